@@ -0,0 +1,73 @@
+"""
+Measures warm invocation latency of lambda_handler against moto,
+before (a new s3 client built on every invocation) and after
+(clients and bucket regions cached in the module level registry).
+
+Run from the repo root with:
+    python -m benchmark.bench_client_cache
+"""
+import os
+import statistics
+import time
+from unittest.mock import patch
+
+import boto3
+from moto import mock_aws
+
+import src.GDPRObfuscator_handler as handler
+
+BUCKET_NAME = "obfuscator-benchmark-bucket"
+KEY_NAME = "customers-100.csv"
+INVOCATIONS = 50
+
+
+def time_invocations(event, invocations):
+    timings = []
+    with patch("builtins.print"):
+        for _ in range(invocations):
+            start = time.perf_counter()
+            handler.lambda_handler(event, None)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarise(label, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(
+        f"{label:<28} median {statistics.median(timings):7.2f} ms"
+        f"   p95 {p95:7.2f} ms   max {timings[-1]:7.2f} ms"
+    )
+
+
+def main():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket=BUCKET_NAME,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=BUCKET_NAME, Key=KEY_NAME, Body=f)
+        event = {
+            "s3_path": f"s3://{BUCKET_NAME}/{KEY_NAME}",
+            "obfuscate_fields": ["First Name", "Last Name"],
+        }
+        handler.reset_s3_clients()
+        time_invocations(event, 1)
+        with patch.object(
+            handler,
+            "get_s3_client_for_bucket",
+            lambda bucket_name, profile=None: handler.init_s3_client(),
+        ):
+            summarise("before: client per call", time_invocations(event, INVOCATIONS))
+        handler.reset_s3_clients()
+        time_invocations(event, 1)
+        summarise("after: cached client", time_invocations(event, INVOCATIONS))
+
+
+if __name__ == "__main__":
+    main()
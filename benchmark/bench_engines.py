@@ -0,0 +1,135 @@
+"""
+Compares the pandas and arrow engines on csv, json and parquet inputs,
+and the exact engine on csv,
+reporting throughput and the peak memory used on top of the input bytes.
+Each case runs in its own process so peak RSS isn't shared between cases,
+the inputs are generated in a separate process too so the parent stays small.
+
+Run from the repo root with:
+    python -m benchmark.bench_engines
+"""
+import io
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PII_FIELDS = ["name", "email"]
+FORMATS = ("csv", "json", "parquet")
+ENGINES = ("pandas", "arrow", "exact")
+
+
+def write_inputs(directory, rows):
+    import pandas as pd
+
+    df = pd.DataFrame(
+        {
+            "id": range(rows),
+            "name": [f"customer {i}" for i in range(rows)],
+            "email": [f"customer{i}@example.com" for i in range(rows)],
+            "balance": [i * 0.25 for i in range(rows)],
+            "city": ["Leeds", "Manchester", "London", "Bristol"] * (rows // 4),
+        }
+    )
+    df.to_csv(directory / "input.csv", index=False)
+    with open(directory / "input.json", "w") as f:
+        json.dump(df.to_dict(orient="records"), f)
+    df.to_parquet(directory / "input.parquet")
+
+
+def run_case(engine, file_format, input_path):
+    """
+    Runs one obfuscation in this process and prints its measurements as json.
+    """
+    import src.GDPRObfuscator_handler as handler
+
+    import psutil
+
+    formatted_bytes = Path(input_path).read_bytes()
+    baseline_mb = psutil.Process().memory_info().rss / 2**20
+    start = time.perf_counter()
+    if engine == "exact":
+        sink = io.BytesIO()
+        handler.exact_obfuscate_csv(formatted_bytes, PII_FIELDS, sink)
+        output = sink.getvalue()
+    elif engine == "arrow":
+        table_dict = handler.convert_bytestream_to_table(
+            formatted_bytes, PII_FIELDS, file_format
+        )
+        new_table = handler.produce_obfuscated_table(table_dict["table"], PII_FIELDS)
+        output = handler.convert_table_to_formatted_bytestream(
+            new_table, file_format, json_orient=table_dict["json_orient"]
+        )
+    else:
+        df_dict = handler.convert_bytestream_to_df(
+            formatted_bytes, PII_FIELDS, file_format=file_format
+        )
+        new_df = handler.produce_obfuscated_data(df_dict["df"], PII_FIELDS)
+        output = handler.convert_df_to_formatted_bytestream(new_df, file_format)
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "seconds": seconds,
+                "input_mb": len(formatted_bytes) / 2**20,
+                "output_mb": len(output) / 2**20,
+                "peak_over_baseline_mb": peak_kb / 1024 - baseline_mb,
+            }
+        )
+    )
+
+
+def main(rows=500_000):
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; from pathlib import Path;"
+                " from benchmark.bench_engines import write_inputs;"
+                " write_inputs(Path(sys.argv[1]), int(sys.argv[2]))",
+                str(directory),
+                str(rows),
+            ],
+            check=True,
+        )
+        print(
+            f"{'format':<8} {'engine':<7} {'input MB':>9} {'seconds':>8}"
+            f" {'MB/s':>7} {'peak over input MB':>19}"
+        )
+        for file_format in FORMATS:
+            for engine in ENGINES:
+                if engine == "exact" and file_format != "csv":
+                    continue
+                completed = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmark.bench_engines",
+                        engine,
+                        file_format,
+                        str(directory / f"input.{file_format}"),
+                    ],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                print(
+                    f"{file_format:<8} {engine:<7} {result['input_mb']:>9.1f}"
+                    f" {result['seconds']:>8.3f}"
+                    f" {result['input_mb'] / result['seconds']:>7.1f}"
+                    f" {result['peak_over_baseline_mb']:>19.1f}"
+                )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4:
+        run_case(*sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,101 @@
+"""
+Compares the old parquet -> csv -> json try/except format cascade with
+detect_format, counting how many times each parser runs per file and timing both.
+The legacy path parses a json file as csv first, which gets very slow as the file
+grows, so the default size is kept small.
+Parquet reads call json.loads once internally to load the pandas schema metadata.
+
+Run from the repo root with:
+    python -m benchmark.bench_format_detection
+"""
+import json
+import time
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+import pandas as pd
+
+import src.GDPRObfuscator_handler as handler
+
+REPEATS = 3
+
+
+def legacy_convert_bytestream_to_df(formatted_bytes, fields):
+    """
+    The trial and error format detection the handler used before detect_format.
+    """
+    try:
+        df = pd.read_parquet(BytesIO(formatted_bytes))
+        if set(fields).issubset(set(df.columns.values.tolist())):
+            return {"df": df, "format": "parquet"}
+        raise TypeError("Failed to interpret bytes as parquet")
+    except Exception:
+        formatted_string = formatted_bytes.decode("utf-8")
+        df = pd.read_csv(StringIO(formatted_string), sep=",", header=0)
+        if set(fields).issubset(set(df.columns.values.tolist())):
+            return {"df": df, "format": "csv"}
+        df = pd.DataFrame.from_dict(json.loads(formatted_string))
+        if set(fields).issubset(set(df.columns.values.tolist())):
+            return {"df": df, "format": "json"}
+        raise TypeError("Failed to interpret string as json or csv")
+
+
+def make_inputs(rows):
+    df = pd.DataFrame(
+        {
+            "id": range(rows),
+            "name": [f"customer {i}" for i in range(rows)],
+            "email": [f"customer{i}@example.com" for i in range(rows)],
+            "city": ["Leeds", "Manchester", "London", "Bristol"] * (rows // 4),
+        }
+    )
+    return {
+        "csv": df.to_csv(index=False).encode("utf-8"),
+        "json": json.dumps(df.to_dict(orient="records")).encode("utf-8"),
+        "parquet": df.to_parquet(),
+    }
+
+
+def count_parses(convert, formatted_bytes, fields):
+    counts = {"read_parquet": 0, "read_csv": 0, "json.loads": 0}
+
+    def counted(name, parser):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return parser(*args, **kwargs)
+
+        return wrapper
+
+    with patch.object(pd, "read_parquet", counted("read_parquet", pd.read_parquet)), \
+        patch.object(pd, "read_csv", counted("read_csv", pd.read_csv)), \
+        patch.object(json, "loads", counted("json.loads", json.loads)), \
+        patch("builtins.print"):
+        convert(formatted_bytes, fields)
+    return counts
+
+
+def time_convert(convert, formatted_bytes, fields):
+    best = float("inf")
+    with patch("builtins.print"):
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            convert(formatted_bytes, fields)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(rows=2_000):
+    fields = ["name", "email"]
+    print(f"{'format':<8} {'path':<8} {'parses':<56} {'best of %d (s)' % REPEATS}")
+    for file_format, formatted_bytes in make_inputs(rows).items():
+        for label, convert in (
+            ("legacy", legacy_convert_bytestream_to_df),
+            ("sniffed", handler.convert_bytestream_to_df),
+        ):
+            counts = count_parses(convert, formatted_bytes, fields)
+            seconds = time_convert(convert, formatted_bytes, fields)
+            print(f"{file_format:<8} {label:<8} {str(counts):<56} {seconds:.3f}")
+
+
+if __name__ == "__main__":
+    main()
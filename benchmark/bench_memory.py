@@ -0,0 +1,133 @@
+"""
+Measures the peak memory of obfuscating a whole file with the pandas and arrow
+engines against the size of its input plus its output, the least a pipeline
+that reads the whole input and writes the whole output can hold at once.
+
+Each case reads its input into a bytearray, as download_file_in_ranges does,
+and runs obfuscate_file_bytes on it with release_input, writing into a BytesIO.
+The handler's modules are imported before the baseline is taken, so the peak
+over the baseline is the memory of the pipeline itself, and "copies" is that
+peak divided by input plus output. What it holds on top of 1 is the parsed
+dataframe or Table, which is larger than a compressed parquet input, rather than
+extra copies of the input or output.
+
+Each case runs in its own process so peak RSS isn't shared between cases,
+the inputs are generated in a separate process too so the parent stays small.
+
+Run from the repo root with, for example:
+    python -m benchmark.bench_memory
+    python -m benchmark.bench_memory --size 200MB --formats csv,parquet
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+FORMATS = ("csv", "json", "ndjson", "parquet")
+ENGINES = ("pandas", "arrow")
+DEFAULT_SIZE = "50MB"
+
+
+def run_case(engine, file_format, input_path, pii_fields):
+    """
+    Runs one obfuscation in this process and prints its measurements as json.
+    """
+    import io
+    import os
+    import resource
+
+    import pandas
+    import psutil
+    import pyarrow.csv
+    import pyarrow.json
+    import pyarrow.parquet
+
+    import src.GDPRObfuscator_handler as handler
+
+    baseline_mb = psutil.Process().memory_info().rss / 2**20
+    file = bytearray(os.path.getsize(input_path))
+    with open(input_path, "rb") as f:
+        f.readinto(file)
+    input_mb = len(file) / 2**20
+    output = io.BytesIO()
+    handler.obfuscate_file_bytes(
+        file,
+        Path(input_path).name,
+        None,
+        pii_fields.split(","),
+        output,
+        {"engine": engine},
+        release_input=True,
+    )
+    output_mb = output.tell() / 2**20
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        json.dumps(
+            {
+                "input_mb": input_mb,
+                "output_mb": output_mb,
+                "peak_over_baseline_mb": peak_mb - baseline_mb,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", default=DEFAULT_SIZE)
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--engines", default=",".join(ENGINES))
+    arguments = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        print(
+            f"{'format':<8} {'engine':<7} {'input MB':>9} {'output MB':>10}"
+            f" {'peak over baseline MB':>22} {'copies':>7}"
+        )
+        for file_format in arguments.formats.split(","):
+            input_path = Path(directory) / f"input.{file_format}"
+            generated = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmark.generate_data",
+                    str(input_path),
+                    "--size",
+                    arguments.size,
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            pii_fields = json.loads(generated.stdout)["pii_fields"]
+            for engine in arguments.engines.split(","):
+                completed = subprocess.run(
+                    [
+                        sys.executable,
+                        "-m",
+                        "benchmark.bench_memory",
+                        engine,
+                        file_format,
+                        str(input_path),
+                        ",".join(pii_fields),
+                    ],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                result = json.loads(completed.stdout.strip().splitlines()[-1])
+                floor_mb = result["input_mb"] + result["output_mb"]
+                print(
+                    f"{file_format:<8} {engine:<7} {result['input_mb']:>9.1f}"
+                    f" {result['output_mb']:>10.1f}"
+                    f" {result['peak_over_baseline_mb']:>22.1f}"
+                    f" {result['peak_over_baseline_mb'] / floor_mb:>7.2f}"
+                )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5:
+        run_case(*sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,56 @@
+"""
+Compares parallel_obfuscate_csv across worker counts with the single threaded
+stream_obfuscate_csv, on a generated csv file, checking the outputs are identical.
+
+Run from the repo root with:
+    python -m benchmark.bench_parallel_csv
+"""
+import os
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import src.GDPRObfuscator_handler as handler
+from benchmark.generate_data import write_file
+
+REPEATS = 3
+
+
+def best_seconds(obfuscate):
+    best = float("inf")
+    for _ in range(REPEATS):
+        output = BytesIO()
+        start = time.perf_counter()
+        obfuscate(output)
+        best = min(best, time.perf_counter() - start)
+    return best, output.getvalue()
+
+
+def main(size=256 * 2**20):
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "input.csv"
+        generated = write_file(path, "csv", size, columns=12)
+        buffer = bytearray(path.read_bytes())
+    size_mb = len(buffer) / 2**20
+    pii_fields = generated["pii_fields"]
+    print(f"{size_mb:.0f} MB csv, {generated['rows']} rows, {os.cpu_count()} cores")
+    print(f"{'workers':>8} {'seconds':>8} {'MB/s':>8}")
+    seconds, expected = best_seconds(
+        lambda output: handler.stream_obfuscate_csv(BytesIO(buffer), pii_fields, output)
+    )
+    print(f"{'single':>8} {seconds:>8.3f} {size_mb / seconds:>8.1f}")
+    workers = 2
+    while workers <= max(2, os.cpu_count()):
+        seconds, obfuscated = best_seconds(
+            lambda output: handler.parallel_obfuscate_csv(
+                buffer, pii_fields, output, max_workers=workers
+            )
+        )
+        assert obfuscated == expected, "parallel output differs"
+        print(f"{workers:>8} {seconds:>8.3f} {size_mb / seconds:>8.1f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares CPU time of obfuscating a wide parquet file with the pandas engine,
+the arrow engine and the column chunk pass-through rewrite.
+
+Run from the repo root with:
+    python -m benchmark.bench_parquet_passthrough
+"""
+import time
+from io import BytesIO
+from unittest.mock import patch
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import src.GDPRObfuscator_handler as handler
+
+PII_FIELDS = ["name", "email", "phone"]
+REPEATS = 3
+
+
+def make_wide_parquet(rows, columns):
+    rng = np.random.default_rng(0)
+    data = {
+        f"metric_{i}": rng.integers(0, 1_000_000, rows) for i in range(columns - 3)
+    }
+    data["name"] = [f"customer {i}" for i in range(rows)]
+    data["email"] = [f"customer{i}@example.com" for i in range(rows)]
+    data["phone"] = [f"07{i:09d}" for i in range(rows)]
+    sink = BytesIO()
+    pq.write_table(pa.table(data), sink, row_group_size=50_000)
+    return sink.getvalue()
+
+
+def run_pandas(parquet_bytes):
+    df_dict = handler.convert_bytestream_to_df(
+        parquet_bytes, PII_FIELDS, file_format="parquet"
+    )
+    new_df = handler.produce_obfuscated_data(df_dict["df"], PII_FIELDS)
+    return handler.convert_df_to_formatted_bytestream(new_df, "parquet")
+
+
+def run_arrow(parquet_bytes):
+    table_dict = handler.convert_bytestream_to_table(parquet_bytes, PII_FIELDS, "parquet")
+    new_table = handler.produce_obfuscated_table(table_dict["table"], PII_FIELDS)
+    return handler.convert_table_to_formatted_bytestream(new_table, "parquet")
+
+
+def run_passthrough(parquet_bytes):
+    output = BytesIO()
+    handler.rewrite_parquet_passthrough(BytesIO(parquet_bytes), PII_FIELDS, output)
+    return output.getvalue()
+
+
+def main(rows=200_000, columns=200):
+    parquet_bytes = make_wide_parquet(rows, columns)
+    print(f"{rows} rows x {columns} columns, {len(parquet_bytes) / 2**20:.1f} MB")
+    print(f"{'path':<12} {'cpu seconds':>12} {'wall seconds':>13}")
+    with patch("builtins.print"):
+        results = {}
+        for label, run in (
+            ("pandas", run_pandas),
+            ("arrow", run_arrow),
+            ("passthrough", run_passthrough),
+        ):
+            best_cpu = best_wall = float("inf")
+            for _ in range(REPEATS):
+                cpu_start, wall_start = time.process_time(), time.perf_counter()
+                run(parquet_bytes)
+                best_cpu = min(best_cpu, time.process_time() - cpu_start)
+                best_wall = min(best_wall, time.perf_counter() - wall_start)
+            results[label] = (best_cpu, best_wall)
+    for label, (best_cpu, best_wall) in results.items():
+        print(f"{label:<12} {best_cpu:>12.3f} {best_wall:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
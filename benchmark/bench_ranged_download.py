@@ -0,0 +1,78 @@
+"""
+Measures download throughput of download_file_in_ranges for a range of part counts,
+next to a single sequential get_object.
+By default it runs against moto, which serves requests in process and copies the whole
+object for every ranged request, so it only shows request overhead and more parts look
+slower. Set BENCHMARK_S3_BUCKET to the name of a real bucket you can write to
+to measure actual network throughput instead.
+
+Run from the repo root with:
+    python -m benchmark.bench_ranged_download
+"""
+import contextlib
+import os
+import time
+
+import boto3
+from moto import mock_aws
+
+import src.GDPRObfuscator_handler as handler
+
+BUCKET_NAME = "obfuscator-benchmark-bucket"
+KEY_NAME = "large-object"
+PART_COUNTS = (1, 2, 4, 8, 16, 32)
+REPEATS = 3
+
+
+def best_seconds(download):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        download()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(size_mb=128):
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    size = size_mb * 2**20
+    bucket_name = os.environ.get("BENCHMARK_S3_BUCKET")
+    mock = mock_aws() if bucket_name is None else contextlib.nullcontext()
+    with mock:
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        if bucket_name is None:
+            bucket_name = BUCKET_NAME
+            s3_client.create_bucket(
+                Bucket=bucket_name,
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+            )
+        s3_client.put_object(Bucket=bucket_name, Key=KEY_NAME, Body=os.urandom(size))
+        print(f"{size_mb} MB object in {bucket_name}")
+        print(f"{'parts':>6} {'part MB':>8} {'seconds':>8} {'MB/s':>8}")
+        seconds = best_seconds(
+            lambda: handler.get_file_from_bucket(bucket_name, KEY_NAME, s3_client)
+        )
+        print(f"{'single':>6} {size_mb:>8.1f} {seconds:>8.3f} {size_mb / seconds:>8.1f}")
+        for part_count in PART_COUNTS:
+            part_size = -(-size // part_count)
+            seconds = best_seconds(
+                lambda: handler.download_file_in_ranges(
+                    bucket_name,
+                    KEY_NAME,
+                    s3_client,
+                    part_size=part_size,
+                    max_concurrency=min(part_count, 16),
+                )
+            )
+            print(
+                f"{part_count:>6} {part_size / 2**20:>8.1f}"
+                f" {seconds:>8.3f} {size_mb / seconds:>8.1f}"
+            )
+        if bucket_name != BUCKET_NAME:
+            s3_client.delete_object(Bucket=bucket_name, Key=KEY_NAME)
+
+
+if __name__ == "__main__":
+    main()
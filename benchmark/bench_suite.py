@@ -0,0 +1,305 @@
+"""
+Runs lambda_handler against moto on generated csv, json, ndjson and parquet files
+of increasing size, and records throughput, peak memory and latency
+percentiles, overall and for each stage, into a json results file.
+Later runs can be compared against a saved results file with --compare.
+
+The handler's cold import is profiled with python -X importtime, recording its
+total import time and its slowest direct imports, and each case records which
+of numpy, pandas and pyarrow it loaded, so cold start regressions show up
+in the results too.
+
+Every size and format runs in its own process so peak RSS isn't shared between
+cases. Inputs come from benchmark.generate_data and are streamed to a temporary
+directory, moto keeps each uploaded input in the benchmark process's memory,
+so peak_rss_mb includes it and peak_over_baseline_mb doesn't.
+
+Run from the repo root with, for example:
+    python -m benchmark.bench_suite --sizes 1MB,100MB --output results.json
+    python -m benchmark.bench_suite --sizes 1MB,100MB --compare results.json
+    python -m benchmark.bench_suite --formats csv --event '{"streaming": true}'
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BUCKET_NAME = "obfuscator-benchmark-bucket"
+PERCENTILES = (50, 90, 99)
+DEFAULT_SIZES = "1MB,10MB"
+DEFAULT_RESULTS_PATH = "benchmark_results.json"
+HEAVY_MODULES = ("numpy", "pandas", "pyarrow")
+IMPORT_PROFILE_REPEATS = 3
+IMPORT_PROFILE_TOP = 10
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def percentiles(values):
+    import numpy as np
+
+    return {
+        f"p{percentile}": float(np.percentile(values, percentile))
+        for percentile in PERCENTILES
+    } | {"min": min(values), "max": max(values)}
+
+
+def run_case(case):
+    """
+    Uploads case["input_path"] to moto and runs lambda_handler on it
+    case["repeats"] times in this process, printing the measurements as json.
+    """
+    import resource
+
+    import boto3
+    import psutil
+    from moto import mock_aws
+
+    import src.GDPRObfuscator_handler as handler
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(
+            Bucket=BUCKET_NAME,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        key_name = f"input.{case['format']}"
+        s3_client.upload_file(case["input_path"], BUCKET_NAME, key_name)
+        event = {
+            **case["event"],
+            "s3_path": f"s3://{BUCKET_NAME}/{key_name}",
+            "obfuscate_fields": case["pii_fields"],
+            "metrics": True,
+        }
+        if "output_s3_path" in event:
+            event["output_s3_path"] = f"s3://{BUCKET_NAME}/output.{case['format']}"
+        baseline_mb = psutil.Process().memory_info().rss / 2**20
+        latencies = []
+        stages = {}
+        for _ in range(case["repeats"]):
+            start = time.perf_counter()
+            response = handler.lambda_handler(event, None)
+            latencies.append((time.perf_counter() - start) * 1000)
+            for stage in response["metrics"]:
+                stages.setdefault(stage["stage"], []).append(stage["wall_ms"])
+            if "body" in response:
+                output_bytes = len(response["body"])
+            else:
+                output_bytes = response["size"]
+            del response
+        loaded_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    best_seconds = min(latencies) / 1000
+    input_mb = case["input_bytes"] / 2**20
+    print(
+        json.dumps(
+            {
+                "output_bytes": output_bytes,
+                "latency_ms": percentiles(latencies),
+                "stages_ms": {name: percentiles(ms) for name, ms in stages.items()},
+                "throughput_mb_s": input_mb / best_seconds,
+                "rows_s": case["rows"] / best_seconds,
+                "peak_rss_mb": peak_mb,
+                "peak_over_baseline_mb": peak_mb - baseline_mb,
+                "loaded_modules": loaded_modules,
+            }
+        )
+    )
+
+
+def import_profile(repeats=IMPORT_PROFILE_REPEATS, top=IMPORT_PROFILE_TOP):
+    """
+    Imports the handler in fresh interpreters with -X importtime and returns the
+    fastest run's total import time and its top slowest direct imports,
+    with their own and cumulative times, in milliseconds.
+    """
+    runs = []
+    for _ in range(repeats):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "import src.GDPRObfuscator_handler",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        imports = []
+        for line in completed.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match is None:
+                continue
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append(
+                {
+                    "module": name,
+                    "depth": len(indent) // 2,
+                    "self_ms": int(self_us) / 1000,
+                    "cumulative_ms": int(cumulative_us) / 1000,
+                }
+            )
+        runs.append(imports)
+    imports = min(runs, key=lambda imports: imports[-1]["cumulative_ms"])
+    direct_imports = sorted(
+        (entry for entry in imports if entry["depth"] == 1),
+        key=lambda entry: entry["cumulative_ms"],
+        reverse=True,
+    )
+    return {
+        "handler_ms": imports[-1]["cumulative_ms"],
+        "modules_imported": len(imports),
+        "slowest_imports": [
+            {key: entry[key] for key in ("module", "self_ms", "cumulative_ms")}
+            for entry in direct_imports[:top]
+        ],
+    }
+
+
+def case_key(result):
+    return (result["format"], result["size"], json.dumps(result["event"]))
+
+
+def compare(results, profile, baseline_path):
+    """
+    Prints the change in handler import time, and in p50 latency and peak memory
+    of each case, against the results file at baseline_path.
+    """
+    with open(baseline_path) as f:
+        baseline_file = json.load(f)
+    baseline = {case_key(result): result for result in baseline_file["results"]}
+    print(f"\ncompared with {baseline_path}")
+    if "import_profile" in baseline_file:
+        previous_ms = baseline_file["import_profile"]["handler_ms"]
+        print(
+            f"handler import {profile['handler_ms']:.1f} ms, was {previous_ms:.1f} ms"
+            f" ({(profile['handler_ms'] / previous_ms - 1) * 100:+.1f}%)"
+        )
+    print(
+        f"{'format':<8} {'size':>6} {'p50 ms':>10} {'was':>10} {'change':>8}"
+        f" {'peak MB':>8} {'was':>8}"
+    )
+    for result in results:
+        previous = baseline.get(case_key(result))
+        if previous is None:
+            continue
+        p50 = result["latency_ms"]["p50"]
+        previous_p50 = previous["latency_ms"]["p50"]
+        print(
+            f"{result['format']:<8} {result['size']:>6} {p50:>10.1f}"
+            f" {previous_p50:>10.1f} {(p50 / previous_p50 - 1) * 100:>+7.1f}%"
+            f" {result['peak_over_baseline_mb']:>8.1f}"
+            f" {previous['peak_over_baseline_mb']:>8.1f}"
+        )
+
+
+def main():
+    # imported here so the --run-case processes only load what the handler loads
+    from benchmark.generate_data import FORMATS, parse_size, write_file
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES)
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--pii-ratio", type=float, default=0.3)
+    parser.add_argument("--string-length", type=int, default=16)
+    parser.add_argument("--cardinality", type=int, default=10_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--event",
+        default="{}",
+        help='extra event fields as json, e.g. \'{"engine": "arrow"}\'',
+    )
+    parser.add_argument("--output", default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("--compare", default=None)
+    arguments = parser.parse_args()
+    generator_options = {
+        "columns": arguments.columns,
+        "pii_ratio": arguments.pii_ratio,
+        "string_length": arguments.string_length,
+        "cardinality": arguments.cardinality,
+    }
+    event = json.loads(arguments.event)
+    profile = import_profile()
+    print(
+        f"handler import {profile['handler_ms']:.1f} ms, slowest imports: "
+        + ", ".join(
+            f"{entry['module']} {entry['cumulative_ms']:.1f} ms"
+            for entry in profile["slowest_imports"][:3]
+        )
+    )
+    results = []
+    print(
+        f"{'format':<8} {'size':>6} {'rows':>10} {'p50 ms':>10} {'p90 ms':>10}"
+        f" {'MB/s':>8} {'rows/s':>10} {'peak MB':>8}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for size in arguments.sizes.split(","):
+            for file_format in arguments.formats.split(","):
+                input_path = Path(directory) / f"input.{file_format}"
+                generated = write_file(
+                    input_path, file_format, parse_size(size), **generator_options
+                )
+                case = {
+                    "format": file_format,
+                    "size": size,
+                    "event": event,
+                    "input_path": str(input_path),
+                    "input_bytes": generated["bytes"],
+                    "rows": generated["rows"],
+                    "pii_fields": generated["pii_fields"],
+                    "repeats": arguments.repeats,
+                }
+                completed = subprocess.run(
+                    [sys.executable, "-m", "benchmark.bench_suite", "--run-case"],
+                    input=json.dumps(case),
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                result = case | json.loads(completed.stdout.strip().splitlines()[-1])
+                del result["input_path"]
+                results.append(result)
+                print(
+                    f"{file_format:<8} {size:>6} {result['rows']:>10}"
+                    f" {result['latency_ms']['p50']:>10.1f}"
+                    f" {result['latency_ms']['p90']:>10.1f}"
+                    f" {result['throughput_mb_s']:>8.1f} {result['rows_s']:>10.0f}"
+                    f" {result['peak_over_baseline_mb']:>8.1f}"
+                )
+                input_path.unlink()
+    if arguments.compare is not None:
+        compare(results, profile, arguments.compare)
+    with open(arguments.output, "w") as f:
+        json.dump(
+            {
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+                "generator": generator_options,
+                "import_profile": profile,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"\nresults written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--run-case"]:
+        run_case(json.load(sys.stdin))
+    else:
+        main()
@@ -0,0 +1,184 @@
+"""
+Deterministic synthetic PII data for the benchmarks.
+Files are generated in batches and streamed to disk until they reach a target size,
+so inputs from 1MB up to several GB can be made without holding them in memory.
+The same seed and settings always produce the same bytes.
+
+Columns are an "id" column followed by string pii columns ("pii_0", "pii_1", ...)
+and non pii columns cycling through strings, integers and floats ("col_0", ...).
+Strings are drawn from a pool of `cardinality` distinct values of `string_length`
+characters, so the cardinality also controls how well the files compress.
+
+Run from the repo root with, for example:
+    python -m benchmark.generate_data /tmp/input.csv --size 100MB --columns 20
+"""
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+FORMATS = ("csv", "json", "ndjson", "parquet")
+DEFAULT_SEED = 20240601
+BATCH_ROWS = 20_000
+SIZE_UNITS = {"B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30}
+STRING_ALPHABET = np.frombuffer(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ", dtype=np.uint8
+)
+
+
+def parse_size(size):
+    """
+    Parses sizes such as "1MB", "512KB" or "5GB" into a number of bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B)\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Can't parse size {size}, expected a size like 10MB")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def column_names(columns, pii_ratio):
+    """
+    Returns the names of the pii columns and of all the columns for a file
+    with the given number of columns, at least one of which is pii.
+    """
+    if columns < 2:
+        raise ValueError("At least 2 columns are needed, the id and a pii column")
+    pii_count = min(columns - 1, max(1, round(columns * pii_ratio)))
+    pii_columns = [f"pii_{i}" for i in range(pii_count)]
+    other_columns = [f"col_{i}" for i in range(columns - 1 - pii_count)]
+    return {"pii": pii_columns, "all": ["id"] + pii_columns + other_columns}
+
+
+def _string_pool(rng, cardinality, string_length):
+    characters = rng.choice(STRING_ALPHABET, size=(cardinality, string_length))
+    return pa.array(
+        [row.tobytes().decode("ascii") for row in characters], type=pa.string()
+    )
+
+
+def _make_batch(rng, pool, names, first_id, rows):
+    arrays = [pa.array(np.arange(first_id, first_id + rows))]
+    for position in range(len(names["all"]) - 1):
+        kind = position - len(names["pii"])
+        if kind < 0 or kind % 3 == 0:
+            arrays.append(pool.take(rng.integers(0, len(pool), rows)))
+        elif kind % 3 == 1:
+            arrays.append(pa.array(rng.integers(0, 1_000_000, rows)))
+        else:
+            arrays.append(pa.array(rng.random(rows).round(4)))
+    return pa.Table.from_arrays(arrays, names=names["all"])
+
+
+def generate_batches(
+    columns=10,
+    pii_ratio=0.3,
+    string_length=16,
+    cardinality=10_000,
+    seed=DEFAULT_SEED,
+    batch_rows=BATCH_ROWS,
+    first_batch_rows=None,
+):
+    """
+    Returns a generator of pyarrow Tables, each of batch_rows rows unless another
+    number of rows is passed in with .send(), it never runs out.
+    The first Table has first_batch_rows rows when given.
+    """
+    rng = np.random.default_rng(seed)
+    pool = _string_pool(rng, cardinality, string_length)
+    names = column_names(columns, pii_ratio)
+    first_id = 0
+    rows = first_batch_rows or batch_rows
+    while True:
+        table = _make_batch(rng, pool, names, first_id, rows)
+        first_id += rows
+        rows = (yield table) or batch_rows
+
+
+def _json_records(table):
+    # json.dumps of each batch's rows, without the enclosing list brackets
+    return json.dumps(table.to_pylist(), separators=(",", ":"))[1:-1]
+
+
+def write_file(path, file_format, size, **batch_options):
+    """
+    Streams generated batches to path in file_format until it holds at least
+    size bytes, then returns a dictionary with the rows, bytes and pii_fields
+    written. Json files are a single list of records, ndjson files have one record
+    on each line.
+    The first batch is small and later batches are sized from the bytes per row
+    it took, so small files don't overshoot their size by a whole batch.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown format {file_format}, must be one of {FORMATS}")
+    batch_rows = batch_options.get("batch_rows", BATCH_ROWS)
+    batches = generate_batches(first_batch_rows=min(batch_rows, 1000), **batch_options)
+    rows = 0
+    with open(path, "wb") as f:
+        writer = None
+        table = next(batches)
+        while True:
+            if file_format == "csv":
+                if writer is None:
+                    writer = pa_csv.CSVWriter(f, table.schema)
+                writer.write_table(table)
+            elif file_format == "json":
+                f.write(b"," if rows else b"[")
+                f.write(_json_records(table).encode("utf-8"))
+            elif file_format == "ndjson":
+                lines = [
+                    json.dumps(record, separators=(",", ":")) + "\n"
+                    for record in table.to_pylist()
+                ]
+                f.write("".join(lines).encode("utf-8"))
+            else:
+                if writer is None:
+                    writer = pq.ParquetWriter(f, table.schema, compression="snappy")
+                writer.write_table(table)
+            rows += table.num_rows
+            written = f.tell()
+            if written >= size:
+                break
+            remaining_rows = (size - written) * rows // max(written, 1) + 1
+            table = batches.send(min(batch_rows, remaining_rows))
+        if writer is not None:
+            writer.close()
+        if file_format == "json":
+            f.write(b"]")
+    names = column_names(
+        batch_options.get("columns", 10), batch_options.get("pii_ratio", 0.3)
+    )
+    return {"rows": rows, "bytes": os.path.getsize(path), "pii_fields": names["pii"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS, default=None)
+    parser.add_argument("--size", default="1MB")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--pii-ratio", type=float, default=0.3)
+    parser.add_argument("--string-length", type=int, default=16)
+    parser.add_argument("--cardinality", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    arguments = parser.parse_args()
+    file_format = arguments.format or os.path.splitext(arguments.path)[1][1:]
+    result = write_file(
+        arguments.path,
+        file_format,
+        parse_size(arguments.size),
+        columns=arguments.columns,
+        pii_ratio=arguments.pii_ratio,
+        string_length=arguments.string_length,
+        cardinality=arguments.cardinality,
+        seed=arguments.seed,
+    )
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Builds the lambda dependency layer from dependency_layer/ into build/layer/python,
+the directory terraform/lambdas.tf zips, so it's extracted to /opt/python where
+the lambda runtime imports it from.
+
+The copy is trimmed and precompiled:
+    - botocore/data keeps only the models of the services the obfuscator calls,
+    s3, lambda for fan out, and sts, sso and sso-oidc for the "profile" option
+    - modules nothing imports in lambda are dropped, see DROPPED_PATHS
+    - every module is compiled to unchecked hash based .pyc files, /opt is read only
+    so without them each cold start compiles botocore from source, and hash based
+    .pyc files stay valid whatever modification times the zip gives the sources
+
+The layer's size and the time a fresh interpreter takes to import botocore and
+create an s3 client from it are reported before and after trimming.
+The .pyc files only load on the python version that wrote them, so the build
+must run on the lambda runtime's version.
+
+Run from the repo root with, for example:
+    python scripts/build_layer.py
+    python scripts/build_layer.py --report layer_report.json
+"""
+import argparse
+import compileall
+import json
+import os
+import py_compile
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+SOURCE_DIRECTORY = "dependency_layer"
+BUILD_DIRECTORY = "build/layer"
+RUNTIME_VERSION = "3.11"
+KEPT_SERVICES = ("s3", "lambda", "sts", "sso", "sso-oidc")
+DROPPED_PATHS = (
+    "bin",
+    "urllib3/contrib/emscripten",
+    "urllib3/contrib/pyopenssl.py",
+    "urllib3/contrib/socks.py",
+)
+IMPORT_REPEATS = 7
+COLD_START_CODE = """
+import botocore.session
+botocore.session.get_session().create_client(
+    "s3",
+    region_name="eu-west-2",
+    aws_access_key_id="layer",
+    aws_secret_access_key="layer",
+)
+"""
+
+
+def directory_size(path):
+    """
+    Returns the number of files in path and their total size in bytes.
+    """
+    files = [file for file in Path(path).rglob("*") if file.is_file()]
+    return {"files": len(files), "bytes": sum(file.stat().st_size for file in files)}
+
+
+def zipped_size(path):
+    """
+    Returns the size in bytes of path zipped the way terraform's archive_file does.
+    """
+    with tempfile.TemporaryFile() as f:
+        with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as archive:
+            for file in sorted(Path(path).rglob("*")):
+                if file.is_file():
+                    archive.write(file, file.relative_to(path))
+        return f.tell()
+
+
+def cold_import_ms(path, repeats=IMPORT_REPEATS):
+    """
+    Returns the median wall time in milliseconds of fresh interpreters importing
+    botocore from path and creating an s3 client. Site packages are left out so
+    only the layer is imported, and no bytecode is written, as in lambda's /opt.
+    """
+    environment = {
+        **os.environ,
+        "PYTHONPATH": str(path),
+        "PYTHONDONTWRITEBYTECODE": "1",
+    }
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-S", "-c", COLD_START_CODE], env=environment, check=True
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def measure(path):
+    return directory_size(path) | {
+        "zipped_bytes": zipped_size(path),
+        "cold_import_ms": cold_import_ms(path),
+    }
+
+
+def prune(path, kept_services=KEPT_SERVICES):
+    """
+    Removes the botocore service models that aren't in kept_services and the
+    DROPPED_PATHS from the layer at path, the data files shared by every
+    service, such as endpoints.json, are kept.
+    """
+    data = Path(path) / "botocore" / "data"
+    for service in data.iterdir():
+        if service.is_dir() and service.name not in kept_services:
+            shutil.rmtree(service)
+    for dropped in DROPPED_PATHS:
+        dropped = Path(path) / dropped
+        if dropped.is_dir():
+            shutil.rmtree(dropped)
+        elif dropped.exists():
+            dropped.unlink()
+
+
+def build_layer(source, destination, kept_services=KEPT_SERVICES):
+    """
+    Copies the layer from source to destination/python, measures it, trims and
+    precompiles it and measures it again.
+    Returns a dictionary of the "before" and "after" measurements.
+    """
+    target = Path(destination) / "python"
+    if Path(destination).exists():
+        shutil.rmtree(destination)
+    shutil.copytree(
+        source, target, ignore=shutil.ignore_patterns("__pycache__", "*.pyc")
+    )
+    before = measure(target)
+    prune(target, kept_services)
+    compiled = compileall.compile_dir(
+        target,
+        quiet=1,
+        workers=0,
+        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+    )
+    if not compiled:
+        raise RuntimeError(f"Failed to compile every module of {target}")
+    return {"before": before, "after": measure(target)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--source", default=SOURCE_DIRECTORY)
+    parser.add_argument("--destination", default=BUILD_DIRECTORY)
+    parser.add_argument("--services", default=",".join(KEPT_SERVICES))
+    parser.add_argument("--report", default=None)
+    arguments = parser.parse_args()
+    version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    if version != RUNTIME_VERSION:
+        raise SystemExit(
+            f"The layer is for python{RUNTIME_VERSION}, it can't be compiled "
+            f"with python{version}"
+        )
+    result = build_layer(
+        arguments.source, arguments.destination, arguments.services.split(",")
+    )
+    print(f"{'':<8} {'files':>8} {'MB':>8} {'zipped MB':>10} {'import ms':>10}")
+    for name, measured in result.items():
+        print(
+            f"{name:<8} {measured['files']:>8} {measured['bytes'] / 2**20:>8.1f}"
+            f" {measured['zipped_bytes'] / 2**20:>10.1f}"
+            f" {measured['cold_import_ms']:>10.1f}"
+        )
+    if arguments.report is not None:
+        with open(arguments.report, "w") as f:
+            json.dump(result | {"python": version}, f, indent=2)
+    print(f"\nlayer written to {arguments.destination}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,223 @@
+import bz2
+import codecs
+import contextlib
+import csv
+import functools
+import hmac
+import importlib
+import itertools
 import json
+import lzma
+import os
+import queue
+import random
+import re
+import resource
+import tracemalloc
+import threading
+import time
+import zlib
+import concurrent.futures
+import multiprocessing.shared_memory
 import botocore.client
-import pandas as pd
+import botocore.config
+import botocore.exceptions
+import jmespath
+import jmespath.visitor
 import botocore.session
+import io
 from io import StringIO, BytesIO
 
 
+class _LazyModule:
+    """
+    Stands in for a module and imports it the first time one of its attributes
+    is used, so numpy, pandas and pyarrow are only loaded by the invocations
+    whose format and engine need them, rather than on every cold start.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazily imported module {self._name!r}>"
+
+
+np = _LazyModule("numpy")
+pd = _LazyModule("pandas")
+pa = _LazyModule("pyarrow")
+pa_csv = _LazyModule("pyarrow.csv")
+pa_json = _LazyModule("pyarrow.json")
+pq = _LazyModule("pyarrow.parquet")
+
+ENGINES = ("pandas", "arrow", "exact")
+OBFUSCATED_STRING = "***"
+MODES = ("mask", "pseudonymise")
+TYPED_MASKS = ("null", "sentinel")
+TYPED_MASK_KINDS = "iufbM"
+PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE = "OBFUSCATOR_PSEUDONYMISATION_KEY"
+PSEUDONYM_LENGTH = 16
+PSEUDONYM_CACHE_SIZE = 100_000
+FIELD_PATH_CACHE_SIZE = 256
+FIELD_PATH_CHARACTERS = re.compile(r"[.\[*]")
+CSV_STREAM_CHUNK_ROWS = 10000
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+PARALLEL_SLICES_PER_WORKER = 4
+CSV_EXACT_BLOCK_BYTES = 1024 * 1024
+JSON_STREAM_READ_BYTES = 64 * 1024
+JSON_WRITE_BUFFER_BYTES = 1024 * 1024
+WRITE_CHUNK_ROWS = 50_000
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+NDJSON_BLOCK_BYTES = 1024 * 1024
+NDJSON_BLANK_LINE = re.compile(rb"(?m)^[ \t\r]*$")
+NDJSON_LINE_START = re.compile(r"[ \t\r]*\n[ \t\n\r]*\{")
+S3_POOL_SETTINGS = {
+    "max_pool_connections": 32,
+    "tcp_keepalive": True,
+}
+METRICS_NAMESPACE = "GDPRObfuscator"
+METRICS_ENVIRONMENT_VARIABLE = "OBFUSCATOR_METRICS"
+PRIME_ENVIRONMENT_VARIABLE = "OBFUSCATOR_PRIME"
+PRIME_BUCKETS_ENVIRONMENT_VARIABLE = "OBFUSCATOR_PRIME_BUCKETS"
+PRIMED_INITIALIZATION_TYPES = ("provisioned-concurrency", "snap-start")
+PRIME_SAMPLE_RECORDS = [
+    {"id": 1, "name": "Ada", "email": "ada@example.com"},
+    {"id": 2, "name": "Alan", "email": "alan@example.com"},
+]
+EMF_METRIC_UNITS = {
+    "wall_ms": "Milliseconds",
+    "cpu_ms": "Milliseconds",
+    "bytes_in": "Bytes",
+    "bytes_out": "Bytes",
+    "max_rss_mb": "Megabytes",
+    "traced_peak_mb": "Megabytes",
+}
+OUTPUT_MODES = ("s3", "auto")
+LAMBDA_RESPONSE_PAYLOAD_LIMIT = 6 * 1024 * 1024
+S3_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = 4
+BATCH_CONCURRENCY = 8
+S3_LIST_PAGE_SIZE = 1000
+PREFIX_FAILURE_REPORT_LIMIT = 100
+FAN_OUT_EXECUTORS = ("lambda", "local")
+FAN_OUT_RANGE_SIZE = 64 * 1024 * 1024
+FAN_OUT_CONCURRENCY = 16
+FAN_OUT_WINDOW_BYTES = 1024 * 1024
+FAN_OUT_CHECK_RECORDS = 16
+S3_MAX_PARTS = 10000
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+COMPRESSIONS = ("gzip", "bz2", "xz")
+COMPRESSION_MAGIC = {b"\x1f\x8b": "gzip", b"BZh": "bz2", b"\xfd7zXZ\x00": "xz"}
+COMPRESSION_ENCODINGS = {
+    "gzip": "gzip",
+    "x-gzip": "gzip",
+    "bzip2": "bz2",
+    "x-bzip2": "bz2",
+    "xz": "xz",
+    "x-xz": "xz",
+}
+COMPRESSION_EXTENSIONS = (".gz", ".gzip", ".bz2", ".xz")
+COMPRESSION_LEVELS = {"gzip": 6, "bz2": 9, "xz": 6}
+COMPRESSION_CHUNK_BYTES = 1024 * 1024
+COMPRESSION_QUEUE_CHUNKS = 4
+LAMBDA_INVOKE_READ_TIMEOUT = 900
+S3_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+S3_DOWNLOAD_CONCURRENCY = 8
+S3_DOWNLOAD_READ_SIZE = 1024 * 1024
+FORMAT_SNIFF_BYTES = 4096
+PARQUET_MAGIC = b"PAR1"
+UTF8_BOM = b"\xef\xbb\xbf"
+FORMAT_EXTENSIONS = {
+    ".csv": "csv",
+    ".json": "json",
+    ".jsonl": "ndjson",
+    ".ndjson": "ndjson",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+}
+FORMAT_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/json": "json",
+    "text/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/x-jsonlines": "ndjson",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+}
+PARQUET_COPY_BLOCK_BYTES = 8 * 1024 * 1024
+PARQUET_CODECS = {
+    0: "NONE",
+    1: "SNAPPY",
+    2: "GZIP",
+    3: "LZO",
+    4: "BROTLI",
+    5: "LZ4",
+    6: "ZSTD",
+    7: "LZ4",
+}
+# compression names in parquet metadata that the writer knows by another name
+PARQUET_METADATA_COMPRESSIONS = {
+    "UNCOMPRESSED": "NONE",
+    "LZ4_RAW": "LZ4",
+}
+
+# thrift compact protocol types, used to read and write parquet footers
+THRIFT_STOP = 0
+THRIFT_TRUE = 1
+THRIFT_FALSE = 2
+THRIFT_BYTE = 3
+THRIFT_I16 = 4
+THRIFT_I32 = 5
+THRIFT_I64 = 6
+THRIFT_DOUBLE = 7
+THRIFT_BINARY = 8
+THRIFT_LIST = 9
+THRIFT_SET = 10
+THRIFT_STRUCT = 12
+
+# field ids from the parquet-format thrift definitions
+PARQUET_FILE_NUM_ROWS = 3
+PARQUET_FILE_ROW_GROUPS = 4
+PARQUET_FILE_ENCRYPTION_ALGORITHM = 8
+PARQUET_ROW_GROUP_COLUMNS = 1
+PARQUET_ROW_GROUP_TOTAL_BYTE_SIZE = 2
+PARQUET_ROW_GROUP_NUM_ROWS = 3
+PARQUET_ROW_GROUP_FILE_OFFSET = 5
+PARQUET_ROW_GROUP_TOTAL_COMPRESSED_SIZE = 6
+PARQUET_CHUNK_FILE_OFFSET = 2
+PARQUET_CHUNK_METADATA = 3
+PARQUET_CHUNK_PAGE_INDEX_FIELDS = (4, 5, 6, 7)
+PARQUET_COLUMN_TYPE = 1
+PARQUET_COLUMN_PATH = 3
+PARQUET_COLUMN_CODEC = 4
+PARQUET_COLUMN_TOTAL_UNCOMPRESSED_SIZE = 6
+PARQUET_COLUMN_TOTAL_COMPRESSED_SIZE = 7
+PARQUET_COLUMN_DATA_PAGE_OFFSET = 9
+PARQUET_COLUMN_INDEX_PAGE_OFFSET = 10
+PARQUET_COLUMN_DICTIONARY_PAGE_OFFSET = 11
+PARQUET_COLUMN_STATISTICS = 12
+PARQUET_COLUMN_BLOOM_FILTER_OFFSET = 14
+PARQUET_COLUMN_BLOOM_FILTER_LENGTH = 15
+PARQUET_COLUMN_SIZE_STATISTICS = 16
+PARQUET_TYPE_INT96 = 3
+
+# s3 clients and bucket regions live at module level so warm lambda
+# invocations reuse them instead of building a new client every time.
+_s3_clients = {}
+_bucket_regions = {}
+_s3_clients_lock = threading.Lock()
+# the credentials the cached clients were built with, see check_restored
+_primed_credentials = None
+
+
 def lambda_handler(event, context):
     """
     This function is the handler for the obfuscator tool, 
@@ -17,6 +230,97 @@ def lambda_handler(event, context):
                 "s3_path" : "s3://my_bucket/my_file_key",
                 "obfuscate_fields" : ["sensitive data field1", "sensitive data fieldn"]
             }
+            json, ndjson and parquet fields can also be JMESPath expressions
+            selecting nested values, e.g. "customer.contact.email" or
+            "orders[*].shipping.address", applied to each record or to the struct
+            and list columns of a parquet file.
+            optional fields:
+                - "streaming" : true
+                    csv files are read from s3 and obfuscated chunk by chunk,
+                    json files record by record,
+                    parquet files row group by row group using ranged requests,
+                    so the whole file is never held in memory at once.
+                - "chunk_rows" : the number of csv rows in each streamed chunk.
+                - "profile" : the aws config profile used to create the s3 client.
+                - "engine" : "pandas" (default), "arrow" or "exact"
+                    the arrow engine obfuscates a pyarrow Table, replacing only the
+                    sensitive columns and leaving every other column untouched.
+                    the exact engine copies csv files byte for byte, only the
+                    sensitive fields are replaced, other formats use pandas.
+                    Except with the arrow engine, json files are obfuscated with
+                    stream_obfuscate_json, keeping their shape and key order,
+                    and ndjson files line by line with stream_obfuscate_ndjson.
+                - "parquet_passthrough" : true
+                    parquet files are rewritten chunk by chunk, only the column chunks
+                    of the sensitive fields are re-encoded, the rest are copied as is.
+                - "output_s3_path" : "s3://my_bucket/my_obfuscated_file_key"
+                    the obfuscated file is streamed to this s3 path with a multipart
+                    upload instead of being returned.
+                - "output_mode" : "s3" (default) or "auto"
+                    in auto mode outputs within the lambda response payload limit
+                    are returned as usual and only larger outputs go to output_s3_path.
+                - "upload_part_size", "upload_concurrency" : the size in bytes of each
+                    uploaded part and how many parts are uploaded at once.
+                - "download_part_size", "download_concurrency" : the size in bytes of
+                    each ranged request used to download the file and how many
+                    are made at once.
+                - "workers" : the number of processes csv and ndjson files are
+                    obfuscated with in parallel, for multi-core machines outside
+                    aws lambda. The output is the same as with "streaming", every
+                    csv value is written back as the string it was read as.
+                - "output_compression" : "same" (default), "none", "gzip", "bz2" or "xz"
+                    gzip, bz2 and xz input files are detected from their magic bytes
+                    or ContentEncoding and decompressed, by default the output is
+                    compressed with the same codec.
+                - "compression_level" : the level the output is compressed with.
+                - "mode" : "mask" (default) or "pseudonymise"
+                    in pseudonymise mode each sensitive value is replaced with a token,
+                    the start of its HMAC-SHA256 under the key in the environment
+                    variable OBFUSCATOR_PSEUDONYMISATION_KEY, so a value gets the
+                    same token in every file. Nulls and empty values are kept.
+                - "token_length" : the number of hex characters in each token.
+                - "typed_mask" : "null" or "sentinel"
+                    masked parquet columns of numbers, booleans and datetimes keep
+                    their type, holding nulls or the zero value of the type, instead
+                    of becoming "***" strings. Text formats always show ***.
+                - "metrics" : true
+                    wall time, cpu time, bytes in and out and peak memory of each
+                    stage are printed as CloudWatch Embedded Metric Format lines and
+                    added to the response under "metrics". Setting the environment
+                    variable OBFUSCATOR_METRICS=true prints them for every invocation
+                    without changing the response.
+                - "trace_memory" : true
+                    also record the peak python allocations of each stage with tracemalloc.
+            a batch of files can be obfuscated in one invocation by passing "items"
+            instead of "s3_path", every item is written to its output_s3_path:
+            event = {
+                "items" : [
+                    {
+                        "s3_path" : "s3://my_bucket/my_file_key",
+                        "output_s3_path" : "s3://my_bucket/my_obfuscated_file_key",
+                        "obfuscate_fields" : ["sensitive data field1"]
+                    },
+                ],
+                "batch_concurrency" : 8
+            }
+            fields set on the event, such as "obfuscate_fields" or "engine",
+            apply to every item that doesn't set them itself.
+            a csv file too large for one invocation can be split into byte ranges
+            obfuscated by parallel worker invocations with "fan_out" : true,
+            the output_s3_path is then required:
+                - "fan_out_range_size" : the number of bytes given to each worker,
+                    at least S3_MIN_PART_SIZE, a smaller one raises ValueError
+                    before the multipart upload is created.
+                - "fan_out_concurrency" : how many workers run at once.
+                - "fan_out_executor" : "lambda" (default in aws lambda) or "local".
+                - "fan_out_function_name" : the function invoked for each worker.
+            every object under a prefix is obfuscated when the s3_path ends in /,
+            each is written to the same key under the output_s3_path prefix:
+            event = {
+                "s3_path" : "s3://my_bucket/my_prefix/",
+                "output_s3_path" : "s3://my_bucket/my_obfuscated_prefix/",
+                "obfuscate_fields" : ["sensitive data field1"]
+            }
             - context is not used and can be passed context = None
         - When deployed using terraform:
         the handler is called from aws lambda. 
@@ -36,181 +340,4451 @@ def lambda_handler(event, context):
         - A bytestream of the data from the obfuscated file 
         with sensitive data replaced by ***.
         The object is ready and compatible for a boto3.put_object operation.
+        - When the output is written to output_s3_path a dictionary describing
+        the uploaded object is returned instead, with its s3_path, bucket_name,
+        key_name, size, etag, format, row_count and timings.
+        - With "metrics" the bytestream is returned as {"body": ..., "metrics": [...]},
+        and a "metrics" list is added to the dictionary returned for output_s3_path.
+        - For a batch event a dictionary with the number of items that "succeeded"
+        and "failed" and the report of each item under "items", a failed item
+        doesn't stop the rest of the batch.
+        - For a prefix the number of objects that "succeeded", "failed" and were
+        "skipped", with the reports of the first failed objects under "failures".
+        - For "fan_out" the dictionary describing the uploaded object, with the
+        number of "workers" it was split between.
             
     """
+    check_restored()
+    include_metrics = event.get("metrics", False)
+    recorder = StageRecorder(
+        enabled=include_metrics or metrics_enabled_by_environment(),
+        trace_memory=event.get("trace_memory", False),
+    )
+    if "fan_out_worker" in event:
+        response = obfuscate_csv_range(event["fan_out_worker"])
+    elif event.get("fan_out", False):
+        with recorder.stage("fan_out"):
+            response = fan_out_obfuscate_csv(event)
+    elif "items" in event:
+        with recorder.stage("batch"):
+            response = obfuscate_batch(event)
+    elif event["s3_path"].endswith("/"):
+        with recorder.stage("prefix"):
+            response = obfuscate_prefix(event)
+    else:
+        response = obfuscate_event_file(event, recorder)
+    recorder.finish()
+    if include_metrics:
+        if isinstance(response, dict):
+            response["metrics"] = recorder.stages
+        else:
+            response = {"body": response, "metrics": recorder.stages}
+    return response
+
+
+def obfuscate_event_file(event, recorder=None):
+    """
+    This function will obfuscate the file at the s3_path of an event.
+    Parameters:
+        - event
+            The event passed to lambda_handler, with one file's s3_path.
+        - recorder
+            Optionally a StageRecorder to record each stage in.
+    Returns:
+        - The obfuscated bytestream, or for an output_s3_path the dictionary
+        returned by obfuscate_s3_file_to_s3.
+    """
+    if recorder is None:
+        recorder = DISABLED_RECORDER
     s3_path = event["s3_path"]
     fields = event["obfuscate_fields"]
-    s3_client = init_s3_client()
     path_elements = get_bucket_and_key_strings(s3_path)
-    file = get_file_from_bucket(
-        bucket_name=path_elements["bucket_name"],
-        file_name=path_elements["key_name"],
-        client=s3_client,
+    with recorder.stage("client"):
+        s3_client = get_s3_client_for_bucket(
+            path_elements["bucket_name"], profile=event.get("profile")
+        )
+    output_s3_path = event.get("output_s3_path")
+    if output_s3_path is None:
+        output = BytesIO()
+        obfuscate_s3_file(
+            client=s3_client,
+            bucket_name=path_elements["bucket_name"],
+            file_name=path_elements["key_name"],
+            pii_fields=fields,
+            output=output,
+            options=event,
+            recorder=recorder,
+        )
+        return output.getvalue()
+    else:
+        return obfuscate_s3_file_to_s3(
+            client=s3_client,
+            bucket_name=path_elements["bucket_name"],
+            file_name=path_elements["key_name"],
+            pii_fields=fields,
+            output_s3_path=output_s3_path,
+            options=event,
+            recorder=recorder,
+        )
+
+
+def obfuscate_s3_file_to_s3(
+    client,
+    bucket_name,
+    file_name,
+    pii_fields,
+    output_s3_path,
+    options,
+    recorder=None,
+):
+    """
+    This function will obfuscate an s3 file and stream the obfuscated file to
+    output_s3_path with an S3MultipartWriter.
+    Parameters:
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, file_name
+            Strings naming the object's bucket and key.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output_s3_path
+            The s3 path in the format "s3://bucket/key" to write the obfuscated file to.
+        - options
+            A dictionary of the optional event fields described in lambda_handler,
+            e.g. the event itself.
+        - recorder
+            Optionally a StageRecorder to record each stage in.
+    Returns:
+        - A dictionary describing the uploaded object with its s3_path, bucket_name,
+        key_name, size, etag, format, row_count and timings.
+        - Or, in "auto" output_mode, the obfuscated bytes when they fit
+        in the lambda response payload.
+    """
+    if recorder is None:
+        recorder = DISABLED_RECORDER
+    output_mode = options.get("output_mode", "s3")
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(
+            f"Unknown output_mode {output_mode}, must be one of {OUTPUT_MODES}"
+        )
+    destination = get_bucket_and_key_strings(output_s3_path)
+    start_time = time.perf_counter()
+    writer = S3MultipartWriter(
+        client=get_s3_client_for_bucket(
+            destination["bucket_name"], profile=options.get("profile")
+        ),
+        bucket_name=destination["bucket_name"],
+        file_name=destination["key_name"],
+        part_size=options.get("upload_part_size", S3_UPLOAD_PART_SIZE),
+        max_concurrency=options.get("upload_concurrency", S3_UPLOAD_CONCURRENCY),
+        inline_limit=LAMBDA_RESPONSE_PAYLOAD_LIMIT if output_mode == "auto" else None,
     )
-    df_dict = convert_bytestream_to_df(file, fields)
-    df = df_dict["df"]
-    found_format = df_dict["format"]
-    new_df = produce_obfuscated_data(df, fields)
-    return convert_df_to_formatted_bytestream(new_df, found_format)
+    with recorder.stage("upload") as upload_stage:
+        with writer:
+            result = obfuscate_s3_file(
+                client=client,
+                bucket_name=bucket_name,
+                file_name=file_name,
+                pii_fields=pii_fields,
+                output=writer,
+                options=options,
+                recorder=recorder,
+            )
+            obfuscated_time = time.perf_counter()
+        upload_stage.record(bytes_out=writer.size)
+    if writer.inline_body is not None:
+        return writer.inline_body
+    end_time = time.perf_counter()
+    return {
+        "s3_path": f"s3://{destination['bucket_name']}/{destination['key_name']}",
+        "bucket_name": destination["bucket_name"],
+        "key_name": destination["key_name"],
+        "size": writer.size,
+        "etag": writer.etag,
+        "format": result["format"],
+        "row_count": result["row_count"],
+        "timings": {
+            "obfuscate_seconds": obfuscated_time - start_time,
+            "upload_complete_seconds": end_time - obfuscated_time,
+            "total_seconds": end_time - start_time,
+        },
+    }
 
 
-def init_s3_client():
+def obfuscate_s3_file(
+    client, bucket_name, file_name, pii_fields, output, options, recorder=None
+):
     """
-    Initialises an s3 client using boto3.
+    This function will obfuscate an s3 file, writing the obfuscated file to the output.
+    Parameters:
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, file_name
+            Strings naming the object's bucket and key.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated file is written to.
+        - options
+            A dictionary of the optional event fields described in lambda_handler,
+            e.g. the event itself.
+        - recorder
+            Optionally a StageRecorder to record each stage in.
+    Returns:
+        - A dictionary containing the fields:
+            - format
+                the format of the input as identified by this function
+            - row_count
+                the number of rows written to the output
+            - compression
+                the compression of the input, or None
+    """
+    if recorder is None:
+        recorder = DISABLED_RECORDER
+    if options.get("streaming", False):
+        with recorder.stage("stream") as stage:
+            output_start = output.tell()
+            result = stream_obfuscate_file(
+                client=client,
+                bucket_name=bucket_name,
+                file_name=file_name,
+                pii_fields=pii_fields,
+                output=output,
+                chunk_rows=options.get("chunk_rows", CSV_STREAM_CHUNK_ROWS),
+                parquet_passthrough=options.get("parquet_passthrough", False),
+                engine=options.get("engine", "pandas"),
+                output_compression=options.get("output_compression", "same"),
+                compression_level=options.get("compression_level"),
+                pseudonymiser=pseudonymiser_from_options(options),
+                typed_mask=options.get("typed_mask"),
+            )
+            stage.record(bytes_out=output.tell() - output_start)
+        return result
+    with recorder.stage("download") as stage:
+        file_dict = download_file_in_ranges(
+            bucket_name=bucket_name,
+            file_name=file_name,
+            client=client,
+            part_size=options.get("download_part_size", S3_DOWNLOAD_PART_SIZE),
+            max_concurrency=options.get(
+                "download_concurrency", S3_DOWNLOAD_CONCURRENCY
+            ),
+        )
+        # popped so the compressed body is freed once it's decompressed
+        file = file_dict.pop("body")
+        stage.record(bytes_in=len(file))
+    compression = detect_compression(
+        file[:FORMAT_SNIFF_BYTES], file_dict["content_encoding"]
+    )
+    if compression is not None:
+        with recorder.stage("decompress") as stage:
+            compressed_size = len(file)
+            file = decompress_bytes(file, compression)
+            stage.record(bytes_in=compressed_size, bytes_out=len(file))
+    with compressed_output(
+        output,
+        resolve_output_compression(
+            options.get("output_compression", "same"), compression
+        ),
+        options.get("compression_level"),
+    ) as output:
+        result = obfuscate_file_bytes(
+            file=file,
+            file_name=strip_compression_extension(file_name),
+            content_type=file_dict["content_type"],
+            pii_fields=pii_fields,
+            output=output,
+            options=options,
+            recorder=recorder,
+            release_input=True,
+        )
+    result["compression"] = compression
+    return result
 
-            Parameters:
-                    No inputs are taken for this function.
 
-            Returns:
-                    An instance of s3 client.
+def obfuscate_file_bytes(
+    file,
+    file_name,
+    content_type,
+    pii_fields,
+    output,
+    options,
+    recorder=None,
+    release_input=False,
+):
+    """
+    This function will obfuscate the bytes of a whole file,
+    writing the obfuscated file to the output.
+    Parameters:
+        - file
+            The bytes of the file, any object supporting the buffer protocol.
+        - file_name
+            The s3 key of the file, its extension is used as a format hint.
+        - content_type
+            The ContentType of the s3 object or None, used as a format hint.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated file is written to.
+        - options
+            A dictionary of the optional event fields described in lambda_handler.
+        - recorder
+            Optionally a StageRecorder to record each stage in.
+        - release_input
+            True when the caller hands over a bytearray file it doesn't need back,
+            it's emptied as soon as it's parsed into a dataframe or Table.
+    Returns:
+        - A dictionary containing the fields:
+            - format
+                the format of the input as identified by this function
+            - row_count
+                the number of rows written to the output
+    """
+    if recorder is None:
+        recorder = DISABLED_RECORDER
+    pseudonymiser = pseudonymiser_from_options(options)
+    typed_mask = options.get("typed_mask")
+    _check_typed_mask(typed_mask)
+    with recorder.stage("detect_format"):
+        found_format = detect_format(
+            head=file[:FORMAT_SNIFF_BYTES],
+            tail=file[-len(PARQUET_MAGIC) :],
+            key_name=file_name,
+            content_type=content_type,
+        )
+    if found_format == "parquet" and options.get("parquet_passthrough", False):
+        if pseudonymiser is not None:
+            raise ValueError("parquet_passthrough can't be used to pseudonymise")
+        with recorder.stage("parquet_passthrough") as stage:
+            output_start = output.tell()
+            with MemoryviewReader(file) as source:
+                row_count = rewrite_parquet_passthrough(source, pii_fields, output)
+            stage.record(bytes_in=len(file), bytes_out=output.tell() - output_start)
+        return {"format": found_format, "row_count": row_count}
+    if found_format in ("csv", "ndjson") and options.get("workers", 1) > 1:
+        parallel_obfuscate = {
+            "csv": parallel_obfuscate_csv,
+            "ndjson": parallel_obfuscate_ndjson,
+        }[found_format]
+        with recorder.stage(parallel_obfuscate.__name__) as stage:
+            output_start = output.tell()
+            row_count = parallel_obfuscate(
+                file,
+                pii_fields,
+                output,
+                max_workers=options["workers"],
+                pseudonymiser=pseudonymiser,
+            )
+            stage.record(bytes_in=len(file), bytes_out=output.tell() - output_start)
+        return {"format": found_format, "row_count": row_count}
+    engine = options.get("engine", "pandas")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine}, must be one of {ENGINES}")
+    if engine == "exact" and found_format == "csv":
+        with recorder.stage("exact_obfuscate_csv") as stage:
+            output_start = output.tell()
+            row_count = exact_obfuscate_csv(
+                file, pii_fields, output, pseudonymiser=pseudonymiser
+            )
+            stage.record(bytes_in=len(file), bytes_out=output.tell() - output_start)
+        return {"format": found_format, "row_count": row_count}
+    if found_format == "json" and engine != "arrow":
+        with recorder.stage("stream_obfuscate_json") as stage:
+            output_start = output.tell()
+            row_count = stream_obfuscate_json(
+                file, pii_fields, output, pseudonymiser=pseudonymiser
+            )
+            stage.record(bytes_in=len(file), bytes_out=output.tell() - output_start)
+        return {"format": found_format, "row_count": row_count}
+    if found_format == "ndjson" and engine != "arrow":
+        with recorder.stage("stream_obfuscate_ndjson") as stage:
+            output_start = output.tell()
+            row_count = stream_obfuscate_ndjson(
+                file, pii_fields, output, pseudonymiser=pseudonymiser
+            )
+            stage.record(bytes_in=len(file), bytes_out=output.tell() - output_start)
+        return {"format": found_format, "row_count": row_count}
+    if found_format != "parquet":
+        # text formats show *** whatever the type of the column
+        typed_mask = None
+    if engine == "arrow":
+        with recorder.stage("convert_bytestream_to_table") as stage:
+            table_dict = convert_bytestream_to_table(file, pii_fields, found_format)
+            stage.record(bytes_in=len(file))
+        if release_input:
+            _release_buffer(file)
+        # popped so the unmasked pii columns are freed once they're replaced
+        with recorder.stage("produce_obfuscated_table"):
+            new_table = produce_obfuscated_table(
+                table_dict.pop("table"), pii_fields, pseudonymiser, typed_mask
+            )
+        with recorder.stage("write_table_to_formatted_output") as stage:
+            output_start = output.tell()
+            write_table_to_formatted_output(
+                new_table, found_format, output, json_orient=table_dict["json_orient"]
+            )
+            stage.record(bytes_out=output.tell() - output_start)
+        return {"format": found_format, "row_count": new_table.num_rows}
+    with recorder.stage("convert_bytestream_to_df") as stage:
+        df_dict = convert_bytestream_to_df(file, pii_fields, file_format=found_format)
+        stage.record(bytes_in=len(file))
+    if release_input:
+        _release_buffer(file)
+    with recorder.stage("produce_obfuscated_data"):
+        new_df = produce_obfuscated_data(
+            df_dict.pop("df"), pii_fields, pseudonymiser, typed_mask
+        )
+    with recorder.stage("write_df_to_formatted_output") as stage:
+        output_start = output.tell()
+        write_df_to_formatted_output(new_df, df_dict["format"], output)
+        stage.record(bytes_out=output.tell() - output_start)
+    return {"format": df_dict["format"], "row_count": len(new_df)}
+
+
+def run_with_bounded_concurrency(function, items, max_concurrency):
+    """
+    Calls function on each of the items on a pool of max_concurrency threads,
+    yielding the results as they complete.
+    Parameters:
+        - function
+            Called with one item at a time.
+        - items
+            Any iterable, it's consumed as results come back with at most
+            2 * max_concurrency items taken ahead of the results,
+            so it can be a generator of any length.
+        - max_concurrency
+            The number of threads calling function at once.
+    Returns:
+        - A generator of the results of function in the order they complete.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = set()
+        for item in items:
+            if len(pending) >= 2 * max_concurrency:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(function, item))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def obfuscate_batch_item(item, options):
+    """
+    This function will obfuscate one item of a batch event to its output_s3_path,
+    reporting the failure instead of raising it.
+    Parameters:
+        - item
+            A dictionary with the s3_path, output_s3_path and optionally the
+            obfuscate_fields and any other optional event field for this item.
+        - options
+            A dictionary of the optional event fields shared by every item,
+            which the item's own fields override.
+    Returns:
+        - A dictionary with the s3_path and output_s3_path of the item and a
+        status of "succeeded", with the format, row_count, size and etag
+        of the output, or "failed" with the error_type and error message.
     """
+    report = {
+        "s3_path": item.get("s3_path"),
+        "output_s3_path": item.get("output_s3_path"),
+    }
     try:
-        session = botocore.session.get_session()
-        s3_client = session.create_client("s3")
-        return s3_client
-    except Exception as e:
-        raise e
+        item_options = {**options, **item, "output_mode": "s3"}
+        if item_options.get("output_s3_path") is None:
+            raise ValueError("Every batch item needs an output_s3_path")
+        path_elements = get_bucket_and_key_strings(item_options["s3_path"])
+        result = obfuscate_s3_file_to_s3(
+            client=get_s3_client_for_bucket(
+                path_elements["bucket_name"], profile=item_options.get("profile")
+            ),
+            bucket_name=path_elements["bucket_name"],
+            file_name=path_elements["key_name"],
+            pii_fields=item_options["obfuscate_fields"],
+            output_s3_path=item_options["output_s3_path"],
+            options=item_options,
+        )
+    except Exception as error:
+        report["status"] = "failed"
+        report["error_type"] = type(error).__name__
+        report["error"] = str(error)
+        return report
+    report["status"] = "succeeded"
+    for key in ("format", "row_count", "size", "etag"):
+        report[key] = result[key]
+    return report
 
 
-def get_file_from_bucket(bucket_name, file_name, client):
+def obfuscate_batch(event):
     """
-    Gets specified file from bucket.
+    This function will obfuscate every item of a batch event to s3, running
+    batch_concurrency items at once over the cached s3 clients so downloads,
+    obfuscation and uploads of different items overlap.
+    Parameters:
+        - event
+            A dictionary with a list of "items", each a dictionary with the
+            s3_path, output_s3_path and optionally the obfuscate_fields of one file.
+            Every other field of the event, including obfuscate_fields,
+            is used for each item that doesn't set it itself.
+    Returns:
+        - A dictionary with the number of items that "succeeded" and "failed",
+        and "items", the report of each item in the order they were given,
+        as returned by obfuscate_batch_item.
+    """
+    items = event["items"]
+    options = {key: value for key, value in event.items() if key != "items"}
+    reports = [None] * len(items)
 
-            Parameters:
-                    Requires a boto3 s3 client connection.
-                    Requires a string naming the object's bucket
-                    Requires a string naming the object's key 
+    def process(indexed_item):
+        index, item = indexed_item
+        return index, obfuscate_batch_item(item, options)
 
-            Returns:
-                    The target file.
+    for index, report in run_with_bounded_concurrency(
+        process,
+        enumerate(items),
+        max_concurrency=event.get("batch_concurrency", BATCH_CONCURRENCY),
+    ):
+        reports[index] = report
+    succeeded = sum(report["status"] == "succeeded" for report in reports)
+    return {"succeeded": succeeded, "failed": len(items) - succeeded, "items": reports}
+
+
+def list_s3_objects(client, bucket_name, prefix, page_size=S3_LIST_PAGE_SIZE):
     """
-    response = client.get_object(Bucket=bucket_name, Key=file_name)
-    body = response["Body"].read()
-    return body
+    Lists every object under a prefix with the ListObjectsV2 paginator.
+    Parameters:
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, prefix
+            Strings naming the bucket and the prefix of the keys to list.
+        - page_size
+            The number of keys requested in each page.
+    Returns:
+        - A generator of the object dictionaries of each page, with the Key and Size
+        of each object. Pages are only requested as the generator is consumed.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    pages = paginator.paginate(
+        Bucket=bucket_name,
+        Prefix=prefix,
+        PaginationConfig={"PageSize": page_size},
+    )
+    for page in pages:
+        yield from page.get("Contents", [])
 
 
-def get_bucket_and_key_strings(file_path):
+def obfuscate_prefix(event):
     """
-    From an s3 path in the format "s3://bucket/key" this function will
-    extract the path information (bucket and key)
+    This function will obfuscate every object under the s3_path prefix of the event,
+    writing each to the same key under the output_s3_path prefix.
+    Keys are listed page by page as the batch_concurrency workers take them,
+    so the first objects are obfuscated while the rest of the prefix is still
+    being listed, and only the failed items are kept in memory.
+    Folder markers, empty objects, objects under the output prefix and objects
+    whose format can't be obfuscated are skipped.
     Parameters:
-        - takes the file path in format "s3://bucket/key"
+        - event
+            A dictionary with the s3_path "s3://bucket/prefix/" of the objects
+            and the output_s3_path "s3://bucket/output_prefix/" to write them under,
+            every other field is used for each object as in obfuscate_batch.
+    Returns:
+        - A dictionary with the number of objects that "succeeded", "failed" and
+        were "skipped", and "failures", the reports of the first
+        PREFIX_FAILURE_REPORT_LIMIT failed objects as returned by
+        obfuscate_batch_item.
+    """
+    output_s3_path = event.get("output_s3_path", "")
+    if not output_s3_path.endswith("/"):
+        raise ValueError(
+            "An output_s3_path ending in / is needed to obfuscate a whole prefix"
+        )
+    source = get_bucket_and_key_strings(event["s3_path"])
+    destination = get_bucket_and_key_strings(output_s3_path)
+    options = {
+        key: value
+        for key, value in event.items()
+        if key not in ("s3_path", "output_s3_path")
+    }
+    client = get_s3_client_for_bucket(
+        source["bucket_name"], profile=event.get("profile")
+    )
+    counts = {"succeeded": 0, "failed": 0, "skipped": 0}
+    failures = []
+
+    def items():
+        for listed in list_s3_objects(
+            client, source["bucket_name"], source["key_name"]
+        ):
+            key = listed["Key"]
+            if (
+                key.endswith("/")
+                or listed["Size"] == 0
+                or (
+                    source["bucket_name"] == destination["bucket_name"]
+                    and key.startswith(destination["key_name"])
+                )
+            ):
+                counts["skipped"] += 1
+                continue
+            relative_key = key[len(source["key_name"]) :]
+            yield {
+                "s3_path": f"s3://{source['bucket_name']}/{key}",
+                "output_s3_path": f"s3://{destination['bucket_name']}/"
+                f"{destination['key_name']}{relative_key}",
+            }
+
+    for report in run_with_bounded_concurrency(
+        lambda item: obfuscate_batch_item(item, options),
+        items(),
+        max_concurrency=event.get("batch_concurrency", BATCH_CONCURRENCY),
+    ):
+        if report.get("error_type") == UnsupportedFormatError.__name__:
+            counts["skipped"] += 1
+            continue
+        counts[report["status"]] += 1
+        if report["status"] == "failed" and len(failures) < PREFIX_FAILURE_REPORT_LIMIT:
+            failures.append(report)
+    return {**counts, "failures": failures}
 
+
+def _scan_record_boundary(data, inside_quotes):
+    """
+    Scans csv bytes for the end of the current record, the first newline outside
+    quotes, starting inside or outside a quoted field.
+    Parameters:
+        - data
+            The csv bytes to scan.
+        - inside_quotes
+            True when data starts inside a quoted field.
     Returns:
-        - a dictionary in format:
-        {
-            "bucket_name":bucket,
-            "key_name":key
-        }
+        - A tuple of the offset just after the newline, or None when data ends
+        first, and whether the end of data is inside a quoted field.
     """
-    path_elements = file_path.split("/")
-    bucket_name = path_elements[2]
-    key_name = ""
-    first_key_ele_toggle = False
-    for ele in path_elements[3:]:
-        if first_key_ele_toggle == True:
-            key_name += "/"
-        key_name += ele
-        first_key_ele_toggle = True
-    return {"bucket_name": bucket_name, "key_name": key_name}
+    position = 0
+    while True:
+        if inside_quotes:
+            quote = data.find(b'"', position)
+            if quote == -1:
+                return None, True
+            position = quote + 1
+            inside_quotes = False
+        else:
+            newline = data.find(b"\n", position)
+            end = len(data) if newline == -1 else newline
+            quote = data.find(b'"', position, end)
+            if quote == -1:
+                return (None if newline == -1 else newline + 1), False
+            position = quote + 1
+            inside_quotes = True
 
 
-def produce_obfuscated_data(df, pii_fields):
+def _records_match_header(data, field_count, check_records=FAN_OUT_CHECK_RECORDS):
     """
-    This function will replace specified fields of a dataframe with
-    obfuscated strings "***"
+    Returns True when the first complete records of data all have field_count fields,
+    False when one doesn't or there are fewer than 2 complete records to check.
+    """
+    try:
+        text = data[: data.rfind(b"\n") + 1].decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    records = list(
+        itertools.islice(csv.reader(StringIO(text, newline="")), check_records + 1)
+    )
+    # the last record read may be cut off by the end of data
+    checked = records[:check_records] if len(records) > check_records else records[:-1]
+    return len(checked) >= 2 and all(len(record) == field_count for record in checked)
+
+
+def find_record_boundary(
+    client,
+    bucket_name,
+    file_name,
+    offset,
+    field_count,
+    previous_boundary,
+    window_size=FAN_OUT_WINDOW_BYTES,
+):
+    """
+    Finds the start of the first csv record at or after offset without reading
+    the file from the start.
+    A window of bytes from offset is scanned twice, once as if it started outside
+    quotes and once as if it were inside a quoted field, and the records after each
+    candidate boundary are parsed. When only one candidate is followed by records
+    with the header's field count it is the boundary. Otherwise the quotes from
+    previous_boundary to offset are counted to know for sure whether offset is
+    inside a quoted field, and the file is scanned on from offset.
     Parameters:
-        - A dataframe containing the dataset to be obfuscated.
-        - A list of fields containing the data to be obfuscated.
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, file_name
+            Strings naming the csv object's bucket and key.
+        - offset
+            The byte offset to search from.
+        - field_count
+            The number of fields in the header.
+        - previous_boundary
+            The offset of a known record boundary before offset, e.g. the end
+            of the header.
+        - window_size
+            The number of bytes read from offset for the first scan.
     Returns:
-        - A new dataframe with the required obfuscation completed.
-    
+        - The offset of the first record boundary at or after offset,
+        or the size of the file if there isn't one.
     """
-    new_df = df.copy()
-    new_df[pii_fields] = "***"
-    return new_df
+    if offset <= previous_boundary:
+        return previous_boundary
+    # scanning from the byte before offset finds offset itself when it's a boundary
+    start = offset - 1
+    window = client.get_object(
+        Bucket=bucket_name,
+        Key=file_name,
+        Range=f"bytes={start}-{start + window_size - 1}",
+    )["Body"].read()
+    candidates = []
+    for inside_quotes in (False, True):
+        boundary, _ = _scan_record_boundary(window, inside_quotes)
+        if boundary is not None and _records_match_header(
+            window[boundary:], field_count
+        ):
+            candidates.append(boundary)
+    if len(candidates) == 1:
+        return start + candidates[0]
+    quote_count = 0
+    if start > previous_boundary:
+        preceding = client.get_object(
+            Bucket=bucket_name,
+            Key=file_name,
+            Range=f"bytes={previous_boundary}-{start - 1}",
+        )["Body"]
+        for chunk in preceding.iter_chunks(S3_DOWNLOAD_READ_SIZE):
+            quote_count += chunk.count(b'"')
+    inside_quotes = quote_count % 2 == 1
+    following = client.get_object(
+        Bucket=bucket_name, Key=file_name, Range=f"bytes={start}-"
+    )
+    position = start
+    for chunk in following["Body"].iter_chunks(S3_DOWNLOAD_READ_SIZE):
+        boundary, inside_quotes = _scan_record_boundary(chunk, inside_quotes)
+        if boundary is not None:
+            following["Body"].close()
+            return position + boundary
+        position += len(chunk)
+    return position
 
 
-def convert_bytestream_to_df(formatted_bytes, fields):
+def read_csv_header(client, bucket_name, file_name, window_size=FAN_OUT_WINDOW_BYTES):
     """
-    This function will identify the format convention of a bytestream representing a dataset. 
-    The function will then convert this bytestream into a pandas dataframe.
-    It will work if the format is valid csv, json or parquet.
+    Reads the header record of a csv object.
+    Parameters:
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, file_name
+            Strings naming the csv object's bucket and key.
+        - window_size
+            The number of bytes requested at a time.
+    Returns:
+        - The bytes of the header record, including its newline.
+    """
+    response = client.get_object(Bucket=bucket_name, Key=file_name)
+    header = b""
+    inside_quotes = False
+    for chunk in response["Body"].iter_chunks(window_size):
+        if not header and detect_compression(chunk, response.get("ContentEncoding")):
+            response["Body"].close()
+            raise UnsupportedFormatError(
+                "Compressed csv can't be split into byte ranges for fan_out"
+            )
+        boundary, inside_quotes = _scan_record_boundary(chunk, inside_quotes)
+        if boundary is not None:
+            response["Body"].close()
+            return header + chunk[:boundary]
+        header += chunk
+    return header
 
+
+def plan_csv_ranges(
+    client, bucket_name, file_name, size, header_end, field_count, range_size
+):
+    """
+    Splits a csv object into byte ranges of about range_size bytes that each
+    start and end on a record boundary.
     Parameters:
-        - formatted_bytes
-            A bytestream formatted with csv, json, or parquet.
-        - fields
-            The list of fields to obfuscate. Used as a tool to validate the format of the string
-    Return:
-        - A dictionary containing the fields:
-            - df
-                the data frame converted from the input
-            - format
-                the format of the input as identified by this function
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, file_name
+            Strings naming the csv object's bucket and key.
+        - size
+            The size of the object in bytes.
+        - header_end
+            The offset just after the header record.
+        - field_count
+            The number of fields in the header.
+        - range_size
+            The number of bytes wanted in each range.
+    Returns:
+        - A list of (start, end) tuples covering every record after the header,
+        end being exclusive.
+    """
+    range_size = max(range_size, -(-(size - header_end) // S3_MAX_PARTS))
+    boundaries = [header_end]
+    for split_point in range(header_end + range_size, size, range_size):
+        if split_point <= boundaries[-1]:
+            continue
+        boundary = find_record_boundary(
+            client,
+            bucket_name,
+            file_name,
+            split_point,
+            field_count,
+            previous_boundary=boundaries[-1],
+        )
+        if boundary < size:
+            boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def obfuscate_csv_range(task):
+    """
+    This function is the fan out worker, it obfuscates one byte range of a csv object
+    and uploads it as one part of the output's multipart upload.
+    Parameters:
+        - task
+            A dictionary with the s3_path, obfuscate_fields, the "header" of the csv
+            as a string, the "range" [start, end) of bytes to obfuscate, whether to
+            "write_header", and the output_s3_path, "upload_id", "part_number"
+            and whether it's the "last_part" of the part to upload.
+            Optionally "profile", "chunk_rows", "mode" and "token_length".
+            Every part but the last must be at least S3_MIN_PART_SIZE bytes
+            after obfuscation, a smaller one raises ValueError before it's uploaded.
+    Returns:
+        - A dictionary with the PartNumber and ETag of the uploaded part,
+        its size and the row_count of the range.
+    """
+    source = get_bucket_and_key_strings(task["s3_path"])
+    destination = get_bucket_and_key_strings(task["output_s3_path"])
+    start, end = task["range"]
+    client = get_s3_client_for_bucket(
+        source["bucket_name"], profile=task.get("profile")
+    )
+    records = b""
+    if end > start:
+        records = client.get_object(
+            Bucket=source["bucket_name"],
+            Key=source["key_name"],
+            Range=f"bytes={start}-{end - 1}",
+        )["Body"].read()
+    output = BytesIO()
+    row_count = stream_obfuscate_csv(
+        BytesIO(task["header"].encode("utf-8") + records),
+        task["obfuscate_fields"],
+        output,
+        chunk_rows=task.get("chunk_rows", CSV_STREAM_CHUNK_ROWS),
+        write_header=task["write_header"],
+        pseudonymiser=pseudonymiser_from_options(task),
+    )
+    body = output.getvalue()
+    if not task["last_part"] and len(body) < S3_MIN_PART_SIZE:
+        raise ValueError(
+            f"Part {task['part_number']} of the fan out output is {len(body)} bytes"
+            f" after obfuscation, under the {S3_MIN_PART_SIZE} bytes every part"
+            " but the last must have, use a larger fan_out_range_size"
+        )
+    part = get_s3_client_for_bucket(
+        destination["bucket_name"], profile=task.get("profile")
+    ).upload_part(
+        Bucket=destination["bucket_name"],
+        Key=destination["key_name"],
+        UploadId=task["upload_id"],
+        PartNumber=task["part_number"],
+        Body=body,
+    )
+    return {
+        "PartNumber": task["part_number"],
+        "ETag": part["ETag"],
+        "size": len(body),
+        "row_count": row_count,
+    }
+
+
+def invoke_workers_locally(tasks, max_concurrency):
+    """
+    Runs each fan out task in this process through lambda_handler,
+    standing in for lambda invocations.
+    Returns:
+        - A list of the results of each task, in the order of tasks.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(
+            executor.map(
+                lambda task: lambda_handler({"fan_out_worker": task}, None), tasks
+            )
+        )
+
+
+def invoke_workers_with_lambda(tasks, max_concurrency, function_name, profile=None):
+    """
+    Invokes function_name once for each fan out task and waits for every result.
+    Returns:
+        - A list of the results of each task, in the order of tasks.
+    """
+    session = botocore.session.Session(profile=profile)
+    lambda_client = session.create_client(
+        "lambda",
+        config=botocore.config.Config(
+            read_timeout=LAMBDA_INVOKE_READ_TIMEOUT,
+            max_pool_connections=max_concurrency,
+            retries={"max_attempts": 0},
+        ),
+    )
+
+    def invoke(task):
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps({"fan_out_worker": task}),
+        )
+        payload = json.loads(response["Payload"].read())
+        if "FunctionError" in response:
+            raise RuntimeError(
+                f"Fan out worker for part {task['part_number']} failed: {payload}"
+            )
+        return payload
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(invoke, tasks))
+
+
+def fan_out_obfuscate_csv(event):
+    """
+    This function is the fan out coordinator, it obfuscates a csv object too large
+    for one invocation by splitting it into record aligned byte ranges, each
+    obfuscated by a worker that uploads its output as one part of a shared
+    multipart upload, so the output is assembled by s3 without another copy.
+    The header record is sent to every worker, only the first writes it.
+    The multipart upload is aborted if any worker fails.
+    Parameters:
+        - event
+            A dictionary with the s3_path of the csv object, its output_s3_path
+            and obfuscate_fields. Optionally:
+                - "fan_out_range_size" : the number of bytes given to each worker.
+                - "fan_out_concurrency" : how many workers run at once.
+                - "fan_out_executor" : "lambda" to invoke a lambda function for each
+                    worker, or "local" to run them in this process. Defaults to "lambda"
+                    when running in aws lambda.
+                - "fan_out_function_name" : the function invoked for each worker,
+                    by default the function running the coordinator.
+    Returns:
+        - A dictionary describing the uploaded object with its s3_path, bucket_name,
+        key_name, size, etag, format, row_count and the number of workers.
     """
-    df_dict = dict()
+    source = get_bucket_and_key_strings(event["s3_path"])
+    destination = get_bucket_and_key_strings(event["output_s3_path"])
+    profile = event.get("profile")
+    range_size = event.get("fan_out_range_size", FAN_OUT_RANGE_SIZE)
+    if range_size < S3_MIN_PART_SIZE:
+        raise ValueError(
+            f"fan_out_range_size must be at least {S3_MIN_PART_SIZE} bytes,"
+            " the minimum size of every part of a multipart upload but the last"
+        )
+    executor = event.get(
+        "fan_out_executor",
+        "lambda" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else "local",
+    )
+    if executor not in FAN_OUT_EXECUTORS:
+        raise ValueError(
+            f"Unknown fan_out_executor {executor}, must be one of {FAN_OUT_EXECUTORS}"
+        )
+    pseudonymiser_from_options(event)
+    client = get_s3_client_for_bucket(source["bucket_name"], profile=profile)
+    size = client.head_object(Bucket=source["bucket_name"], Key=source["key_name"])[
+        "ContentLength"
+    ]
+    header = read_csv_header(client, source["bucket_name"], source["key_name"])
+    try:
+        header_text = header.decode("utf-8")
+    except UnicodeDecodeError:
+        raise UnsupportedFormatError(
+            "Failed to interpret bytes as csv, header is not utf-8"
+        )
+    field_count = len(next(csv.reader(StringIO(header_text, newline="")), []))
+    ranges = plan_csv_ranges(
+        client,
+        source["bucket_name"],
+        source["key_name"],
+        size,
+        len(header),
+        field_count,
+        range_size,
+    )
+    output_client = get_s3_client_for_bucket(
+        destination["bucket_name"], profile=profile
+    )
+    upload_id = output_client.create_multipart_upload(
+        Bucket=destination["bucket_name"], Key=destination["key_name"]
+    )["UploadId"]
+    tasks = [
+        {
+            "s3_path": event["s3_path"],
+            "obfuscate_fields": event["obfuscate_fields"],
+            "header": header_text,
+            "range": [start, end],
+            "write_header": part_number == 1,
+            "output_s3_path": event["output_s3_path"],
+            "upload_id": upload_id,
+            "part_number": part_number,
+            "last_part": part_number == len(ranges),
+            "profile": profile,
+            "chunk_rows": event.get("chunk_rows", CSV_STREAM_CHUNK_ROWS),
+            "mode": event.get("mode", "mask"),
+            "token_length": event.get("token_length", PSEUDONYM_LENGTH),
+        }
+        for part_number, (start, end) in enumerate(ranges, start=1)
+    ]
+    max_concurrency = event.get("fan_out_concurrency", FAN_OUT_CONCURRENCY)
     try:
-        bytesio = BytesIO(formatted_bytes)
-        df = pd.read_parquet(bytesio)
-        if set(fields).issubset(set(df.columns.values.tolist())):
-            df_dict["format"] = "parquet"
+        if executor == "lambda":
+            parts = invoke_workers_with_lambda(
+                tasks,
+                max_concurrency,
+                event.get(
+                    "fan_out_function_name", os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+                ),
+                profile=profile,
+            )
         else:
-            raise TypeError("Failed to interpret bytes as parquet")
-    except Exception as e:
-        formatted_string = formatted_bytes.decode("utf-8")
-        stringio = StringIO(formatted_string)
-        try:
-            df = pd.read_csv(stringio, sep=",", header=0)
-            if set(fields).issubset(set(df.columns.values.tolist())):
-                df_dict["format"] = "csv"
-            else:
-                df = pd.DataFrame.from_dict(json.loads(formatted_string))
-                if set(fields).issubset(set(df.columns.values.tolist())):
-                    df_dict["format"] = "json"
-                else:
-                    raise TypeError(
-                        "Failed to interpret string as json or csv"
-                    )  ## raise error, format probably wrong
-        except TypeError as e:
-            raise e
-        except Exception as e:
-            raise e
-    df_dict["df"] = df
-    print("read the df:\n",df)
-    return df_dict
+            parts = invoke_workers_locally(tasks, max_concurrency)
+        response = output_client.complete_multipart_upload(
+            Bucket=destination["bucket_name"],
+            Key=destination["key_name"],
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+                    for part in parts
+                ]
+            },
+        )
+    except BaseException:
+        output_client.abort_multipart_upload(
+            Bucket=destination["bucket_name"],
+            Key=destination["key_name"],
+            UploadId=upload_id,
+        )
+        raise
+    return {
+        "s3_path": event["output_s3_path"],
+        "bucket_name": destination["bucket_name"],
+        "key_name": destination["key_name"],
+        "size": sum(part["size"] for part in parts),
+        "etag": response["ETag"],
+        "format": "csv",
+        "row_count": sum(part["row_count"] for part in parts),
+        "workers": len(parts),
+    }
 
 
-def convert_df_to_formatted_bytestream(df, format):
+class _DisabledStage:
+    """
+    The stage handed out by a disabled StageRecorder, it records nothing.
     """
-    This function will convert a dataframe to a bytestream of a desired format.
 
-    Parameters:
-        - df
-            A dataframe of the dataset to convert into a formatted string.
-        - format
-            The desired format.
-            Must be "csv", "json" or "parquet"
+    __slots__ = ()
 
-    Returns:
-        - A formatted bytestream convertion of the dataframe.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+    def record(self, bytes_in=None, bytes_out=None):
+        pass
+
+
+_DISABLED_STAGE = _DisabledStage()
+
+
+class _Stage:
     """
-    if format == "csv":
-        try:
-            csv_string = df.to_csv(index=False)
-            csv_bytestream = csv_string.encode("utf-8")
-            return csv_bytestream
-        except Exception as e:
-            raise e
-    elif format == "json":
-        try:
-            json_string = json.dumps(df.to_dict())
-            json_bytestream = json_string.encode("utf-8")
-            return json_bytestream
-        except Exception as e:
-            raise e
-    elif format == "parquet":
-        try:
-            return df.to_parquet()
-        except Exception as e:
-            raise e
+    A context manager measuring one stage of an invocation for a StageRecorder.
+    """
+
+    __slots__ = (
+        "recorder",
+        "name",
+        "bytes_in",
+        "bytes_out",
+        "wall_start",
+        "cpu_start",
+    )
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.bytes_in = None
+        self.bytes_out = None
+
+    def __enter__(self):
+        if self.recorder.trace_memory:
+            tracemalloc.reset_peak()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def record(self, bytes_in=None, bytes_out=None):
+        if bytes_in is not None:
+            self.bytes_in = bytes_in
+        if bytes_out is not None:
+            self.bytes_out = bytes_out
+
+    def __exit__(self, exception_type, exception, traceback):
+        wall_seconds = time.perf_counter() - self.wall_start
+        cpu_seconds = time.process_time() - self.cpu_start
+        stage = {
+            "stage": self.name,
+            "wall_ms": wall_seconds * 1000,
+            "cpu_ms": cpu_seconds * 1000,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        if self.recorder.trace_memory:
+            stage["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        if exception_type is not None:
+            stage["error"] = exception_type.__name__
+        self.recorder.stages.append(stage)
+        return False
+
+
+class StageRecorder:
+    """
+    Records wall time, cpu time, bytes in and out and peak memory
+    for each stage of an invocation.
+    max_rss_mb is the peak resident memory of the process when the stage ended,
+    with trace_memory the peak of python allocations during the stage is
+    also recorded with tracemalloc, which slows everything down noticeably.
+    A disabled recorder hands out a shared stage that does nothing,
+    so instrumented code costs a method call when metrics are off.
+    """
+
+    def __init__(self, enabled=True, trace_memory=False):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages = []
+        self._started_tracemalloc = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stage(self, name):
+        """
+        Returns a context manager measuring the stage called name.
+        Bytes processed can be added with .record(bytes_in=..., bytes_out=...).
+        """
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return _Stage(self, name)
+
+    def to_emf(self, namespace=METRICS_NAMESPACE):
+        """
+        Returns the recorded stages as CloudWatch Embedded Metric Format documents,
+        one per stage with the stage name as a dimension.
+        """
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for stage in self.stages:
+            document = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": namespace,
+                            "Dimensions": [["Stage"]],
+                            "Metrics": [],
+                        }
+                    ],
+                },
+                "Stage": stage["stage"],
+            }
+            metrics = document["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+            for key, unit in EMF_METRIC_UNITS.items():
+                if stage.get(key) is not None:
+                    metrics.append({"Name": key, "Unit": unit})
+                    document[key] = stage[key]
+            documents.append(document)
+        return documents
+
+    def finish(self):
+        """
+        Prints each recorded stage as an Embedded Metric Format json line,
+        which CloudWatch turns into metrics, and stops tracemalloc if it was
+        started by this recorder.
+        """
+        if not self.enabled:
+            return
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        for document in self.to_emf():
+            print(json.dumps(document))
+
+
+DISABLED_RECORDER = StageRecorder(enabled=False)
+
+
+def metrics_enabled_by_environment():
+    """
+    Returns True when the OBFUSCATOR_METRICS environment variable turns on
+    metrics for every invocation.
+    """
+    return os.environ.get(METRICS_ENVIRONMENT_VARIABLE, "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+
+def init_s3_client(region_name=None, profile=None, config=None):
+    """
+    Initialises an s3 client using boto3.
+
+            Parameters:
+                    Optionally the region to create the client in,
+                    the aws config profile to use
+                    and a botocore Config for the client.
+                    The session defaults are used for anything not given.
+
+            Returns:
+                    An instance of s3 client.
+    """
+    try:
+        if profile is None:
+            session = botocore.session.get_session()
+        else:
+            session = botocore.session.Session(profile=profile)
+        client_kwargs = {}
+        if region_name is not None:
+            client_kwargs["region_name"] = region_name
+        if config is not None:
+            client_kwargs["config"] = config
+        s3_client = session.create_client("s3", **client_kwargs)
+        return s3_client
+    except Exception as e:
+        raise e
+
+
+def get_s3_client(region_name=None, profile=None):
+    """
+    Gets an s3 client from the module level registry, creating it on first use.
+    Clients are kept for the lifetime of the lambda container, so warm invocations
+    reuse the loaded service model, resolved endpoint, credentials
+    and the connection pool configured by S3_POOL_SETTINGS.
+
+            Parameters:
+                    Optionally the region and aws config profile of the client.
+
+            Returns:
+                    An instance of s3 client.
+    """
+    registry_key = (region_name, profile)
+    with _s3_clients_lock:
+        s3_client = _s3_clients.get(registry_key)
+        if s3_client is None:
+            s3_client = init_s3_client(
+                region_name=region_name,
+                profile=profile,
+                config=botocore.config.Config(**S3_POOL_SETTINGS),
+            )
+            _s3_clients[registry_key] = s3_client
+    return s3_client
+
+
+def get_bucket_region(bucket_name, profile=None):
+    """
+    Finds the region of a bucket with a HeadBucket request,
+    caching the answer so each bucket is only looked up once.
+
+            Parameters:
+                    Requires a string naming the bucket.
+                    Optionally the aws config profile to use for the lookup.
+
+            Returns:
+                    The name of the region the bucket is in.
+    """
+    region_name = _bucket_regions.get(bucket_name)
+    if region_name is not None:
+        return region_name
+    s3_client = get_s3_client(profile=profile)
+    try:
+        response = s3_client.head_bucket(Bucket=bucket_name)
+    except botocore.exceptions.ClientError as e:
+        response = e.response
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    region_name = headers.get("x-amz-bucket-region", s3_client.meta.region_name)
+    _bucket_regions[bucket_name] = region_name
+    return region_name
+
+
+def get_s3_client_for_bucket(bucket_name, profile=None):
+    """
+    Gets a cached s3 client in the same region as the bucket,
+    so requests to buckets in other regions don't pay for redirects.
+
+            Parameters:
+                    Requires a string naming the bucket.
+                    Optionally the aws config profile to use.
+
+            Returns:
+                    An instance of s3 client.
+    """
+    region_name = get_bucket_region(bucket_name, profile=profile)
+    return get_s3_client(region_name=region_name, profile=profile)
+
+
+def reset_s3_clients():
+    """
+    Forgets every cached s3 client and bucket region,
+    the next request will create new clients.
+
+            Parameters:
+                    No inputs are taken for this function.
+
+            Returns:
+                    Nothing.
+    """
+    with _s3_clients_lock:
+        _s3_clients.clear()
+        _bucket_regions.clear()
+
+
+def priming_enabled_by_environment():
+    """
+    Returns True when the module should be primed at import. OBFUSCATOR_PRIME
+    turns priming on or off, otherwise lambdas initialised for provisioned
+    concurrency or a SnapStart snapshot are primed, as their init isn't paid
+    for by a request.
+    """
+    setting = os.environ.get(PRIME_ENVIRONMENT_VARIABLE, "").lower()
+    if setting:
+        return setting in ("1", "true", "yes")
+    initialization_type = os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE")
+    return initialization_type in PRIMED_INITIALIZATION_TYPES
+
+
+def _credentials_fingerprint():
+    # lambda puts the function's credentials in the environment,
+    # a restored snapshot gets new ones
+    return hash(
+        (os.environ.get("AWS_ACCESS_KEY_ID"), os.environ.get("AWS_SESSION_TOKEN"))
+    )
+
+
+def _priming_samples():
+    # a tiny file of each format to run the engines on
+    table = pa.Table.from_pylist(PRIME_SAMPLE_RECORDS)
+    parquet = BytesIO()
+    pq.write_table(table, parquet)
+    csv_output = StringIO()
+    writer = csv.DictWriter(csv_output, fieldnames=list(PRIME_SAMPLE_RECORDS[0]))
+    writer.writeheader()
+    writer.writerows(PRIME_SAMPLE_RECORDS)
+    return {
+        "csv": csv_output.getvalue().encode("utf-8"),
+        "json": json.dumps(PRIME_SAMPLE_RECORDS).encode("utf-8"),
+        "ndjson": "".join(
+            json.dumps(record) + "\n" for record in PRIME_SAMPLE_RECORDS
+        ).encode("utf-8"),
+        "parquet": parquet.getvalue(),
+    }
+
+
+def _exercise_engines():
+    # runs every engine, the streaming functions and every compression codec
+    # once on the samples, importing what they use and filling their caches
+    options = [{}, {"engine": "arrow"}, {"engine": "exact"}]
+    if os.environ.get(PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE):
+        options.append({"mode": "pseudonymise"})
+    samples = _priming_samples()
+    for file_format, sample in samples.items():
+        for event_options in options:
+            obfuscate_file_bytes(
+                sample, f"prime.{file_format}", None, ["name"], BytesIO(), event_options
+            )
+    stream_obfuscate_csv(BytesIO(samples["csv"]), ["name"], BytesIO())
+    stream_obfuscate_parquet(BytesIO(samples["parquet"]), ["name"], BytesIO())
+    for compression in COMPRESSIONS:
+        compressed = BytesIO()
+        with compressed_output(compressed, compression, None) as output:
+            output.write(samples["csv"])
+        decompress_bytes(compressed.getvalue(), compression)
+
+
+def prime(buckets=(), profile=None):
+    """
+    Does during init what the first request would otherwise pay for, for lambdas
+    whose init is free, such as provisioned concurrency and SnapStart snapshots.
+        - builds the s3 client and, for each bucket, looks up its region and
+        opens a connection to it with a HeadBucket request
+        - imports numpy, pandas and pyarrow and runs every engine, the streaming
+        functions and the compression codecs on a tiny in memory sample
+        - loads the pseudonymisation key when one is set
+    A step that fails is reported rather than raised, priming never stops init.
+    Parameters:
+        - buckets
+            The names of the buckets to connect to, by default those listed
+            in the environment variable OBFUSCATOR_PRIME_BUCKETS.
+        - profile
+            Optionally the aws config profile of the clients.
+    Returns:
+        - A dictionary of the "timings_ms" of each step and the "errors"
+        of the steps that failed.
+    """
+    global _primed_credentials
+    if not buckets:
+        buckets = os.environ.get(PRIME_BUCKETS_ENVIRONMENT_VARIABLE, "").split(",")
+    steps = {"s3_client": lambda: get_s3_client(profile=profile)}
+    for bucket_name in filter(None, buckets):
+        steps[f"bucket {bucket_name}"] = functools.partial(
+            lambda bucket_name: get_s3_client_for_bucket(
+                bucket_name, profile=profile
+            ).head_bucket(Bucket=bucket_name),
+            bucket_name,
+        )
+    steps["engines"] = _exercise_engines
+    if os.environ.get(PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE):
+        steps["pseudonymiser"] = lambda: pseudonymiser_from_options(
+            {"mode": "pseudonymise"}
+        )
+    timings = {}
+    errors = {}
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            errors[name] = f"{type(e).__name__}: {e}"
+        timings[name] = (time.perf_counter() - start) * 1000
+    _primed_credentials = _credentials_fingerprint()
+    return {"timings_ms": timings, "errors": errors}
+
+
+def refresh_after_restore():
+    """
+    Makes state built before a snapshot safe to use after it's restored:
+    the cached s3 clients are closed with their public close method, which
+    closes their pooled connections, and the client registry and bucket regions
+    are forgotten, so the next request builds fresh clients with the restored
+    lambda's credentials. The random module is reseeded so restored copies don't
+    share a sequence. Everything else primed stays cached.
+    It's registered as an after restore hook when the runtime provides
+    snapshot_restore_py, and check_restored calls it otherwise.
+    """
+    global _primed_credentials
+    with _s3_clients_lock:
+        s3_clients = list(_s3_clients.values())
+    reset_s3_clients()
+    for s3_client in s3_clients:
+        s3_client.close()
+    random.seed()
+    _primed_credentials = _credentials_fingerprint()
+
+
+def check_restored():
+    """
+    Calls refresh_after_restore when the credentials in the environment aren't
+    the ones the module was primed with, as after a snapshot is restored.
+    It's called at the start of every invocation and only compares a hash.
+    """
+    if _primed_credentials is not None:
+        if _primed_credentials != _credentials_fingerprint():
+            refresh_after_restore()
+
+
+def get_file_from_bucket(bucket_name, file_name, client):
+    """
+    Gets specified file from bucket.
+
+            Parameters:
+                    Requires a boto3 s3 client connection.
+                    Requires a string naming the object's bucket
+                    Requires a string naming the object's key 
+
+            Returns:
+                    The target file.
+    """
+    response = client.get_object(Bucket=bucket_name, Key=file_name)
+    body = response["Body"].read()
+    return body
+
+
+def get_file_stream_from_bucket(bucket_name, file_name, client):
+    """
+    Opens specified file from bucket as a stream, without reading it.
+
+            Parameters:
+                    Requires a boto3 s3 client connection.
+                    Requires a string naming the object's bucket
+                    Requires a string naming the object's key
+
+            Returns:
+                    The StreamingBody of the target file.
+    """
+    response = client.get_object(Bucket=bucket_name, Key=file_name)
+    return response["Body"]
+
+
+class S3RangedFile(io.RawIOBase):
+    """
+    A read only, seekable file object over an s3 object.
+    Nothing is downloaded up front, every read fetches just the bytes asked for
+    with a ranged GetObject, so readers like pyarrow.parquet can fetch the footer
+    and then one row group at a time.
+    """
+
+    def __init__(self, client, bucket_name, file_name):
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        response = client.head_object(Bucket=bucket_name, Key=file_name)
+        self.size = response["ContentLength"]
+        self.content_type = response.get("ContentType")
+        self.content_encoding = response.get("ContentEncoding")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self.position = position
+        return self.position
+
+    def _get_range(self, start, length):
+        response = self.client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.file_name,
+            Range=f"bytes={start}-{start + length - 1}",
+        )
+        return response["Body"].read()
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = self._get_range(self.position, length)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readall(self):
+        length = self.size - self.position
+        if length <= 0:
+            return b""
+        data = self._get_range(self.position, length)
+        self.position += len(data)
+        return data
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    A write only file object that streams everything written to it into an s3 object.
+    Writes are cut into parts of part_size bytes which are uploaded concurrently
+    with a multipart upload, at most max_concurrency parts are in flight so memory
+    stays bounded. Outputs smaller than one part are sent with a single put_object.
+    Used as a context manager the upload is completed on exit, or aborted
+    if an exception was raised.
+    A part_size under S3_MIN_PART_SIZE raises ValueError, s3 would only reject
+    it when the upload is completed.
+    When inline_limit is given nothing is uploaded until more than inline_limit bytes
+    have been written, smaller outputs are left in inline_body instead.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket_name,
+        file_name,
+        part_size=S3_UPLOAD_PART_SIZE,
+        max_concurrency=S3_UPLOAD_CONCURRENCY,
+        inline_limit=None,
+    ):
+        super().__init__()
+        if part_size < S3_MIN_PART_SIZE:
+            raise ValueError(
+                f"part_size must be at least {S3_MIN_PART_SIZE} bytes,"
+                " the minimum size of every part of a multipart upload but the last"
+            )
+        self.client = client
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.inline_limit = inline_limit
+        self.inline_body = None
+        self.size = 0
+        self.etag = None
+        self.upload_id = None
+        self._buffer = bytearray()
+        self._parts = []
+        self._pending = []
+        self._executor = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        if self.inline_limit is not None and self.size <= self.inline_limit:
+            return len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def _submit_part(self, part):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.file_name
+            )
+            self.upload_id = response["UploadId"]
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency
+            )
+        while len(self._pending) >= self.max_concurrency:
+            self._parts.append(self._pending.pop(0).result())
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(
+            self._executor.submit(self._upload_part, part_number, part)
+        )
+
+    def _upload_part(self, part_number, part):
+        response = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.file_name,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=part,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def close(self):
+        """
+        Uploads whatever is left in the buffer and completes the upload.
+        """
+        if self.closed:
+            return
+        if self.inline_limit is not None and self.size <= self.inline_limit:
+            self.inline_body = bytes(self._buffer)
+        elif self.upload_id is None:
+            response = self.client.put_object(
+                Bucket=self.bucket_name, Key=self.file_name, Body=bytes(self._buffer)
+            )
+            self.etag = response["ETag"]
+        else:
+            if self._buffer:
+                self._submit_part(bytes(self._buffer))
+            for future in self._pending:
+                self._parts.append(future.result())
+            self._pending = []
+            self._executor.shutdown()
+            response = self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.file_name,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+            self.etag = response["ETag"]
+        self._buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        """
+        Abandons the upload, nothing is written to s3.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.file_name, UploadId=self.upload_id
+            )
+        self._buffer = bytearray()
+        self._pending = []
+        super().close()
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+
+
+def detect_compression(head, content_encoding=None):
+    """
+    This function will identify the compression of a file from its magic bytes,
+    or from the ContentEncoding s3 reports for it when the bytes don't have any.
+    Parameters:
+        - head
+            The first bytes of the file, 6 are enough.
+        - content_encoding
+            Optional ContentEncoding from the s3 HeadObject or GetObject response.
+    Returns:
+        - "gzip", "bz2", "xz" or None for uncompressed files.
+    """
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if head[: len(magic)] == magic:
+            # bzip2 magic is followed by the block size, 1 to 9
+            if compression != "bz2" or head[3:4] in b"123456789":
+                return compression
+    if content_encoding:
+        return COMPRESSION_ENCODINGS.get(content_encoding.strip().lower())
+    return None
+
+
+def strip_compression_extension(key_name):
+    """
+    Returns key_name without a trailing .gz, .bz2 or .xz extension,
+    so "data.csv.gz" still hints at csv.
+    """
+    for extension in COMPRESSION_EXTENSIONS:
+        if key_name and key_name.lower().endswith(extension):
+            return key_name[: -len(extension)]
+    return key_name
+
+
+class _GzipDecompressor:
+    # zlib's gzip decompressor with the needs_input interface of bz2 and lzma
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def decompress(self, data, max_length):
+        data = self._decompressor.unconsumed_tail + data
+        return self._decompressor.decompress(data, max_length)
+
+    @property
+    def needs_input(self):
+        return not self._decompressor.unconsumed_tail
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self._decompressor.unused_data
+
+
+def _new_decompressor(compression):
+    if compression == "gzip":
+        return _GzipDecompressor()
+    if compression == "bz2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    raise ValueError(
+        f"Unknown compression {compression}, must be one of {COMPRESSIONS}"
+    )
+
+
+def _new_compressor(compression, level=None):
+    if level is None:
+        level = COMPRESSION_LEVELS.get(compression)
+    if compression == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if compression == "bz2":
+        return bz2.BZ2Compressor(level)
+    if compression == "xz":
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError(
+        f"Unknown compression {compression}, must be one of {COMPRESSIONS}"
+    )
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A read only file object over the decompressed bytes of a compressed stream.
+    The source is read and decompressed on a background thread, zlib, bz2 and
+    lzma release the GIL, so decompression runs alongside the parsing of the
+    bytes already decompressed. At most queue_size chunks of chunk_size
+    decompressed bytes wait to be read, so memory stays bounded.
+    Concatenated gzip members and bz2 or xz streams are read one after another.
+    Wrap it in an io.BufferedReader for reads of an exact size and peek.
+    """
+
+    def __init__(
+        self,
+        source,
+        compression,
+        chunk_size=COMPRESSION_CHUNK_BYTES,
+        queue_size=COMPRESSION_QUEUE_CHUNKS,
+    ):
+        super().__init__()
+        self.compression = compression
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._chunk = memoryview(b"")
+        self._finished = False
+        self._thread = threading.Thread(
+            target=self._decompress,
+            args=(source, _new_decompressor(compression), chunk_size),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def _put(self, item):
+        # returns False once the reader has been closed
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self, source, decompressor, chunk_size):
+        try:
+            while True:
+                data = source.read(chunk_size)
+                if not data:
+                    break
+                while data or not decompressor.needs_input:
+                    if decompressor.eof:
+                        decompressor = _new_decompressor(self.compression)
+                    chunk = decompressor.decompress(data, chunk_size)
+                    data = decompressor.unused_data if decompressor.eof else b""
+                    if chunk and not self._put(chunk):
+                        return
+                    if decompressor.eof and not data:
+                        break
+            if not decompressor.eof:
+                raise EOFError("the compressed data ends part way through a stream")
+        except (EOFError, OSError, zlib.error, lzma.LZMAError) as error:
+            self._put(
+                TypeError(f"Failed to decompress {self.compression} data, {error}")
+            )
+        except Exception as error:
+            self._put(error)
+        else:
+            self._put(None)
+
+    def _next_chunk(self):
+        # returns False once every chunk has been read
+        if self._finished:
+            return False
+        item = self._chunks.get()
+        if item is None or isinstance(item, Exception):
+            self._finished = True
+            if item is not None:
+                raise item
+            return False
+        self._chunk = memoryview(item)
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            if not self._next_chunk():
+                return 0
+        length = min(len(buffer), len(self._chunk))
+        buffer[:length] = self._chunk[:length]
+        self._chunk = self._chunk[length:]
+        return length
+
+    def readall(self):
+        chunks = [self._chunk]
+        while self._next_chunk():
+            chunks.append(self._chunk)
+        self._chunk = memoryview(b"")
+        return b"".join(chunks)
+
+    def close(self):
+        self._stopped.set()
+        super().close()
+
+
+class CompressingWriter(io.RawIOBase):
+    """
+    A write only file object that compresses everything written to it into output.
+    Writes are collected into chunks of chunk_size bytes that are compressed and
+    written to output on a background thread, so compression runs alongside the
+    obfuscation of the next chunk, with at most queue_size chunks waiting.
+    tell() and size count the uncompressed bytes written.
+    Used as a context manager the compressed stream is finished on exit, output
+    itself is left open.
+    """
+
+    def __init__(
+        self,
+        output,
+        compression,
+        level=None,
+        chunk_size=COMPRESSION_CHUNK_BYTES,
+        queue_size=COMPRESSION_QUEUE_CHUNKS,
+    ):
+        super().__init__()
+        self.output = output
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._buffer = bytearray()
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(
+            target=self._compress,
+            args=(_new_compressor(compression, level),),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def _compress(self, compressor):
+        try:
+            while True:
+                chunk = self._chunks.get()
+                if chunk is None:
+                    break
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    self.output.write(compressed)
+            if not self._aborted:
+                self.output.write(compressor.flush())
+        except Exception as error:
+            self._error = error
+            # keep taking chunks so a blocked write can see the error
+            while self._chunks.get() is not None:
+                pass
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= self.chunk_size:
+            self._chunks.put(bytes(self._buffer))
+            self._buffer = bytearray()
+        return len(data)
+
+    def close(self):
+        """
+        Compresses whatever is left in the buffer and finishes the compressed stream.
+        """
+        if self.closed:
+            return
+        if self._buffer and not self._aborted:
+            self._chunks.put(bytes(self._buffer))
+        self._buffer = bytearray()
+        self._chunks.put(None)
+        self._thread.join()
+        super().close()
+        if self._error is not None and not self._aborted:
+            raise self._error
+
+    def abort(self):
+        """
+        Stops compressing, the compressed stream is left unfinished.
+        """
+        self._aborted = True
+        self.close()
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is not None:
+            self.abort()
+            return
+        self.close()
+
+
+def resolve_output_compression(output_compression, input_compression):
+    """
+    Returns the compression of the output, or None for an uncompressed output.
+    Parameters:
+        - output_compression
+            "same" to compress the output like the input, "none",
+            or one of COMPRESSIONS.
+        - input_compression
+            The compression detect_compression found for the input.
+    """
+    if output_compression == "same":
+        return input_compression
+    if output_compression == "none":
+        return None
+    if output_compression not in COMPRESSIONS:
+        raise ValueError(
+            f"Unknown output_compression {output_compression},"
+            f" must be same, none or one of {COMPRESSIONS}"
+        )
+    return output_compression
+
+
+class MemoryviewReader(io.RawIOBase):
+    """
+    A read only, seekable file object over any object supporting the buffer
+    protocol. It reads from a memoryview of the object, where BytesIO would
+    copy a bytearray or memoryview before reading it.
+    Closing it releases the memoryview, so a bytearray it read can be resized.
+    """
+
+    def __init__(self, data):
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        chunk = self._view[self._position : self._position + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def readall(self):
+        data = self._view[self._position :].tobytes()
+        self._position += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _release_buffer(buffer):
+    """
+    Empties a bytearray that has been parsed and is no longer needed, freeing
+    its memory while the caller still holds a reference to it.
+    Other objects, and bytearrays something still has a view of, are left alone.
+    """
+    if isinstance(buffer, bytearray):
+        try:
+            del buffer[:]
+        except BufferError:
+            pass
+
+
+def decompress_bytes(data, compression):
+    """
+    Returns the decompressed bytes of a whole compressed file as a bytearray,
+    it's grown a chunk at a time rather than joined from every chunk at the end.
+    """
+    decompressed = bytearray()
+    with MemoryviewReader(data) as source:
+        with DecompressingReader(source, compression) as reader:
+            while chunk := reader.read(COMPRESSION_CHUNK_BYTES):
+                decompressed += chunk
+    return decompressed
+
+
+def compressed_output(output, compression, level=None):
+    """
+    Returns a context manager giving a CompressingWriter over output,
+    or output itself when compression is None.
+    """
+    if compression is None:
+        return contextlib.nullcontext(output)
+    return CompressingWriter(output, compression, level)
+
+
+def download_file_in_ranges(
+    bucket_name,
+    file_name,
+    client,
+    part_size=S3_DOWNLOAD_PART_SIZE,
+    max_concurrency=S3_DOWNLOAD_CONCURRENCY,
+):
+    """
+    Gets specified file from bucket with concurrent ranged requests.
+    The first part is requested on its own, its Content-Range gives the size of the
+    object (so no separate HeadObject is needed), then the remaining parts are
+    fetched on a thread pool sharing the client. Every part is written straight
+    into its slice of one preallocated bytearray, there is no concatenation.
+    The later requests are pinned to the ETag of the first so a file replaced
+    part way through the download fails instead of mixing versions.
+
+            Parameters:
+                    Requires a string naming the object's bucket
+                    Requires a string naming the object's key
+                    Requires a boto3 s3 client connection.
+                    Optionally the size in bytes of each ranged request
+                    and how many requests are made at once.
+
+            Returns:
+                    A dictionary in format:
+                    {
+                        "body": a bytearray of the target file,
+                        "content_type": the ContentType of the object, or None
+                        "content_encoding": the ContentEncoding of the object, or None
+                    }
+    """
+    try:
+        response = client.get_object(
+            Bucket=bucket_name, Key=file_name, Range=f"bytes=0-{part_size - 1}"
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "InvalidRange":
+            raise e
+        # ranges can't be requested from an empty object
+        response = client.get_object(Bucket=bucket_name, Key=file_name)
+        return {
+            "body": bytearray(response["Body"].read()),
+            "content_type": response.get("ContentType"),
+            "content_encoding": response.get("ContentEncoding"),
+        }
+    content_range = response.get("ContentRange")
+    if content_range:
+        size = int(content_range.rsplit("/", 1)[1])
+    else:
+        size = response["ContentLength"]
+    body = bytearray(size)
+    view = memoryview(body)
+
+    def read_part(part_response, start):
+        position = start
+        for chunk in part_response["Body"].iter_chunks(S3_DOWNLOAD_READ_SIZE):
+            view[position : position + len(chunk)] = chunk
+            position += len(chunk)
+        return position - start
+
+    def fetch_part(start):
+        end = min(start + part_size, size)
+        part_response = client.get_object(
+            Bucket=bucket_name,
+            Key=file_name,
+            Range=f"bytes={start}-{end - 1}",
+            IfMatch=response["ETag"],
+        )
+        if read_part(part_response, start) != end - start:
+            raise IOError(f"Incomplete download of bytes {start}-{end - 1}")
+
+    if read_part(response, 0) != min(part_size, size):
+        raise IOError(f"Incomplete download of bytes 0-{part_size - 1}")
+    remaining_starts = range(part_size, size, part_size)
+    if remaining_starts:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency
+        ) as executor:
+            for _ in executor.map(fetch_part, remaining_starts):
+                pass
+    view.release()
+    return {
+        "body": body,
+        "content_type": response.get("ContentType"),
+        "content_encoding": response.get("ContentEncoding"),
+    }
+
+
+def get_bucket_and_key_strings(file_path):
+    """
+    From an s3 path in the format "s3://bucket/key" this function will
+    extract the path information (bucket and key)
+    Parameters:
+        - takes the file path in format "s3://bucket/key"
+
+    Returns:
+        - a dictionary in format:
+        {
+            "bucket_name":bucket,
+            "key_name":key
+        }
+    """
+    path_elements = file_path.split("/")
+    bucket_name = path_elements[2]
+    key_name = ""
+    first_key_ele_toggle = False
+    for ele in path_elements[3:]:
+        if first_key_ele_toggle == True:
+            key_name += "/"
+        key_name += ele
+        first_key_ele_toggle = True
+    return {"bucket_name": bucket_name, "key_name": key_name}
+
+
+class Pseudonymiser:
+    """
+    Replaces values with tokens, the first `length` hex characters of their
+    HMAC-SHA256 under a secret key, so a value gets the same token in every file
+    and joins and distinct counts still work on the pseudonymised data.
+    Values are hashed as text, numbers as str() gives them and nested json values
+    as json with sorted keys. Nulls, NaN and empty strings are kept as they are.
+    Tokens are memoised in an LRU cache of cache_size values, and columns are
+    factorised first so each distinct value is looked up once, rather than every cell.
+    """
+
+    def __init__(self, key, length=PSEUDONYM_LENGTH, cache_size=PSEUDONYM_CACHE_SIZE):
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        if not key:
+            raise ValueError("The pseudonymisation key can't be empty")
+        if not 1 <= length <= 64:
+            raise ValueError("The token length must be between 1 and 64")
+        self.key = key
+        self.length = length
+        self.token = functools.lru_cache(maxsize=cache_size, typed=True)(
+            self._hmac_token
+        )
+
+    def __reduce__(self):
+        # worker processes get the pseudonymiser of their own registry,
+        # the memo isn't pickled
+        return (get_pseudonymiser, (self.key, self.length))
+
+    def _hmac_token(self, value):
+        if isinstance(value, str):
+            message = value.encode("utf-8")
+        elif isinstance(value, bytes):
+            message = value
+        else:
+            message = str(value).encode("utf-8")
+        return hmac.digest(self.key, message, "sha256").hex()[: self.length]
+
+    def pseudonymise_value(self, value):
+        """
+        Returns the token of one value.
+        """
+        if (
+            value is None
+            or value == ""
+            or (isinstance(value, float) and value != value)
+        ):
+            return value
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        return self.token(value)
+
+    def tokens(self, values):
+        """
+        Returns the list of the tokens of a list of values.
+        """
+        return [self.pseudonymise_value(value) for value in values]
+
+    def pseudonymise_series(self, series):
+        """
+        Returns a pandas Series of the tokens of series,
+        hashing each distinct value once.
+        """
+        try:
+            codes, uniques = pd.factorize(series)
+        except TypeError:
+            # nested values such as lists can't be factorised
+            return pd.Series(self.tokens(series), index=series.index, dtype=object)
+        tokens = np.array(self.tokens(list(uniques)) + [None], dtype=object)
+        return pd.Series(tokens[codes], index=series.index, dtype=object)
+
+    def pseudonymise_arrow(self, array):
+        """
+        Returns a dictionary encoded pyarrow array of the tokens of array, only the
+        dictionary of distinct values is hashed and the indices are kept.
+        """
+        if isinstance(array, pa.ChunkedArray):
+            chunks = array.chunks or [pa.array([], type=array.type)]
+            new_chunks = [self.pseudonymise_arrow(chunk) for chunk in chunks]
+            return pa.chunked_array(new_chunks, type=new_chunks[0].type)
+        if pa.types.is_nested(array.type):
+            return pa.array(self.tokens(array.to_pylist()), type=pa.string())
+        if not pa.types.is_dictionary(array.type):
+            array = array.dictionary_encode()
+        dictionary = pa.array(self.tokens(array.dictionary.to_pylist()), pa.string())
+        return pa.DictionaryArray.from_arrays(array.indices, dictionary)
+
+
+_PSEUDONYMISERS = {}
+
+
+def get_pseudonymiser(key, length=PSEUDONYM_LENGTH):
+    """
+    Returns the Pseudonymiser for a key and token length, creating it on first use,
+    so its memo is kept across warm lambda invocations.
+    """
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    if (key, length) not in _PSEUDONYMISERS:
+        _PSEUDONYMISERS[(key, length)] = Pseudonymiser(key, length)
+    return _PSEUDONYMISERS[(key, length)]
+
+
+def pseudonymiser_from_options(options):
+    """
+    Returns the Pseudonymiser to use for the "mode" of an event, or None to mask
+    values with "***". The key is read from the environment variable
+    OBFUSCATOR_PSEUDONYMISATION_KEY, so it's never part of the event.
+    """
+    mode = options.get("mode", "mask")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, must be one of {MODES}")
+    if mode == "mask":
+        return None
+    key = os.environ.get(PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE)
+    if not key:
+        raise ValueError(
+            f"Set {PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE} to pseudonymise"
+        )
+    return get_pseudonymiser(key, options.get("token_length", PSEUDONYM_LENGTH))
+
+
+def _mask_value(value, pseudonymiser=None):
+    if pseudonymiser is None:
+        return OBFUSCATED_STRING
+    return pseudonymiser.pseudonymise_value(value)
+
+
+def _masked_arrow_array(array, pseudonymiser=None):
+    # a dictionary encoded "***" array as long as array, or its tokens
+    if pseudonymiser is not None:
+        return pseudonymiser.pseudonymise_arrow(array)
+    masked = pa.DictionaryArray.from_arrays(
+        pa.repeat(pa.scalar(0, pa.int8()), len(array)),
+        pa.array([OBFUSCATED_STRING]),
+    )
+    if isinstance(array, pa.ChunkedArray):
+        return pa.chunked_array([masked])
+    return masked
+
+
+def is_field_path(field):
+    """
+    Returns True when an entry of obfuscate_fields is a JMESPath expression
+    selecting nested values, such as "customer.contact.email" or
+    "orders[*].shipping.address", rather than the name of a top level field.
+    A top level field with the same name as an expression is still obfuscated
+    as a field.
+    """
+    return FIELD_PATH_CHARACTERS.search(field) is not None
+
+
+@functools.lru_cache(maxsize=FIELD_PATH_CACHE_SIZE)
+def compile_field_path(expression):
+    """
+    Compiles a JMESPath expression, calls with the same expression string
+    return the compiled expression from an LRU cache.
+    """
+    return jmespath.compile(expression)
+
+
+_IDENTITY_NODE = {"type": "identity", "children": []}
+_JMESPATH_INTERPRETER = jmespath.visitor.TreeInterpreter()
+
+
+def _split_path_root(node):
+    # splits an expression into the top level field it starts from and the
+    # expression to apply to that field's value, the root is None when the
+    # expression doesn't start from a field
+    kind = node["type"]
+    if kind == "field":
+        return node["value"], _IDENTITY_NODE
+    if kind == "subexpression":
+        root, rest = _split_path_root(node["children"][0])
+        if root is None:
+            return None, node
+        children = node["children"][1:]
+        if rest["type"] != "identity":
+            children = [rest] + children
+        if len(children) == 1:
+            return root, children[0]
+        return root, {"type": "subexpression", "children": children}
+    if kind in (
+        "projection",
+        "index_expression",
+        "value_projection",
+        "filter_projection",
+        "flatten",
+    ):
+        root, rest = _split_path_root(node["children"][0])
+        if root is None:
+            return None, node
+        return root, {**node, "children": [rest] + node["children"][1:]}
+    return None, node
+
+
+@functools.lru_cache(maxsize=FIELD_PATH_CACHE_SIZE)
+def _split_field_path(field):
+    """
+    Returns the top level field a field or field path starts from, or None,
+    and the parsed expression selecting the values to obfuscate from it.
+    """
+    if not is_field_path(field):
+        return field, _IDENTITY_NODE
+    return _split_path_root(compile_field_path(field).parsed)
+
+
+def _has_fields(fields, columns):
+    # every field is a column, or a path starting from a column
+    columns = set(columns)
+    return all(
+        field in columns or _split_field_path(field)[0] in columns for field in fields
+    )
+
+
+def _is_jmespath_true(value):
+    return not (value is None or value is False or value in ("", [], {}))
+
+
+def _json_path_locations(node, container, key):
+    """
+    Yields a (container, key) pair for each value the parsed expression node
+    selects from container[key], so the selected values can be replaced in place.
+    """
+    kind = node["type"]
+    value = container[key]
+    children = node["children"]
+    if kind in ("identity", "current"):
+        yield container, key
+    elif kind == "field":
+        if isinstance(value, dict) and node["value"] in value:
+            yield value, node["value"]
+    elif kind == "subexpression":
+        locations = [(container, key)]
+        for child in children:
+            locations = [
+                location
+                for parent, parent_key in locations
+                for location in _json_path_locations(child, parent, parent_key)
+            ]
+        yield from locations
+    elif kind == "index_expression":
+        for parent, parent_key in _json_path_locations(children[0], container, key):
+            yield from _json_path_locations(children[1], parent, parent_key)
+    elif kind == "index":
+        if isinstance(value, list) and -len(value) <= node["value"] < len(value):
+            yield value, node["value"]
+    elif kind == "projection":
+        for parent, parent_key in _projected_json_locations(
+            children[0], container, key
+        ):
+            yield from _json_path_locations(children[1], parent, parent_key)
+    elif kind == "value_projection":
+        for parent, parent_key in _json_path_locations(children[0], container, key):
+            values = parent[parent_key]
+            if isinstance(values, dict):
+                for value_key in list(values):
+                    yield from _json_path_locations(children[1], values, value_key)
+    elif kind == "filter_projection":
+        for parent, parent_key in _json_path_locations(children[0], container, key):
+            elements = parent[parent_key]
+            if isinstance(elements, list):
+                for index, element in enumerate(elements):
+                    condition = _JMESPATH_INTERPRETER.visit(children[2], element)
+                    if _is_jmespath_true(condition):
+                        yield from _json_path_locations(children[1], elements, index)
+    else:
+        raise ValueError(
+            f"JMESPath {kind} expressions can't select the values to obfuscate"
+        )
+
+
+def _projected_json_locations(node, container, key):
+    # the elements a projection applies its right hand side to
+    kind = node["type"]
+    children = node["children"]
+    if kind == "index_expression" and children[1]["type"] == "slice":
+        for parent, parent_key in _json_path_locations(children[0], container, key):
+            elements = parent[parent_key]
+            if isinstance(elements, list):
+                for index in range(len(elements))[slice(*children[1]["children"])]:
+                    yield elements, index
+    elif kind == "flatten":
+        for parent, parent_key in _json_path_locations(children[0], container, key):
+            elements = parent[parent_key]
+            if isinstance(elements, list):
+                for index, element in enumerate(elements):
+                    if isinstance(element, list):
+                        for inner_index in range(len(element)):
+                            yield element, inner_index
+                    else:
+                        yield elements, index
+    else:
+        for parent, parent_key in _json_path_locations(node, container, key):
+            elements = parent[parent_key]
+            if isinstance(elements, list):
+                for index in range(len(elements)):
+                    yield elements, index
+
+
+def obfuscate_json_path(document, expression, pseudonymiser=None):
+    """
+    This function will replace every value a JMESPath expression selects from
+    a parsed json document with "***", in place, without copying the document.
+    Field names, indexes, slices, [*] and [] projections, * value projections
+    and [?...] filters can be used, e.g. "orders[?paid].card.number".
+    Parameters:
+        - document
+            A dictionary or list, e.g. a record from json.loads.
+        - expression
+            The JMESPath expression, it's compiled once with compile_field_path.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+    Returns:
+        - The number of values replaced.
+    """
+    holder = [document]
+    locations = list(
+        _json_path_locations(compile_field_path(expression).parsed, holder, 0)
+    )
+    for container, key in locations:
+        container[key] = _mask_value(container[key], pseudonymiser)
+    return len(locations)
+
+
+def _obfuscate_json_record(record, pii_fields, pseudonymiser=None):
+    """
+    Masks the pii fields of a parsed json object in place, top level fields by name
+    and field paths with obfuscate_json_path.
+    Returns the list of the pii fields found in the record.
+    """
+    found_fields = []
+    for field in pii_fields:
+        if field in record:
+            record[field] = _mask_value(record[field], pseudonymiser)
+            found_fields.append(field)
+        elif is_field_path(field) and obfuscate_json_path(record, field, pseudonymiser):
+            found_fields.append(field)
+    return found_fields
+
+
+def _arrow_path_steps(node):
+    # turns a parsed expression into steps through nested arrow types:
+    # ("field", name) of a struct, ("each",) element of a list, ("flatten",)
+    # elements of a list or of its inner lists, ("values",) every struct field
+    kind = node["type"]
+    children = node["children"]
+    if kind in ("identity", "current"):
+        return []
+    if kind == "field":
+        return [("field", node["value"])]
+    if kind == "subexpression":
+        return [step for child in children for step in _arrow_path_steps(child)]
+    if kind == "projection" and children[0]["type"] == "flatten":
+        left = _arrow_path_steps(children[0]["children"][0])
+        return left + [("flatten",)] + _arrow_path_steps(children[1])
+    if kind == "projection":
+        left = _arrow_path_steps(children[0])
+        return left + [("each",)] + _arrow_path_steps(children[1])
+    if kind == "value_projection":
+        left = _arrow_path_steps(children[0])
+        return left + [("values",)] + _arrow_path_steps(children[1])
+    raise ValueError(
+        f"JMESPath {kind} expressions can't select nested columns to obfuscate"
+    )
+
+
+def _mask_nested_arrow(array, steps, pseudonymiser=None):
+    """
+    Replaces the values of a pyarrow array selected by steps from _arrow_path_steps
+    with a dictionary encoded "***", or their tokens, rebuilding only the struct
+    and list arrays on the way to them, every other child array is shared with
+    the input.
+    Returns:
+        - The new array and whether steps selected anything from its type.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        chunks = array.chunks or [pa.array([], type=array.type)]
+        masked = [_mask_nested_arrow(chunk, steps, pseudonymiser) for chunk in chunks]
+        new_chunks = [chunk for chunk, _ in masked]
+        return pa.chunked_array(new_chunks, type=new_chunks[0].type), masked[0][1]
+    if not steps:
+        return _masked_arrow_array(array, pseudonymiser), True
+    step, rest = steps[0], steps[1:]
+    array_type = array.type
+    if step[0] in ("each", "flatten") and (
+        pa.types.is_list(array_type) or pa.types.is_large_list(array_type)
+    ):
+        if step[0] == "flatten" and pa.types.is_list(array_type.value_type):
+            rest = [("each",)] + rest
+        values, found = _mask_nested_arrow(array.values, rest, pseudonymiser)
+        list_class = type(array)
+        return (
+            list_class.from_arrays(array.offsets, values, mask=array.is_null()),
+            found,
+        )
+    if pa.types.is_struct(array_type) and step[0] in ("field", "values"):
+        fields = list(array_type)
+        children = array.flatten()
+        found = False
+        for index, field in enumerate(fields):
+            if step[0] == "field" and field.name != step[1]:
+                continue
+            children[index], child_found = _mask_nested_arrow(
+                children[index], rest, pseudonymiser
+            )
+            fields[index] = field.with_type(children[index].type)
+            found = found or child_found
+        if not found:
+            return array, False
+        return (
+            pa.StructArray.from_arrays(children, fields=fields, mask=array.is_null()),
+            True,
+        )
+    return array, False
+
+
+def _check_typed_mask(typed_mask):
+    if typed_mask is not None and typed_mask not in TYPED_MASKS:
+        raise ValueError(
+            f"Unknown typed_mask {typed_mask}, must be one of {TYPED_MASKS}"
+        )
+
+
+def _masked_series(column, typed_mask=None):
+    """
+    Returns the mask of a dataframe column without a python object for each row.
+    By default it's a categorical with the single category "***", which csv and
+    json show as *** and parquet writes as a one value dictionary page.
+    With typed_mask "null" or "sentinel", integer, float, boolean and datetime
+    columns keep their dtype instead, holding only nulls or the zero value of
+    the type. The values are zero strided views of a single value, so memory
+    doesn't grow with the length of the column.
+    """
+    length = len(column)
+    dtype = getattr(column.dtype, "numpy_dtype", column.dtype)
+    if (
+        typed_mask is None
+        or not isinstance(dtype, np.dtype)
+        or dtype.kind not in TYPED_MASK_KINDS
+    ):
+        values = pd.Categorical.from_codes(
+            np.broadcast_to(np.int8(0), length), categories=[OBFUSCATED_STRING]
+        )
+        return pd.Series(values, index=column.index, name=column.name, copy=False)
+    is_null = typed_mask == "null"
+    zero = np.zeros((), dtype=dtype)
+    if is_null and dtype.kind in "fM":
+        # NaN and NaT are the nulls of floats and datetimes
+        zero = np.array("NaT" if dtype.kind == "M" else np.nan, dtype=dtype)
+    values = np.broadcast_to(zero, length)
+    if dtype.kind in "iub" and (is_null or dtype != column.dtype):
+        array_class = (
+            pd.arrays.BooleanArray if dtype.kind == "b" else pd.arrays.IntegerArray
+        )
+        values = array_class(values, np.broadcast_to(is_null, length))
+    return pd.Series(values, index=column.index, name=column.name, copy=False)
+
+
+def _is_masked_category(column):
+    # whether a dataframe column is the categorical mask _masked_series returns
+    return isinstance(column.dtype, pd.CategoricalDtype) and list(
+        column.dtype.categories
+    ) == [OBFUSCATED_STRING]
+
+
+def produce_obfuscated_data(df, pii_fields, pseudonymiser=None, typed_mask=None):
+    """
+    This function will replace specified fields of a dataframe with
+    obfuscated strings "***"
+    Each sensitive column becomes a categorical column with the single category
+    "***", or keeps its type with typed_mask, see _masked_series, and the other
+    columns are shared with the input dataframe, not copied.
+    Parameters:
+        - A dataframe containing the dataset to be obfuscated.
+        - A list of fields containing the data to be obfuscated.
+        - Optionally a Pseudonymiser to replace the values with their tokens instead.
+        - Optionally "null" or "sentinel" to keep the types of number, boolean
+        and datetime columns, for typed output formats such as parquet.
+    Returns:
+        - A new dataframe with the required obfuscation completed.
+    
+    """
+    _check_typed_mask(typed_mask)
+    field_paths = [
+        field
+        for field in pii_fields
+        if field not in df.columns and is_field_path(field)
+    ]
+    columns = [field for field in pii_fields if field not in field_paths]
+    missing = [field for field in columns if field not in df.columns]
+    if missing:
+        raise TypeError(f"Failed to find the fields {missing} to obfuscate")
+    masked = {}
+    for field in columns:
+        if pseudonymiser is None:
+            masked[field] = _masked_series(df[field], typed_mask)
+        else:
+            masked[field] = pseudonymiser.pseudonymise_series(df[field])
+    new_df = pd.DataFrame(
+        {name: masked.get(name, df[name]) for name in df.columns},
+        index=df.index,
+        copy=False,
+    )
+    for field in field_paths:
+        root, rest = _split_field_path(field)
+        found = False
+        if root in new_df.columns:
+            column, found = _mask_nested_arrow(
+                pa.array(new_df[root], from_pandas=True),
+                _arrow_path_steps(rest),
+                pseudonymiser,
+            )
+        if not found:
+            raise TypeError(f"Failed to find the field {field} to obfuscate")
+        new_df[root] = pd.Series(column.to_pylist(), index=new_df.index, dtype=object)
+    return new_df
+
+
+def _typed_arrow_mask(column_type, length, typed_mask):
+    # the typed nulls or zero values for typed_mask of a number, boolean or
+    # temporal column, None for any other column
+    if typed_mask is None or not (
+        pa.types.is_integer(column_type)
+        or pa.types.is_floating(column_type)
+        or pa.types.is_boolean(column_type)
+        or pa.types.is_temporal(column_type)
+    ):
+        return None
+    if typed_mask == "null":
+        return pa.nulls(length, column_type)
+    storage_type = pa.int32() if column_type.bit_width == 32 else pa.int64()
+    return pa.repeat(pa.scalar(0, storage_type).cast(column_type), length)
+
+
+def produce_obfuscated_table(table, pii_fields, pseudonymiser=None, typed_mask=None):
+    """
+    This function will replace specified columns of a pyarrow Table with
+    obfuscated strings "***"
+    Each sensitive column is swapped for a dictionary encoded column with the
+    single value "***", the other columns are shared with the input table, not copied.
+    Field paths such as "customer.contact.email" mask the values they select
+    inside struct and list columns, see is_field_path.
+    With a Pseudonymiser the columns are swapped for dictionary encoded tokens,
+    only the distinct values of each column are hashed.
+    Parameters:
+        - A pyarrow Table containing the dataset to be obfuscated.
+        - A list of fields containing the data to be obfuscated.
+        - Optionally a Pseudonymiser to replace the values with their tokens instead.
+        - Optionally "null" or "sentinel" to keep the types of number, boolean
+        and temporal columns, filled with nulls or the zero value of the type.
+    Returns:
+        - A new Table with the required obfuscation completed.
+    """
+    _check_typed_mask(typed_mask)
+    obfuscated_column = pa.DictionaryArray.from_arrays(
+        pa.repeat(pa.scalar(0, pa.int8()), table.num_rows),
+        pa.array([OBFUSCATED_STRING]),
+    )
+    new_table = table
+    for field in pii_fields:
+        column_index = new_table.schema.get_field_index(field)
+        if column_index != -1:
+            column = new_table.column(column_index)
+            if pseudonymiser is not None:
+                column = pseudonymiser.pseudonymise_arrow(column)
+            else:
+                column = _typed_arrow_mask(column.type, len(column), typed_mask)
+            if column is None:
+                column = obfuscated_column
+            new_table = new_table.set_column(column_index, field, column)
+            continue
+        root, rest = _split_field_path(field)
+        found = False
+        if root is not None and new_table.schema.get_field_index(root) != -1:
+            column_index = new_table.schema.get_field_index(root)
+            column, found = _mask_nested_arrow(
+                new_table.column(column_index), _arrow_path_steps(rest), pseudonymiser
+            )
+        if not found:
+            raise TypeError(f"Failed to find the field {field} to obfuscate")
+        new_table = new_table.set_column(column_index, root, column)
+    return new_table
+
+
+def stream_obfuscate_csv(
+    stream,
+    pii_fields,
+    output,
+    chunk_rows=CSV_STREAM_CHUNK_ROWS,
+    write_header=True,
+    pseudonymiser=None,
+):
+    """
+    This function will obfuscate a csv stream chunk by chunk, writing each
+    obfuscated chunk to the output as soon as it is ready.
+    Only one chunk of rows is held in memory at a time, so peak memory
+    does not grow with the size of the file.
+    Every value is read as a string so each chunk is written back the same way
+    regardless of what the other chunks contain.
+    Parameters:
+        - stream
+            A readable file-like object containing csv data,
+            e.g. the StreamingBody of an s3 get_object response.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated csv is written to.
+        - chunk_rows
+            The number of rows parsed and obfuscated at a time.
+        - write_header
+            False to leave the header row out of the output.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+    Returns:
+        - The number of data rows written to the output.
+    """
+    reader = pd.read_csv(
+        stream,
+        sep=",",
+        header=0,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_rows,
+    )
+    row_count = 0
+    for chunk in reader:
+        if row_count == 0 and not set(pii_fields).issubset(set(chunk.columns)):
+            raise TypeError("Failed to find the fields to obfuscate in the csv header")
+        if pseudonymiser is None:
+            chunk[pii_fields] = "***"
+        else:
+            for field in pii_fields:
+                chunk[field] = pseudonymiser.pseudonymise_series(chunk[field])
+        output.write(chunk.to_csv(index=False, header=write_header).encode("utf-8"))
+        row_count += len(chunk)
+        write_header = False
+    return row_count
+
+
+def csv_record_boundaries(buffer):
+    """
+    Builds an index of where each csv record starts, skipping newlines inside
+    quoted fields, with numpy over the raw bytes instead of a python loop.
+    A newline ends a record when an even number of quotes come before it,
+    doubled quotes inside a quoted field count twice so they don't change that.
+    Parameters:
+        - buffer
+            The csv bytes, any object supporting the buffer protocol.
+    Returns:
+        - A numpy array of the offsets just after each newline that ends a record,
+        the first is the end of the header.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    quotes = np.flatnonzero(data == ord('"'))
+    newlines = np.flatnonzero(data == ord("\n"))
+    quotes_before = np.searchsorted(quotes, newlines)
+    return newlines[quotes_before % 2 == 0] + 1
+
+
+def _slice_edges(boundaries, start, end, slice_count):
+    """
+    Picks the offsets, from a sorted array of record boundaries between start
+    and end, that split the bytes into about slice_count slices of equal size.
+    Returns the list of edges, starting with start and ending with end.
+    """
+    split_points = np.linspace(start, end, slice_count + 1)[1:-1]
+    indexes = np.searchsorted(boundaries, split_points).clip(max=len(boundaries) - 1)
+    edges = [start]
+    edges += [
+        int(edge) for edge in np.unique(boundaries[indexes]) if start < edge < end
+    ]
+    edges.append(end)
+    return edges
+
+
+def _map_slices_in_parallel(buffer, edges, function, arguments, max_workers):
+    """
+    Copies buffer once into shared memory, then calls
+    function(shared_memory_name, start, end, *arguments) for the slice between
+    each pair of consecutive edges on a ProcessPoolExecutor.
+    Returns a generator of the results in the order of the slices.
+    """
+    size = edges[-1]
+    shared = multiprocessing.shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shared.buf[:size] = memoryview(buffer).cast("B")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            yield from pool.map(
+                function,
+                itertools.repeat(shared.name),
+                edges[:-1],
+                edges[1:],
+                *(itertools.repeat(argument) for argument in arguments),
+            )
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def _obfuscate_csv_slice(
+    shared_memory_name, start, end, header_end, pii_fields, pseudonymiser
+):
+    # runs in a worker process, the csv bytes are read from shared memory
+    # rather than pickled with each task
+    shared = multiprocessing.shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        records = bytes(shared.buf[:header_end]) + bytes(shared.buf[start:end])
+    finally:
+        shared.close()
+    output = BytesIO()
+    row_count = stream_obfuscate_csv(
+        BytesIO(records),
+        pii_fields,
+        output,
+        chunk_rows=CSV_STREAM_CHUNK_ROWS,
+        write_header=start == header_end,
+        pseudonymiser=pseudonymiser,
+    )
+    return output.getvalue(), row_count
+
+
+def parallel_obfuscate_csv(
+    buffer, pii_fields, output, max_workers=None, pseudonymiser=None
+):
+    """
+    This function will obfuscate csv bytes on several cores, writing the same bytes
+    to the output as stream_obfuscate_csv.
+    The buffer is split on record boundaries found by csv_record_boundaries into
+    slices that a ProcessPoolExecutor parses and obfuscates in parallel. The bytes
+    are copied once into shared memory which every worker reads its slice from,
+    and the obfuscated slices are written to the output in order.
+    Worker processes need /dev/shm, so this is for running the tool as a library
+    on a multi-core machine, it doesn't work in aws lambda.
+    Parameters:
+        - buffer
+            The csv bytes, any object supporting the buffer protocol.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated csv is written to.
+        - max_workers
+            The number of worker processes, by default the number of cores.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens,
+            each worker process keeps its own memo.
+    Returns:
+        - The number of data rows written to the output.
+    """
+    max_workers = max_workers or os.cpu_count()
+    boundaries = csv_record_boundaries(buffer)
+    size = len(memoryview(buffer))
+    if max_workers < 2 or size < PARALLEL_MIN_BYTES or len(boundaries) == 0:
+        return stream_obfuscate_csv(
+            BytesIO(buffer), pii_fields, output, pseudonymiser=pseudonymiser
+        )
+    header_end = int(boundaries[0])
+    edges = _slice_edges(
+        boundaries, header_end, size, max_workers * PARALLEL_SLICES_PER_WORKER
+    )
+    row_count = 0
+    for obfuscated, slice_rows in _map_slices_in_parallel(
+        buffer,
+        edges,
+        _obfuscate_csv_slice,
+        (header_end, pii_fields, pseudonymiser),
+        max_workers,
+    ):
+        output.write(obfuscated)
+        row_count += slice_rows
+    return row_count
+
+
+def _exact_csv_spans(block, pii_indexes, final):
+    """
+    Finds the byte spans of the pii fields in a block of csv records.
+    Parameters:
+        - block
+            A numpy uint8 array starting at a record boundary.
+        - pii_indexes
+            The positions of the pii fields in each record.
+        - final
+            True when the block holds the rest of the file, so its last record
+            doesn't need a newline.
+    Returns:
+        - A dictionary with the "starts" and "ends" arrays of the pii spans, "end",
+        the offset after the last complete record or None when there isn't one,
+        and the number of non blank "rows" up to it.
+    """
+    quotes = np.flatnonzero(block == ord('"'))
+    delimiters = np.flatnonzero((block == ord(",")) | (block == ord("\n")))
+    delimiters = delimiters[np.searchsorted(quotes, delimiters) % 2 == 0]
+    is_newline = block[delimiters] == ord("\n")
+    if final and len(block) and block[-1] != ord("\n"):
+        delimiters = np.append(delimiters, len(block))
+        is_newline = np.append(is_newline, True)
+    record_ends = np.flatnonzero(is_newline)
+    if len(record_ends) == 0:
+        return {"starts": None, "ends": None, "end": None, "rows": 0}
+    delimiters = delimiters[: record_ends[-1] + 1]
+    is_newline = is_newline[: record_ends[-1] + 1]
+    field_starts = np.concatenate(([0], delimiters[:-1] + 1))
+    field_ends = delimiters.copy()
+    record_firsts = np.concatenate(([0], record_ends[:-1] + 1))
+    records = np.cumsum(is_newline) - is_newline
+    field_indexes = np.arange(len(delimiters)) - record_firsts[records]
+    # the \r of a \r\n line ending isn't part of the last field
+    carriage_return = (
+        is_newline & (field_ends > field_starts) & (block[field_ends - 1] == ord("\r"))
+    )
+    field_ends[carriage_return] -= 1
+    blank = is_newline & (field_indexes == 0) & (field_ends == field_starts)
+    selected = np.isin(field_indexes, pii_indexes) & ~blank
+    return {
+        "starts": field_starts[selected],
+        "ends": field_ends[selected],
+        "end": min(int(delimiters[-1]) + 1, len(block)),
+        "rows": len(record_ends) - int(blank.sum()),
+    }
+
+
+def _splice_mask(data, starts, ends, mask):
+    """
+    Returns the bytes of data with each span from starts to ends replaced by mask,
+    built with numpy rather than by joining a slice per span.
+    The spans must be sorted and not overlap.
+    """
+    boundaries = np.zeros(len(data) + 1, dtype=np.int8)
+    boundaries[starts] += 1
+    boundaries[ends] -= 1
+    kept = data[np.cumsum(boundaries[:-1], dtype=np.int8) == 0]
+    lengths = ends - starts
+    positions = starts - (np.cumsum(lengths) - lengths)
+    return np.insert(
+        kept,
+        np.repeat(positions, len(mask)),
+        np.tile(np.frombuffer(mask, dtype=np.uint8), len(starts)),
+    ).tobytes()
+
+
+def _splice_tokens(data, starts, ends, pseudonymiser):
+    """
+    Returns the bytes of data with each span from starts to ends replaced by
+    the token of the csv field it holds, quoted fields are unquoted before hashing.
+    Each distinct field is hashed once, empty fields are kept empty.
+    """
+    fields = [bytes(data[start:end]) for start, end in zip(starts, ends)]
+    codes, uniques = pd.factorize(np.array(fields, dtype=object))
+    tokens = []
+    for field in uniques:
+        if field[:1] == b'"' and field[-1:] == b'"' and len(field) > 1:
+            field = field[1:-1].replace(b'""', b'"')
+        token = pseudonymiser.pseudonymise_value(field.decode("utf-8"))
+        tokens.append(token.encode("utf-8"))
+    pieces = []
+    copied = 0
+    for start, end, code in zip(starts, ends, codes):
+        pieces.append(data[copied:start].tobytes())
+        pieces.append(tokens[code])
+        copied = end
+    pieces.append(data[copied:].tobytes())
+    return b"".join(pieces)
+
+
+def exact_obfuscate_csv(
+    source, pii_fields, output, block_size=CSV_EXACT_BLOCK_BYTES, pseudonymiser=None
+):
+    """
+    This function will obfuscate csv bytes without parsing them into values,
+    writing an exact copy of the input with only the pii fields replaced by ***.
+    Each block of records is scanned once with numpy for the commas and newlines
+    outside quotes, which give the start and end of every field, and the bytes
+    between pii fields are written straight through with *** spliced in.
+    Quoting, number formats, empty values and line endings are kept as they are.
+    Parameters:
+        - source
+            The csv bytes, any object supporting the buffer protocol,
+            or a readable binary file-like object such as an s3 StreamingBody.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated csv is written to.
+        - block_size
+            The number of bytes scanned at a time, a block grows when it
+            doesn't hold a whole record.
+        - pseudonymiser
+            Optionally a Pseudonymiser to splice in the tokens of the fields instead.
+    Returns:
+        - The number of data rows written to the output, blank lines aren't counted.
+    """
+    read = _source_reader(source)
+    header = b""
+    inside_quotes = False
+    while True:
+        chunk = bytes(read(block_size))
+        header_end, inside_quotes = _scan_record_boundary(chunk, inside_quotes)
+        if header_end is not None or not chunk:
+            break
+        header += chunk
+    if header_end is None:
+        header_end = 0
+    header += chunk[:header_end]
+    pending = chunk[header_end:]
+    names = next(csv.reader(StringIO(header.decode("utf-8-sig"), newline="")), [])
+    if not set(pii_fields).issubset(set(names)):
+        raise TypeError("Failed to find the fields to obfuscate in the csv header")
+    pii_indexes = [names.index(field) for field in pii_fields]
+    mask = OBFUSCATED_STRING.encode("utf-8")
+    output.write(header)
+    row_count = 0
+    while True:
+        chunk = read(block_size)
+        final = len(chunk) == 0
+        block = chunk if not len(pending) else bytes(pending) + bytes(chunk)
+        if not len(block):
+            break
+        spans = _exact_csv_spans(
+            np.frombuffer(block, dtype=np.uint8), pii_indexes, final
+        )
+        if spans["end"] is None:
+            pending = block
+            continue
+        records = np.frombuffer(block, dtype=np.uint8, count=spans["end"])
+        if pseudonymiser is None:
+            obfuscated = _splice_mask(records, spans["starts"], spans["ends"], mask)
+        else:
+            obfuscated = _splice_tokens(
+                records, spans["starts"], spans["ends"], pseudonymiser
+            )
+        output.write(obfuscated)
+        row_count += spans["rows"]
+        pending = memoryview(block)[spans["end"] :]
+        if final:
+            break
+    return row_count
+
+
+def _source_reader(source):
+    """
+    Returns a read(size) function over a readable binary file-like object,
+    or over any object supporting the buffer protocol without copying it.
+    """
+    if hasattr(source, "read"):
+        return source.read
+    view = memoryview(source).cast("B")
+    position = 0
+
+    def read(size):
+        nonlocal position
+        chunk = view[position : position + size]
+        position += len(chunk)
+        return chunk
+
+    return read
+
+
+class _JsonStreamReader:
+    """
+    Reads json values one at a time from a byte stream, keeping only the text
+    of the value being read in memory. Values are decoded with raw_decode,
+    when a value runs past the end of what has been read, at least as much text
+    again as is left unconsumed is read before it's decoded again, so a value
+    of any size is scanned a bounded number of times and reading stays linear.
+    """
+
+    def __init__(self, source, read_size=JSON_STREAM_READ_BYTES):
+        self._read = _source_reader(source)
+        self._read_size = read_size
+        self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._json_decoder = json.JSONDecoder()
+        self._text = ""
+        self._position = 0
+        self._at_end = False
+
+    def _fill(self):
+        # reads chunks into a list and joins them onto the unconsumed text once,
+        # until the unconsumed text has at least doubled
+        wanted = max(self._read_size, len(self._text) - self._position)
+        texts = []
+        size = 0
+        while size < wanted and not self._at_end:
+            chunk = self._read(self._read_size)
+            self._at_end = not len(chunk)
+            try:
+                text = self._text_decoder.decode(chunk, final=self._at_end)
+            except UnicodeDecodeError:
+                raise TypeError("Failed to interpret bytes as json, it is not utf-8")
+            texts.append(text)
+            size += len(text)
+        self._text = self._text[self._position :] + "".join(texts)
+        self._position = 0
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or "" at the end.
+        """
+        while True:
+            match = JSON_WHITESPACE.match(self._text, self._position)
+            self._position = match.end()
+            if self._position < len(self._text) or self._at_end:
+                return self._text[self._position : self._position + 1]
+            self._fill()
+
+    def expect(self, characters):
+        """
+        Consumes the next character, raising TypeError if it isn't one of characters.
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise TypeError(
+                f"Failed to interpret bytes as json, expected one of {characters}"
+            )
+        self._position += 1
+        return character
+
+    def read_value(self):
+        """
+        Returns the next json value and its text as it appears in the stream.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._text, self._position)
+            except json.JSONDecodeError:
+                if self._at_end:
+                    raise TypeError("Failed to interpret bytes as json")
+                self._fill()
+                continue
+            # a number at the end of the text read so far might continue
+            if end == len(self._text) and not self._at_end:
+                self._fill()
+                continue
+            text = self._text[self._position : end]
+            self._position = end
+            return value, text
+
+
+def _masked_json_column(value, pseudonymiser=None):
+    if pseudonymiser is not None and isinstance(value, list):
+        return pseudonymiser.tokens(value)
+    if pseudonymiser is not None and isinstance(value, dict):
+        return dict(zip(value, pseudonymiser.tokens(value.values())))
+    if isinstance(value, list):
+        return [OBFUSCATED_STRING] * len(value)
+    if isinstance(value, dict):
+        return {key: OBFUSCATED_STRING for key in value}
+    return _mask_value(value, pseudonymiser)
+
+
+def stream_obfuscate_json(
+    source, pii_fields, output, read_size=JSON_STREAM_READ_BYTES, pseudonymiser=None
+):
+    """
+    This function will obfuscate a json document one value at a time, writing
+    the output in the same shape as the input with the keys in their original order.
+        - a list of records is read record by record, each record is written
+        with the values of its sensitive keys replaced by ***
+        - an object of columns, either lists or {index: value} objects, is read
+        column by column, sensitive columns have each value replaced by ***
+        and every other column is copied as it appears in the input
+    Field paths are applied with obfuscate_json_path to each record, or to the
+    document for an object of columns, so they start with the column's key.
+    So memory depends on the size of a record or column rather than of the file.
+    Output is collected and written in blocks of JSON_WRITE_BUFFER_BYTES.
+    Parameters:
+        - source
+            The json bytes, any object supporting the buffer protocol,
+            or a readable binary file-like object such as an s3 StreamingBody.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated json is written to.
+        - read_size
+            The number of bytes read from the source at a time.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+    Returns:
+        - The number of records, or of values in the longest column.
+    """
+    reader = _JsonStreamReader(source, read_size=read_size)
+    pii_fields = list(dict.fromkeys(pii_fields))
+    path_roots = {}
+    for field in pii_fields:
+        if is_field_path(field):
+            path_roots.setdefault(_split_field_path(field)[0], []).append(field)
+    found_fields = set()
+    pending = []
+    pending_size = 0
+    row_count = 0
+
+    def write(text):
+        nonlocal pending_size
+        pending.append(text)
+        pending_size += len(text)
+        if pending_size >= JSON_WRITE_BUFFER_BYTES:
+            flush()
+
+    def flush():
+        nonlocal pending_size
+        output.write("".join(pending).encode("utf-8"))
+        pending.clear()
+        pending_size = 0
+
+    opening = reader.expect("[{")
+    write(opening)
+    closing = "]" if opening == "[" else "}"
+    if reader.peek() == closing:
+        reader.expect(closing)
+    else:
+        while True:
+            if opening == "[":
+                record, _ = reader.read_value()
+                if not isinstance(record, dict):
+                    raise TypeError("Failed to interpret json list, it isn't records")
+                found_fields.update(
+                    _obfuscate_json_record(record, pii_fields, pseudonymiser)
+                )
+                write(json.dumps(record, ensure_ascii=False))
+                row_count += 1
+            else:
+                key, key_text = reader.read_value()
+                reader.expect(":")
+                column, column_text = reader.read_value()
+                if key in pii_fields:
+                    found_fields.add(key)
+                    column_text = json.dumps(
+                        _masked_json_column(column, pseudonymiser), ensure_ascii=False
+                    )
+                elif key in path_roots:
+                    holder = {key: column}
+                    masked_paths = [
+                        field
+                        for field in path_roots[key]
+                        if obfuscate_json_path(holder, field, pseudonymiser)
+                    ]
+                    if masked_paths:
+                        found_fields.update(masked_paths)
+                        column_text = json.dumps(holder[key], ensure_ascii=False)
+                write(f"{key_text}: {column_text}")
+                if isinstance(column, (list, dict)):
+                    row_count = max(row_count, len(column))
+            separator = reader.expect("," + closing)
+            if separator == closing:
+                break
+            write(", ")
+    write(closing)
+    if reader.peek():
+        raise TypeError("Failed to interpret bytes as json, data after the document")
+    if found_fields != set(pii_fields):
+        raise TypeError("Failed to find the fields to obfuscate in the json data")
+    flush()
+    return row_count
+
+
+def _ndjson_key_pattern(pii_fields):
+    # a line can only hold a pii key if the key appears in it as json.dumps
+    # writes it, or if one of its strings uses an escape the key could be written with,
+    # field paths need the key of their top level field
+    keys = set()
+    for field in pii_fields:
+        names = [field]
+        if is_field_path(field):
+            names.append(_split_field_path(field)[0])
+            if names[-1] is None:
+                # the path doesn't start from a key, every line has to be parsed
+                return re.compile(rb"[^ \t\r\n]")
+        for name in names:
+            keys.add(json.dumps(name).encode("utf-8"))
+            keys.add(json.dumps(name, ensure_ascii=False).encode("utf-8"))
+    return re.compile(b"|".join(re.escape(key) for key in sorted(keys)) + rb"|\\[u/]")
+
+
+def _obfuscate_ndjson_block(block, pii_fields, key_pattern, pseudonymiser=None):
+    """
+    Obfuscates a block of ndjson lines. Only the lines key_pattern matches are
+    parsed, every other line is copied as it is.
+    Returns:
+        - The obfuscated bytes, the number of records in the block and the set
+        of pii fields found in it.
+    """
+    row_count = block.count(b"\n") + 1 - len(NDJSON_BLANK_LINE.findall(block))
+    found_fields = set()
+    pieces = []
+    copied = 0
+    match = key_pattern.search(block)
+    while match:
+        line_start = block.rfind(b"\n", 0, match.start()) + 1
+        line_end = block.find(b"\n", match.end())
+        if line_end < 0:
+            line_end = len(block)
+        if block[line_end - 1 : line_end] == b"\r":
+            line_end -= 1
+        try:
+            record = json.loads(block[line_start:line_end])
+        except json.JSONDecodeError:
+            raise TypeError("Failed to interpret bytes as ndjson, a line isn't json")
+        if not isinstance(record, dict):
+            raise TypeError("Failed to obfuscate ndjson, a line isn't a json object")
+        fields = _obfuscate_json_record(record, pii_fields, pseudonymiser)
+        if fields:
+            found_fields.update(fields)
+            pieces.append(block[copied:line_start])
+            pieces.append(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+            copied = line_end
+        match = key_pattern.search(block, line_end)
+    pieces.append(block[copied:])
+    return b"".join(pieces), row_count, found_fields
+
+
+def stream_obfuscate_ndjson(
+    source, pii_fields, output, block_size=NDJSON_BLOCK_BYTES, pseudonymiser=None
+):
+    """
+    This function will obfuscate newline delimited json, one json object per line,
+    writing the output line for line with the values of the sensitive keys
+    replaced by ***.
+    The input is read in blocks cut at the last newline. Lines that don't contain
+    any of the sensitive keys, or the first key of a field path, are copied through
+    without being parsed, the others are parsed with json.loads and written back
+    with json.dumps.
+    Blank lines and the line endings are kept.
+    Parameters:
+        - source
+            The ndjson bytes, any object supporting the buffer protocol,
+            or a readable binary file-like object such as an s3 StreamingBody.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated ndjson is written to.
+        - block_size
+            The number of bytes read at a time.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+    Returns:
+        - The number of records written to the output.
+    """
+    read = _source_reader(source)
+    key_pattern = _ndjson_key_pattern(pii_fields)
+    row_count = 0
+    found_fields = set()
+    pending = b""
+    while True:
+        chunk = bytes(read(block_size))
+        if chunk:
+            line_end = chunk.rfind(b"\n") + 1
+            if line_end == 0:
+                pending += chunk
+                continue
+            block = pending + chunk[:line_end]
+            pending = chunk[line_end:]
+        else:
+            block, pending = pending, b""
+        if block:
+            obfuscated, block_rows, block_fields = _obfuscate_ndjson_block(
+                block, pii_fields, key_pattern, pseudonymiser
+            )
+            output.write(obfuscated)
+            row_count += block_rows
+            found_fields.update(block_fields)
+        if not chunk:
+            break
+    if not found_fields.issuperset(pii_fields):
+        raise TypeError("Failed to find the fields to obfuscate in the ndjson data")
+    return row_count
+
+
+def _obfuscate_ndjson_slice(shared_memory_name, start, end, pii_fields, pseudonymiser):
+    # runs in a worker process, like _obfuscate_csv_slice
+    shared = multiprocessing.shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        block = bytes(shared.buf[start:end])
+    finally:
+        shared.close()
+    return _obfuscate_ndjson_block(
+        block, pii_fields, _ndjson_key_pattern(pii_fields), pseudonymiser
+    )
+
+
+def parallel_obfuscate_ndjson(
+    buffer, pii_fields, output, max_workers=None, pseudonymiser=None
+):
+    """
+    This function will obfuscate ndjson bytes on several cores, writing the same
+    bytes to the output as stream_obfuscate_ndjson.
+    The buffer is split at newlines into slices obfuscated by a ProcessPoolExecutor,
+    as in parallel_obfuscate_csv, so it also needs /dev/shm and doesn't work in
+    aws lambda.
+    Parameters:
+        - buffer
+            The ndjson bytes, any object supporting the buffer protocol.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated ndjson is written to.
+        - max_workers
+            The number of worker processes, by default the number of cores.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+    Returns:
+        - The number of records written to the output.
+    """
+    max_workers = max_workers or os.cpu_count()
+    size = len(memoryview(buffer))
+    newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord("\n"))
+    if max_workers < 2 or size < PARALLEL_MIN_BYTES or len(newlines) == 0:
+        return stream_obfuscate_ndjson(
+            buffer, pii_fields, output, pseudonymiser=pseudonymiser
+        )
+    edges = _slice_edges(
+        newlines + 1, 0, size, max_workers * PARALLEL_SLICES_PER_WORKER
+    )
+    row_count = 0
+    found_fields = set()
+    for obfuscated, slice_rows, slice_fields in _map_slices_in_parallel(
+        buffer, edges, _obfuscate_ndjson_slice, (pii_fields, pseudonymiser), max_workers
+    ):
+        output.write(obfuscated)
+        row_count += slice_rows
+        found_fields.update(slice_fields)
+    if not found_fields.issuperset(pii_fields):
+        raise TypeError("Failed to find the fields to obfuscate in the ndjson data")
+    return row_count
+
+
+def stream_obfuscate_parquet(
+    source, pii_fields, output, pseudonymiser=None, typed_mask=None
+):
+    """
+    This function will obfuscate a parquet file one row group at a time,
+    writing each obfuscated row group to the output with an incremental ParquetWriter.
+    Peak memory is about one row group rather than the whole file,
+    and the output keeps the row group layout and compression of the input.
+    Parameters:
+        - source
+            A seekable binary file-like object containing a parquet file,
+            e.g. an S3RangedFile.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated parquet is written to.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+        - typed_mask
+            Optionally "null" or "sentinel" to keep the types of masked number,
+            boolean and temporal columns, see produce_obfuscated_table.
+    Returns:
+        - The number of rows written to the output.
+    """
+    parquet_file = pq.ParquetFile(source)
+    schema = produce_obfuscated_table(
+        parquet_file.schema_arrow.empty_table(), pii_fields, pseudonymiser, typed_mask
+    ).schema
+    metadata = parquet_file.metadata
+    compression = "SNAPPY"
+    if metadata.num_row_groups and metadata.num_columns:
+        compression = metadata.row_group(0).column(0).compression
+        compression = PARQUET_METADATA_COMPRESSIONS.get(compression, compression)
+    row_count = 0
+    with pq.ParquetWriter(
+        output, schema, compression=compression, store_schema=False
+    ) as writer:
+        for row_group_index in range(metadata.num_row_groups):
+            row_group_rows = metadata.row_group(row_group_index).num_rows
+            for batch in parquet_file.iter_batches(
+                batch_size=max(row_group_rows, 1), row_groups=[row_group_index]
+            ):
+                table = pa.Table.from_batches([batch])
+                writer.write_table(
+                    produce_obfuscated_table(
+                        table, pii_fields, pseudonymiser, typed_mask
+                    )
+                )
+                row_count += batch.num_rows
+    return row_count
+
+
+def stream_obfuscate_file(
+    client,
+    bucket_name,
+    file_name,
+    pii_fields,
+    output,
+    chunk_rows=CSV_STREAM_CHUNK_ROWS,
+    parquet_passthrough=False,
+    engine="pandas",
+    output_compression="same",
+    compression_level=None,
+    pseudonymiser=None,
+    typed_mask=None,
+):
+    """
+    This function will obfuscate an s3 file without downloading all of it first.
+    The format is detected from the first bytes of the object,
+    csv files are streamed with stream_obfuscate_csv, json files with
+    stream_obfuscate_json and parquet files are read with ranged requests
+    through an S3RangedFile.
+    Compressed files are decompressed by a DecompressingReader as they are
+    streamed, except parquet which is decompressed into memory first.
+    Parameters:
+        - client
+            A boto3 s3 client connection.
+        - bucket_name, file_name
+            Strings naming the object's bucket and key.
+        - pii_fields
+            A list of fields containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated file is written to.
+        - chunk_rows
+            The number of csv rows parsed and obfuscated at a time.
+        - parquet_passthrough
+            Rewrite parquet with rewrite_parquet_passthrough instead of re-encoding
+            every row group.
+        - engine
+            "exact" streams csv through exact_obfuscate_csv instead.
+        - output_compression, compression_level
+            How the output is compressed, see resolve_output_compression.
+        - pseudonymiser
+            Optionally a Pseudonymiser to replace the values with their tokens.
+        - typed_mask
+            Optionally "null" or "sentinel" to keep the types of masked parquet
+            columns, see produce_obfuscated_table.
+    Returns:
+        - A dictionary containing the fields:
+            - format
+                the format of the input as identified by this function
+            - row_count
+                the number of rows written to the output
+            - compression
+                the compression of the input, or None
+    """
+    if parquet_passthrough and pseudonymiser is not None:
+        raise ValueError("parquet_passthrough can't be used to pseudonymise")
+    _check_typed_mask(typed_mask)
+    source = S3RangedFile(client, bucket_name, file_name)
+    head = source.read(FORMAT_SNIFF_BYTES)
+    compression = detect_compression(head, source.content_encoding)
+    body = None
+    tail = b""
+    if compression is not None:
+        body = io.BufferedReader(
+            DecompressingReader(
+                get_file_stream_from_bucket(
+                    bucket_name=bucket_name, file_name=file_name, client=client
+                ),
+                compression,
+            ),
+            COMPRESSION_CHUNK_BYTES,
+        )
+        head = body.peek(FORMAT_SNIFF_BYTES)[:FORMAT_SNIFF_BYTES]
+    elif head.startswith(PARQUET_MAGIC):
+        source.seek(-len(PARQUET_MAGIC), io.SEEK_END)
+        tail = source.read(len(PARQUET_MAGIC))
+    found_format = detect_format(
+        head=head,
+        tail=tail,
+        key_name=strip_compression_extension(file_name),
+        content_type=source.content_type,
+    )
+    source.seek(0)
+    if found_format == "parquet" and body is not None:
+        # parquet is read footer first, so it can't be decompressed as it's read
+        source = BytesIO(body.read())
+    elif body is None and found_format != "parquet":
+        body = get_file_stream_from_bucket(
+            bucket_name=bucket_name, file_name=file_name, client=client
+        )
+    with compressed_output(
+        output,
+        resolve_output_compression(output_compression, compression),
+        compression_level,
+    ) as output:
+        if found_format == "parquet" and parquet_passthrough:
+            row_count = rewrite_parquet_passthrough(source, pii_fields, output)
+        elif found_format == "parquet":
+            row_count = stream_obfuscate_parquet(
+                source,
+                pii_fields,
+                output,
+                pseudonymiser=pseudonymiser,
+                typed_mask=typed_mask,
+            )
+        elif found_format == "csv" and engine == "exact":
+            row_count = exact_obfuscate_csv(
+                body, pii_fields, output, pseudonymiser=pseudonymiser
+            )
+        elif found_format == "csv":
+            row_count = stream_obfuscate_csv(
+                body,
+                pii_fields,
+                output,
+                chunk_rows=chunk_rows,
+                pseudonymiser=pseudonymiser,
+            )
+        elif found_format == "json":
+            row_count = stream_obfuscate_json(
+                body, pii_fields, output, pseudonymiser=pseudonymiser
+            )
+        elif found_format == "ndjson":
+            row_count = stream_obfuscate_ndjson(
+                body, pii_fields, output, pseudonymiser=pseudonymiser
+            )
+        else:
+            raise UnsupportedFormatError(
+                f"Streaming is not supported for {found_format} files"
+            )
+    return {"format": found_format, "row_count": row_count, "compression": compression}
+
+
+def _starts_with_json_lines(head):
+    # true when the first json value of the head is complete and followed by a
+    # newline and another object, a first line longer than the head needs a hint
+    try:
+        text = codecs.getincrementaldecoder("utf-8")().decode(head)
+        first_end = json.JSONDecoder().raw_decode(text, len(text) - len(text.lstrip()))[
+            1
+        ]
+    except ValueError:
+        return False
+    return NDJSON_LINE_START.match(text, first_end) is not None
+
+
+class UnsupportedFormatError(TypeError):
+    """
+    Raised for files whose format can't be obfuscated, so they can be skipped
+    when a whole prefix is obfuscated.
+    """
+
+
+def detect_format(head, tail=b"", key_name=None, content_type=None):
+    """
+    This function will identify the format of a dataset from its first and last bytes,
+    without parsing it.
+        - parquet files start and end with the magic bytes "PAR1"
+        - json files start with "[" or "{"
+        - ndjson files start with a json object followed by a newline and
+        another "{", or have an ndjson hint
+        - anything else with a readable header line is treated as csv
+    The s3 key extension and ContentType can be given as hints. A csv hint
+    overrides a header that happens to start with "[" or "{", and a hint decides
+    the format of an empty file. The parquet magic bytes always win.
+
+    Parameters:
+        - head
+            The first bytes of the file, FORMAT_SNIFF_BYTES is enough.
+        - tail
+            The last bytes of the file, used to confirm the parquet footer magic.
+        - key_name
+            Optional s3 key of the file, its extension is used as a hint.
+        - content_type
+            Optional ContentType from the s3 GetObject response, used as a hint.
+    Returns:
+        - "csv", "json", "ndjson" or "parquet"
+    """
+    hint = None
+    if content_type:
+        hint = FORMAT_CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+    if hint is None and key_name:
+        for extension, extension_format in FORMAT_EXTENSIONS.items():
+            if key_name.lower().endswith(extension):
+                hint = extension_format
+    if head[: len(PARQUET_MAGIC)] == PARQUET_MAGIC:
+        if not tail or tail[-len(PARQUET_MAGIC) :] == PARQUET_MAGIC:
+            return "parquet"
+        raise TypeError("Failed to interpret bytes as parquet, footer is missing")
+    text_head = head[len(UTF8_BOM) :] if head.startswith(UTF8_BOM) else head
+    first_char = text_head.lstrip()[:1]
+    if first_char == b"{" and hint != "csv":
+        if hint == "ndjson" or _starts_with_json_lines(text_head):
+            return "ndjson"
+        return "json"
+    if first_char == b"[" and hint != "csv":
+        return "json"
+    header_bytes, newline, _ = text_head.partition(b"\n")
+    try:
+        # a header cut off by the end of the head may end part way through a character
+        header_line = codecs.getincrementaldecoder("utf-8")().decode(
+            header_bytes, final=bool(newline)
+        )
+    except UnicodeDecodeError:
+        raise UnsupportedFormatError(
+            "Failed to interpret bytes as csv, header is not utf-8"
+        )
+    if header_line.strip():
+        return "csv"
+    if hint in ("csv", "json", "ndjson"):
+        return hint
+    raise UnsupportedFormatError("Failed to identify the format of the file")
+
+
+def convert_bytestream_to_df(formatted_bytes, fields, file_format=None):
+    """
+    This function will identify the format convention of a bytestream representing a dataset. 
+    The function will then convert this bytestream into a pandas dataframe.
+    It will work if the format is valid csv, json, ndjson or parquet.
+    The format is decided by detect_format, so the bytes are only parsed once.
+    csv, ndjson and parquet are read through a MemoryviewReader,
+    so the bytes aren't copied before they're parsed.
+
+    Parameters:
+        - formatted_bytes
+            A bytestream formatted with csv, json, or parquet.
+        - fields
+            The list of fields to obfuscate. Used as a tool to validate the format of the string
+        - file_format
+            Optional format of the bytestream if it is already known,
+            it is detected from the bytes when not given.
+    Return:
+        - A dictionary containing the fields:
+            - df
+                the data frame converted from the input
+            - format
+                the format of the input as identified by this function
+    """
+    if file_format is None:
+        file_format = detect_format(
+            head=formatted_bytes[:FORMAT_SNIFF_BYTES],
+            tail=formatted_bytes[-len(PARQUET_MAGIC) :],
+        )
+    if file_format == "json":
+        df = pd.DataFrame.from_dict(json.loads(formatted_bytes))
+    elif file_format in ("parquet", "ndjson", "csv"):
+        with MemoryviewReader(formatted_bytes) as source:
+            if file_format == "parquet":
+                df = pd.read_parquet(source)
+            elif file_format == "ndjson":
+                df = pd.read_json(source, lines=True, dtype=False, convert_dates=False)
+            else:
+                df = pd.read_csv(source, sep=",", header=0)
+    else:
+        raise TypeError(f"Unsupported format {file_format}")
+    if not _has_fields(fields, df.columns.values.tolist()):
+        raise TypeError(
+            f"Failed to find the fields to obfuscate in the {file_format} data"
+        )
+    return {"df": df, "format": file_format}
+
+
+def convert_bytestream_to_table(formatted_bytes, fields, file_format):
+    """
+    This function will convert a bytestream into a pyarrow Table,
+    without going through pandas.
+    csv and parquet are read with pyarrow.csv and pyarrow.parquet.
+    pyarrow.json only reads newline delimited json, so ndjson is read with it
+    and json documents are loaded with json.loads and built into a Table from
+    their records or lists.
+    csv, ndjson and parquet are read through a MemoryviewReader rather than a
+    pa.BufferReader, so pyarrow copies the blocks it reads into its own buffers
+    and no view of the bytes outlives the read, a Table read from a parquet
+    pa.BufferReader can be a view of the bytes, and pyarrow's reader threads
+    let go of the blocks they read some time after the read returns.
+
+    Parameters:
+        - formatted_bytes
+            A bytestream formatted with csv, json, or parquet.
+        - fields
+            The list of fields to obfuscate, they must all be columns of the table.
+        - file_format
+            The format of the bytestream, "csv", "json", "ndjson" or "parquet".
+    Return:
+        - A dictionary containing the fields:
+            - table
+                the Table converted from the input
+            - format
+                the format of the input
+            - json_orient
+                "records" for a json list of records, "list" for a json
+                object of column lists, None for other formats
+    """
+    json_orient = None
+    if file_format == "json":
+        document = json.loads(formatted_bytes)
+        if isinstance(document, list):
+            table = pa.Table.from_pylist(document)
+            json_orient = "records"
+        else:
+            table = pa.Table.from_pydict(document)
+            json_orient = "list"
+    elif file_format in ("parquet", "csv", "ndjson"):
+        with MemoryviewReader(formatted_bytes) as source:
+            if file_format == "parquet":
+                table = pq.read_table(source)
+            elif file_format == "csv":
+                table = pa_csv.read_csv(source)
+            else:
+                table = pa_json.read_json(source)
+    else:
+        raise TypeError(f"Unsupported format {file_format}")
+    if not _has_fields(fields, table.column_names):
+        raise TypeError(
+            f"Failed to find the fields to obfuscate in the {file_format} data"
+        )
+    return {"table": table, "format": file_format, "json_orient": json_orient}
+
+
+def _write_json_items(output, items):
+    # writes what json.dumps writes for a dictionary of the items, one item at a time
+    output.write(b"{")
+    for position, (key, value) in enumerate(items):
+        if position:
+            output.write(b", ")
+        output.write(json.dumps({key: value})[1:-1].encode("utf-8"))
+    output.write(b"}")
+
+
+def _write_json_records(output, record_batches):
+    # writes what json.dumps writes for the list of records, one batch at a time
+    output.write(b"[")
+    written = False
+    for records in record_batches:
+        if not records:
+            continue
+        if written:
+            output.write(b", ")
+        output.write(json.dumps(records)[1:-1].encode("utf-8"))
+        written = True
+    output.write(b"]")
+
+
+def write_table_to_formatted_output(table, format, output, json_orient="records"):
+    """
+    This function will write a pyarrow Table in a desired format into the output,
+    without building the whole formatted file first.
+    csv and parquet are written into the output by pyarrow, json is written
+    one column or WRITE_CHUNK_ROWS records at a time and ndjson
+    WRITE_CHUNK_ROWS lines at a time.
+    Parquet is written without the arrow schema so the obfuscated dictionary
+    columns read back as plain strings, the pandas metadata is kept.
+
+    Parameters:
+        - table
+            A pyarrow Table of the dataset to write.
+        - format
+            The desired format.
+            Must be "csv", "json", "ndjson" or "parquet"
+        - output
+            A writable binary file-like object the formatted table is written to.
+        - json_orient
+            "records" to write json as a list of records,
+            "list" to write it as an object of column lists.
+    """
+    if format == "csv":
+        pa_csv.write_csv(table, output)
+    elif format == "json":
+        if json_orient == "list":
+            _write_json_items(
+                output,
+                (
+                    (name, column.to_pylist())
+                    for name, column in zip(table.column_names, table.columns)
+                ),
+            )
+        else:
+            _write_json_records(
+                output,
+                (
+                    table.slice(start, WRITE_CHUNK_ROWS).to_pylist()
+                    for start in range(0, table.num_rows, WRITE_CHUNK_ROWS)
+                ),
+            )
+    elif format == "ndjson":
+        for start in range(0, table.num_rows, WRITE_CHUNK_ROWS):
+            records = table.slice(start, WRITE_CHUNK_ROWS).to_pylist()
+            lines = [json.dumps(record) + "\n" for record in records]
+            output.write("".join(lines).encode("utf-8"))
+    elif format == "parquet":
+        pq.write_table(table, output, store_schema=False)
+    else:
+        raise TypeError(f"Unsupported format {format}")
+
+
+def convert_table_to_formatted_bytestream(table, format, json_orient="records"):
+    """
+    This function will convert a pyarrow Table to a bytestream of a desired format.
+
+    Parameters:
+        - table
+            A pyarrow Table of the dataset to convert into a formatted string.
+        - format
+            The desired format.
+            Must be "csv", "json", "ndjson" or "parquet"
+        - json_orient
+            "records" to write json as a list of records,
+            "list" to write it as an object of column lists.
+
+    Returns:
+        - A formatted bytestream convertion of the table.
+    """
+    output = BytesIO()
+    write_table_to_formatted_output(table, format, output, json_orient=json_orient)
+    return output.getvalue()
+
+
+def write_df_to_formatted_output(df, format, output):
+    """
+    This function will write a dataframe in a desired format into the output,
+    without building the whole formatted file first.
+    csv and parquet are written into the output by pandas, a chunk at a time for
+    csv, json is written one column at a time and ndjson WRITE_CHUNK_ROWS
+    lines at a time. Masked columns are written to parquet as strings rather
+    than as categoricals, so the output schema is the same with every engine.
+
+    Parameters:
+        - df
+            A dataframe of the dataset to write.
+        - format
+            The desired format.
+            Must be "csv", "json", "ndjson" or "parquet"
+        - output
+            A writable binary file-like object the formatted dataframe is written to.
+    """
+    if format == "csv":
+        df.to_csv(output, index=False)
+    elif format == "json":
+        _write_json_items(
+            output, ((column, df[column].to_dict()) for column in df.columns)
+        )
+    elif format == "ndjson":
+        # an empty dataframe is still written once, pandas writes it as a newline
+        for start in range(0, max(len(df), 1), WRITE_CHUNK_ROWS):
+            lines = df.iloc[start : start + WRITE_CHUNK_ROWS].to_json(
+                orient="records", lines=True, force_ascii=False
+            )
+            output.write(lines.encode("utf-8"))
+    elif format == "parquet":
+        # masked categoricals are written as plain string columns, as the arrow
+        # engine writes them, pyarrow still gives them a one value dictionary page
+        df = pd.DataFrame(
+            {
+                name: (
+                    df[name].astype(object)
+                    if _is_masked_category(df[name])
+                    else df[name]
+                )
+                for name in df.columns
+            },
+            index=df.index,
+            copy=False,
+        )
+        df.to_parquet(output)
+    else:
+        raise TypeError(f"Unsupported format {format}")
+
+
+def convert_df_to_formatted_bytestream(df, format):
+    """
+    This function will convert a dataframe to a bytestream of a desired format.
+
+    Parameters:
+        - df
+            A dataframe of the dataset to convert into a formatted string.
+        - format
+            The desired format.
+            Must be "csv", "json", "ndjson" or "parquet"
+
+    Returns:
+        - A formatted bytestream convertion of the dataframe.
+    """
+    output = BytesIO()
+    write_df_to_formatted_output(df, format, output)
+    return output.getvalue()
+
+
+def _read_thrift_varint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _read_thrift_value(buffer, position, value_type):
+    if value_type in (THRIFT_TRUE, THRIFT_FALSE):
+        return value_type == THRIFT_TRUE, position
+    if value_type == THRIFT_BYTE:
+        return buffer[position], position + 1
+    if value_type in (THRIFT_I16, THRIFT_I32, THRIFT_I64):
+        zigzag, position = _read_thrift_varint(buffer, position)
+        return (zigzag >> 1) ^ -(zigzag & 1), position
+    if value_type == THRIFT_DOUBLE:
+        return bytes(buffer[position : position + 8]), position + 8
+    if value_type == THRIFT_BINARY:
+        length, position = _read_thrift_varint(buffer, position)
+        return bytes(buffer[position : position + length]), position + length
+    if value_type in (THRIFT_LIST, THRIFT_SET):
+        header = buffer[position]
+        position += 1
+        size = header >> 4
+        element_type = header & 0x0F
+        if size == 15:
+            size, position = _read_thrift_varint(buffer, position)
+        elements = []
+        for _ in range(size):
+            if element_type in (THRIFT_TRUE, THRIFT_FALSE):
+                element = buffer[position] == THRIFT_TRUE
+                position += 1
+            else:
+                element, position = _read_thrift_value(buffer, position, element_type)
+            elements.append(element)
+        return (element_type, elements), position
+    if value_type == THRIFT_STRUCT:
+        return _read_thrift_struct(buffer, position)
+    raise TypeError(f"Unsupported thrift type {value_type} in parquet metadata")
+
+
+def _read_thrift_struct(buffer, position):
+    """
+    Decodes a thrift compact protocol struct into a dictionary of
+    {field id: (thrift type, value)}, nested structs are decoded the same way
+    and lists become (element type, [values]).
+    """
+    struct = {}
+    field_id = 0
+    while True:
+        header = buffer[position]
+        position += 1
+        value_type = header & 0x0F
+        if value_type == THRIFT_STOP:
+            return struct, position
+        delta = header >> 4
+        if delta:
+            field_id += delta
+        else:
+            zigzag, position = _read_thrift_varint(buffer, position)
+            field_id = (zigzag >> 1) ^ -(zigzag & 1)
+        value, position = _read_thrift_value(buffer, position, value_type)
+        struct[field_id] = (value_type, value)
+
+
+def _write_thrift_varint(output, value):
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def _write_thrift_value(output, value_type, value):
+    if value_type == THRIFT_BYTE:
+        output.append(value & 0xFF)
+    elif value_type in (THRIFT_I16, THRIFT_I32, THRIFT_I64):
+        _write_thrift_varint(output, (value << 1) ^ (value >> 63))
+    elif value_type == THRIFT_DOUBLE:
+        output += value
+    elif value_type == THRIFT_BINARY:
+        _write_thrift_varint(output, len(value))
+        output += value
+    elif value_type in (THRIFT_LIST, THRIFT_SET):
+        element_type, elements = value
+        if len(elements) < 15:
+            output.append((len(elements) << 4) | element_type)
+        else:
+            output.append(0xF0 | element_type)
+            _write_thrift_varint(output, len(elements))
+        for element in elements:
+            if element_type in (THRIFT_TRUE, THRIFT_FALSE):
+                output.append(THRIFT_TRUE if element else THRIFT_FALSE)
+            else:
+                _write_thrift_value(output, element_type, element)
+    elif value_type == THRIFT_STRUCT:
+        _write_thrift_struct(output, value)
+    else:
+        raise TypeError(f"Unsupported thrift type {value_type} in parquet metadata")
+
+
+def _write_thrift_struct(output, struct):
+    """
+    Encodes a dictionary produced by _read_thrift_struct back into
+    thrift compact protocol bytes, appending them to the output bytearray.
+    """
+    last_field_id = 0
+    for field_id in sorted(struct):
+        value_type, value = struct[field_id]
+        if value_type in (THRIFT_TRUE, THRIFT_FALSE):
+            value_type = THRIFT_TRUE if value else THRIFT_FALSE
+        delta = field_id - last_field_id
+        if 0 < delta <= 15:
+            output.append((delta << 4) | value_type)
+        else:
+            output.append(value_type)
+            _write_thrift_varint(output, (field_id << 1) ^ (field_id >> 63))
+        if value_type not in (THRIFT_TRUE, THRIFT_FALSE):
+            _write_thrift_value(output, value_type, value)
+        last_field_id = field_id
+    output.append(THRIFT_STOP)
+
+
+def _thrift_field(struct, field_id):
+    """
+    Returns the value of a field of a decoded thrift struct,
+    for lists only the elements are returned.
+    """
+    value_type, value = struct[field_id]
+    if value_type in (THRIFT_LIST, THRIFT_SET):
+        return value[1]
+    return value
+
+
+def _parquet_column_name(column_metadata):
+    return _thrift_field(column_metadata, PARQUET_COLUMN_PATH)[0].decode("utf-8")
+
+
+def read_parquet_footer(source):
+    """
+    This function will read and decode the footer metadata of a parquet file.
+
+    Parameters:
+        - source
+            A seekable binary file-like object containing a parquet file.
+    Returns:
+        - The decoded thrift FileMetaData, as returned by _read_thrift_struct.
+    """
+    source.seek(-8, 2)
+    tail = source.read(8)
+    if tail[4:] != PARQUET_MAGIC:
+        raise TypeError("Failed to interpret bytes as parquet, footer is missing")
+    footer_length = int.from_bytes(tail[:4], "little")
+    source.seek(-8 - footer_length, 2)
+    file_metadata, _ = _read_thrift_struct(source.read(footer_length), 0)
+    return file_metadata
+
+
+def _column_chunk_range(column_metadata):
+    """
+    Returns the (start, length) of a column chunk's pages in the file.
+    """
+    start = _thrift_field(column_metadata, PARQUET_COLUMN_DATA_PAGE_OFFSET)
+    if PARQUET_COLUMN_DICTIONARY_PAGE_OFFSET in column_metadata:
+        dictionary_page_offset = _thrift_field(
+            column_metadata, PARQUET_COLUMN_DICTIONARY_PAGE_OFFSET
+        )
+        if 0 < dictionary_page_offset < start:
+            start = dictionary_page_offset
+    return start, _thrift_field(column_metadata, PARQUET_COLUMN_TOTAL_COMPRESSED_SIZE)
+
+
+def _shift_column_offsets(column_metadata, delta):
+    for offset_field in (
+        PARQUET_COLUMN_DATA_PAGE_OFFSET,
+        PARQUET_COLUMN_INDEX_PAGE_OFFSET,
+        PARQUET_COLUMN_DICTIONARY_PAGE_OFFSET,
+    ):
+        if offset_field in column_metadata:
+            value_type, offset = column_metadata[offset_field]
+            column_metadata[offset_field] = (value_type, offset + delta)
+
+
+def _masked_parquet_array(field, num_rows):
+    """
+    Builds the replacement for a sensitive parquet column, keeping its arrow type
+    so the file schema does not change.
+    String and binary columns become "***", other types become nulls.
+    """
+    if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+        dictionary = pa.array([OBFUSCATED_STRING], type=field.type)
+    elif pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type):
+        dictionary = pa.array([OBFUSCATED_STRING.encode("utf-8")], type=field.type)
+    elif field.nullable:
+        return pa.nulls(num_rows, type=field.type)
+    else:
+        raise TypeError(
+            f"Failed to obfuscate required {field.type} column {field.name}"
+            " in place, use the arrow engine instead"
+        )
+    return pa.DictionaryArray.from_arrays(
+        pa.repeat(pa.scalar(0, pa.int8()), num_rows), dictionary
+    )
+
+
+def _copy_file_range(source, output, start, length):
+    source.seek(start)
+    while length > 0:
+        block = source.read(min(length, PARQUET_COPY_BLOCK_BYTES))
+        if not block:
+            raise TypeError("Failed to read parquet column chunk, file is truncated")
+        output.write(block)
+        length -= len(block)
+
+
+def rewrite_parquet_passthrough(source, pii_fields, output):
+    """
+    This function will obfuscate a parquet file by rewriting only the column chunks
+    of the sensitive columns. Every other column chunk is copied byte for byte,
+    so the row group layout, compression, encodings and schema metadata
+    of the input are preserved.
+    The new chunks are written without statistics, and the statistics and bloom
+    filters of the sensitive columns are dropped from the footer, so nothing about
+    the original values leaks. The statistics of the copied chunks are kept and
+    their bloom filters are copied after the row groups, so readers can still
+    prune on them. Page indexes are dropped, their offsets no longer hold.
+    The new chunks keep the physical type of the chunks they replace, a column
+    whose type arrow can't write back, such as a decimal stored as an integer,
+    raises a TypeError before any chunk of it is written.
+    Sensitive string columns are replaced with "***", other types with nulls.
+
+    Parameters:
+        - source
+            A seekable binary file-like object containing a parquet file.
+        - pii_fields
+            A list of top level columns containing the data to be obfuscated.
+        - output
+            A writable binary file-like object the obfuscated parquet is written to.
+    Returns:
+        - The number of rows in the file.
+    """
+    file_metadata = read_parquet_footer(source)
+    if PARQUET_FILE_ENCRYPTION_ALGORITHM in file_metadata:
+        raise TypeError("Failed to rewrite parquet, encrypted files are not supported")
+    source.seek(0)
+    arrow_schema = pq.ParquetFile(source).schema_arrow
+    missing_fields = set(pii_fields) - set(arrow_schema.names)
+    if missing_fields:
+        raise TypeError(
+            f"Failed to find the fields {sorted(missing_fields)} in the parquet data"
+        )
+    pii_arrow_fields = [arrow_schema.field(name) for name in pii_fields]
+    for field in pii_arrow_fields:
+        if pa.types.is_nested(field.type):
+            raise TypeError(
+                f"Failed to obfuscate nested column {field.name} in place,"
+                " use the arrow engine instead"
+            )
+
+    output.write(PARQUET_MAGIC)
+    position = len(PARQUET_MAGIC)
+    bloom_filters = []
+    for row_group in _thrift_field(file_metadata, PARQUET_FILE_ROW_GROUPS):
+        num_rows = _thrift_field(row_group, PARQUET_ROW_GROUP_NUM_ROWS)
+        column_chunks = _thrift_field(row_group, PARQUET_ROW_GROUP_COLUMNS)
+        compressions = {}
+        physical_types = {}
+        for column_chunk in column_chunks:
+            column_metadata = _thrift_field(column_chunk, PARQUET_CHUNK_METADATA)
+            name = _parquet_column_name(column_metadata)
+            if name in pii_fields:
+                codec = _thrift_field(column_metadata, PARQUET_COLUMN_CODEC)
+                compressions[name] = PARQUET_CODECS[codec]
+                physical_types[name] = _thrift_field(
+                    column_metadata, PARQUET_COLUMN_TYPE
+                )
+        masked_sink = pa.BufferOutputStream()
+        pq.write_table(
+            pa.Table.from_arrays(
+                [_masked_parquet_array(field, num_rows) for field in pii_arrow_fields],
+                schema=pa.schema(pii_arrow_fields),
+            ),
+            masked_sink,
+            row_group_size=max(num_rows, 1),
+            compression=compressions,
+            write_statistics=False,
+            store_schema=False,
+            # arrow reads INT96 columns as timestamps and writes them as INT64
+            # unless asked, the spliced chunks must keep the type in the schema
+            use_deprecated_int96_timestamps=PARQUET_TYPE_INT96
+            in physical_types.values(),
+        )
+        masked_source = pa.BufferReader(masked_sink.getvalue())
+        masked_row_group = _thrift_field(
+            read_parquet_footer(masked_source), PARQUET_FILE_ROW_GROUPS
+        )[0]
+        masked_chunks = {}
+        for masked_chunk in _thrift_field(masked_row_group, PARQUET_ROW_GROUP_COLUMNS):
+            masked_metadata = _thrift_field(masked_chunk, PARQUET_CHUNK_METADATA)
+            name = _parquet_column_name(masked_metadata)
+            if _thrift_field(masked_metadata, PARQUET_COLUMN_TYPE) != (
+                physical_types[name]
+            ):
+                raise TypeError(
+                    f"Failed to obfuscate column {name} in place, its physical type"
+                    " can't be rewritten, use the arrow engine instead"
+                )
+            masked_chunks[name] = masked_metadata
+
+        row_group_start = position
+        total_byte_size = 0
+        for column_chunk in column_chunks:
+            column_metadata = _thrift_field(column_chunk, PARQUET_CHUNK_METADATA)
+            name = _parquet_column_name(column_metadata)
+            if name in pii_fields:
+                column_metadata = masked_chunks[name]
+                chunk_source = masked_source
+            else:
+                chunk_source = source
+            start, length = _column_chunk_range(column_metadata)
+            _copy_file_range(chunk_source, output, start, length)
+            _shift_column_offsets(column_metadata, position - start)
+            if name in pii_fields:
+                for dropped_field in (
+                    PARQUET_COLUMN_STATISTICS,
+                    PARQUET_COLUMN_BLOOM_FILTER_OFFSET,
+                    PARQUET_COLUMN_BLOOM_FILTER_LENGTH,
+                    PARQUET_COLUMN_SIZE_STATISTICS,
+                ):
+                    column_metadata.pop(dropped_field, None)
+            elif PARQUET_COLUMN_BLOOM_FILTER_OFFSET in column_metadata:
+                if PARQUET_COLUMN_BLOOM_FILTER_LENGTH in column_metadata:
+                    bloom_filters.append(column_metadata)
+                else:
+                    # without its length the filter can't be copied
+                    column_metadata.pop(PARQUET_COLUMN_BLOOM_FILTER_OFFSET)
+            column_chunk[PARQUET_CHUNK_METADATA] = (THRIFT_STRUCT, column_metadata)
+            column_chunk[PARQUET_CHUNK_FILE_OFFSET] = (THRIFT_I64, position)
+            for dropped_field in PARQUET_CHUNK_PAGE_INDEX_FIELDS:
+                column_chunk.pop(dropped_field, None)
+            total_byte_size += _thrift_field(
+                column_metadata, PARQUET_COLUMN_TOTAL_UNCOMPRESSED_SIZE
+            )
+            position += length
+        row_group[PARQUET_ROW_GROUP_TOTAL_BYTE_SIZE] = (THRIFT_I64, total_byte_size)
+        row_group[PARQUET_ROW_GROUP_FILE_OFFSET] = (THRIFT_I64, row_group_start)
+        row_group[PARQUET_ROW_GROUP_TOTAL_COMPRESSED_SIZE] = (
+            THRIFT_I64,
+            position - row_group_start,
+        )
+
+    # the bloom filters of the copied chunks follow the row groups, as the
+    # parquet writers put them
+    for column_metadata in bloom_filters:
+        value_type, start = column_metadata[PARQUET_COLUMN_BLOOM_FILTER_OFFSET]
+        length = _thrift_field(column_metadata, PARQUET_COLUMN_BLOOM_FILTER_LENGTH)
+        _copy_file_range(source, output, start, length)
+        column_metadata[PARQUET_COLUMN_BLOOM_FILTER_OFFSET] = (value_type, position)
+        position += length
+
+    footer = bytearray()
+    _write_thrift_struct(footer, file_metadata)
+    output.write(footer)
+    output.write(len(footer).to_bytes(4, "little"))
+    output.write(PARQUET_MAGIC)
+    return _thrift_field(file_metadata, PARQUET_FILE_NUM_ROWS)
+
+
+try:
+    from snapshot_restore_py import register_after_restore
+except ImportError:
+    register_after_restore = None
+if register_after_restore is not None:
+    register_after_restore(refresh_after_restore)
+if priming_enabled_by_environment():
+    prime()
@@ -25,6 +25,7 @@ data "aws_iam_policy_document" "s3_document" {
 
     actions = ["s3:PutObject",
                "s3:GetObject",
+               "s3:AbortMultipartUpload",
                "s3:CreateBucket",
                "s3:DeleteObject",
                "s3:DeleteBucket",
@@ -47,3 +48,24 @@ resource "aws_iam_role_policy_attachment" "lambda_s3_policy_attachment" {
     role = aws_iam_role.lambda_role.name
     policy_arn = aws_iam_policy.s3_policy.arn
 }
+
+data "aws_iam_policy_document" "fan_out_document" {
+  statement {
+
+    actions = ["lambda:InvokeFunction"]
+
+    resources = [
+      aws_lambda_function.obfuscator_lambda.arn,
+    ]
+  }
+}
+
+resource "aws_iam_policy" "fan_out_policy" {
+    name_prefix = "fan-out-policy-obfuscator_lambda"
+    policy = data.aws_iam_policy_document.fan_out_document.json
+}
+
+resource "aws_iam_role_policy_attachment" "lambda_fan_out_policy_attachment" {
+    role = aws_iam_role.lambda_role.name
+    policy_arn = aws_iam_policy.fan_out_policy.arn
+}
@@ -8,7 +8,8 @@ data "archive_file" "obfuscator_lambda_file" {
 data "archive_file" "dependencies" {
   type = "zip"
   output_file_mode = "0666"
-  source_dir = "../dependency_layer"
+  # built by "make build-layer", see scripts/build_layer.py
+  source_dir = "../build/layer"
   output_path = "../python.zip"
 }
 
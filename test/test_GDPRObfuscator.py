@@ -1,11 +1,25 @@
+import botocore.client
 import botocore.session
+import bz2
+import gzip
+import lzma
 import pytest
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from src.GDPRObfuscator_handler import *
+from src.GDPRObfuscator_handler import _scan_record_boundary, _write_thrift_struct
+from src.GDPRObfuscator_handler import _parquet_column_name, _thrift_field
 import boto3
 from unittest.mock import Mock, patch, MagicMock
 from moto import mock_aws
 import os
+import pickle
+import subprocess
+import sys
+import time
+import io
 from io import StringIO, BytesIO
 import botocore.errorfactory
 
@@ -47,6 +61,53 @@ class TestInitS3Client:
             init_s3_client()
 
 
+class TestS3ClientRegistry:
+    @pytest.fixture(autouse=True)
+    def clean_registry(self):
+        reset_s3_clients()
+        yield
+        reset_s3_clients()
+
+    @patch("src.GDPRObfuscator_handler.init_s3_client")
+    def test_client_is_reused_for_same_region_and_profile(self, mocked_init):
+        mocked_init.side_effect = lambda **kwargs: MagicMock()
+        first = get_s3_client(region_name="eu-west-2")
+        second = get_s3_client(region_name="eu-west-2")
+        other_region = get_s3_client(region_name="us-east-1")
+        other_profile = get_s3_client(region_name="eu-west-2", profile="other")
+        assert first is second
+        assert other_region is not first
+        assert other_profile is not first
+        assert mocked_init.call_count == 3
+
+    @patch("src.GDPRObfuscator_handler.init_s3_client")
+    def test_client_uses_pool_settings(self, mocked_init):
+        get_s3_client(region_name="eu-west-2")
+        config = mocked_init.call_args.kwargs["config"]
+        assert config.max_pool_connections == S3_POOL_SETTINGS["max_pool_connections"]
+        assert config.tcp_keepalive == S3_POOL_SETTINGS["tcp_keepalive"]
+
+    def test_bucket_region_is_looked_up_once(self, mock_s3_client):
+        boto3.client("s3", region_name="us-east-1").create_bucket(
+            Bucket="test-bucket-in-virginia"
+        )
+        with patch.object(
+            get_s3_client(), "head_bucket", wraps=get_s3_client().head_bucket
+        ) as mocked_head_bucket:
+            assert get_bucket_region("test-bucket-in-virginia") == "us-east-1"
+            assert get_bucket_region("test-bucket-in-virginia") == "us-east-1"
+        assert mocked_head_bucket.call_count == 1
+
+    def test_client_for_bucket_is_in_bucket_region(self, mock_s3_client):
+        boto3.client("s3", region_name="eu-west-1").create_bucket(
+            Bucket="test-bucket-in-ireland",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+        )
+        s3_client = get_s3_client_for_bucket("test-bucket-in-ireland")
+        assert s3_client.meta.region_name == "eu-west-1"
+        assert get_s3_client_for_bucket("test-bucket-in-ireland") is s3_client
+
+
 class TestGetFile:
     def test_file_path_information_extracted_correctly(self):
         test_file_path_string1 = "s3://my_ingestion_bucket/new_data/file1.csv"
@@ -79,6 +140,54 @@ class TestGetFile:
         )
         assert json.loads(result) == "testing"
 
+    def test_download_in_ranges(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="test-download-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        test_body = bytes(range(256)) * 41
+        mock_s3_client.put_object(
+            Bucket="test-download-bucket",
+            Key="some_test_file",
+            Body=test_body,
+            ContentType="text/csv",
+        )
+        with patch.object(
+            mock_s3_client, "get_object", wraps=mock_s3_client.get_object
+        ) as mocked_get_object:
+            result = download_file_in_ranges(
+                bucket_name="test-download-bucket",
+                file_name="some_test_file",
+                client=mock_s3_client,
+                part_size=1000,
+                max_concurrency=4,
+            )
+        assert result["body"] == test_body
+        assert result["content_type"] == "text/csv"
+        assert mocked_get_object.call_count == 11
+        requested_ranges = sorted(
+            call.kwargs["Range"] for call in mocked_get_object.call_args_list
+        )
+        assert "bytes=10000-10495" in requested_ranges
+
+    def test_download_in_ranges_smaller_than_one_part(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="test-download-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        mock_s3_client.put_object(
+            Bucket="test-download-bucket", Key="small", Body=b"name\nbob\n"
+        )
+        mock_s3_client.put_object(Bucket="test-download-bucket", Key="empty", Body=b"")
+        small = download_file_in_ranges(
+            bucket_name="test-download-bucket", file_name="small", client=mock_s3_client
+        )
+        empty = download_file_in_ranges(
+            bucket_name="test-download-bucket", file_name="empty", client=mock_s3_client
+        )
+        assert small["body"] == b"name\nbob\n"
+        assert empty["body"] == b""
+
 
 class TestObfuscateData:
     def test_obfuscate_small(self):
@@ -202,3 +311,1320 @@ class TestConvertDfToFormattedString:
         test_format = "json"
         expected = json.dumps(make_test_df.to_dict()).encode("utf-8")
         assert convert_df_to_formatted_bytestream(test_input, test_format) == expected
+
+
+class TestStreamObfuscateCsv:
+    def test_stream_matches_whole_file_obfuscation(self):
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            input_bytes = f.read()
+        output = BytesIO()
+        row_count = stream_obfuscate_csv(
+            BytesIO(input_bytes), ["First Name", "Email"], output, chunk_rows=7
+        )
+        result = pd.read_csv(BytesIO(output.getvalue()), dtype=str, keep_default_na=False)
+        expected = pd.read_csv(BytesIO(input_bytes), dtype=str, keep_default_na=False)
+        expected[["First Name", "Email"]] = "***"
+        assert row_count == 100
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_stream_writes_header_once(self):
+        test_input = b"name,cohort\nbob,1\nsue,\nann,3\n"
+        output = BytesIO()
+        stream_obfuscate_csv(BytesIO(test_input), ["name"], output, chunk_rows=1)
+        assert output.getvalue() == b"name,cohort\n***,1\n***,\n***,3\n"
+
+    def test_stream_missing_field_raises_error(self):
+        with pytest.raises(TypeError):
+            stream_obfuscate_csv(BytesIO(b"name,cohort\nbob,1\n"), ["email"], BytesIO())
+
+
+class TestDetectFormat:
+    def test_detects_parquet_from_magic_bytes(self, make_test_df):
+        parquet_bytes = make_test_df.to_parquet()
+        assert detect_format(parquet_bytes[:4096], parquet_bytes[-4:]) == "parquet"
+
+    def test_truncated_parquet_raises_error(self, make_test_df):
+        parquet_bytes = make_test_df.to_parquet()
+        with pytest.raises(TypeError):
+            detect_format(parquet_bytes[:4096], b"oops")
+
+    def test_detects_json_from_first_character(self):
+        assert detect_format(b'  [{"name": "bob"}]') == "json"
+        assert detect_format(b'{"name": ["bob"]}') == "json"
+        assert detect_format(b'\xef\xbb\xbf[{"name": "bob"}]') == "json"
+
+    def test_detects_ndjson_from_second_line(self):
+        assert detect_format(b'{"name": "bob"}\r\n\n{"name": "al"}\n') == "ndjson"
+        assert detect_format(b'{"name": "bob"}\n') == "json"
+        assert detect_format(b'{"name": "b', key_name="data/file.jsonl") == "ndjson"
+        assert detect_format(b'{"name": "b', content_type="application/x-ndjson") == (
+            "ndjson"
+        )
+
+    def test_detects_csv_from_header_line(self):
+        assert detect_format(b"name,DoB,fav_colour\nbob,1/1/4000,maroon") == "csv"
+
+    def test_csv_hint_overrides_bracketed_header(self):
+        test_input = b"[name],DoB\nbob,1/1/4000"
+        assert detect_format(test_input, key_name="data/file.csv") == "csv"
+        assert detect_format(test_input, content_type="text/csv; charset=utf-8") == "csv"
+        assert detect_format(test_input) == "json"
+
+    def test_hint_decides_empty_file(self):
+        assert detect_format(b"", key_name="data/file.json") == "json"
+        with pytest.raises(TypeError):
+            detect_format(b"")
+
+    def test_non_utf8_header_raises_error(self):
+        with pytest.raises(TypeError):
+            detect_format(b"\xff\xfe\x00name\n")
+
+    @patch("src.GDPRObfuscator_handler.pd.read_csv")
+    def test_json_is_parsed_once(self, mocked_read_csv, make_test_df):
+        input_json = json.dumps(make_test_df.to_dict(orient="list")).encode("utf-8")
+        with patch(
+            "src.GDPRObfuscator_handler.json.loads", wraps=json.loads
+        ) as mocked_loads:
+            convert_bytestream_to_df(formatted_bytes=input_json, fields=["name"])
+        mocked_read_csv.assert_not_called()
+        assert mocked_loads.call_count == 1
+
+
+class TestArrowEngine:
+    def test_obfuscated_table_masks_only_pii_columns(self, make_test_df):
+        table = pa.Table.from_pandas(make_test_df)
+        result = produce_obfuscated_table(table, ["name"])
+        assert result.column("name").to_pylist() == ["***", "***"]
+        assert result.column("DoB").chunk(0).buffers()[1].address == (
+            table.column("DoB").chunk(0).buffers()[1].address
+        )
+        assert table.column("name").to_pylist() == ["Bob", "Steve"]
+
+    def test_obfuscated_table_missing_field_raises_error(self, make_test_df):
+        table = pa.Table.from_pandas(make_test_df)
+        with pytest.raises(TypeError):
+            produce_obfuscated_table(table, ["email"])
+
+    def test_csv_round_trip(self):
+        test_input = b"name,DoB,fav_colour\nbob,1/1/4000,maroon\nsue,2/2/4000,teal\n"
+        table_dict = convert_bytestream_to_table(test_input, ["name"], "csv")
+        result = convert_table_to_formatted_bytestream(
+            produce_obfuscated_table(table_dict["table"], ["name"]), "csv"
+        )
+        expected = pd.read_csv(BytesIO(test_input))
+        expected["name"] = "***"
+        pd.testing.assert_frame_equal(pd.read_csv(BytesIO(result)), expected)
+
+    def test_json_keeps_input_shape(self, make_test_df):
+        records = json.dumps(make_test_df.to_dict(orient="records")).encode("utf-8")
+        lists = json.dumps(make_test_df.to_dict(orient="list")).encode("utf-8")
+        for input_json, orient in ((records, "records"), (lists, "list")):
+            table_dict = convert_bytestream_to_table(input_json, ["name"], "json")
+            assert table_dict["json_orient"] == orient
+            result = convert_table_to_formatted_bytestream(
+                produce_obfuscated_table(table_dict["table"], ["name"]),
+                "json",
+                json_orient=table_dict["json_orient"],
+            )
+            expected = make_test_df.copy()
+            expected["name"] = "***"
+            assert json.loads(result) == expected.to_dict(orient=orient)
+
+    def test_parquet_reads_back_as_strings(self, make_test_df):
+        table_dict = convert_bytestream_to_table(
+            make_test_df.to_parquet(), ["name"], "parquet"
+        )
+        result = convert_table_to_formatted_bytestream(
+            produce_obfuscated_table(table_dict["table"], ["name"]), "parquet"
+        )
+        expected = make_test_df.copy()
+        expected["name"] = "***"
+        pd.testing.assert_frame_equal(pd.read_parquet(BytesIO(result)), expected)
+
+
+@pytest.fixture
+def make_wide_parquet():
+    table = pa.table(
+        {
+            "id": pa.array(range(1000), type=pa.int64()),
+            "name": [f"customer {i}" for i in range(1000)],
+            "age": pa.array([i % 90 for i in range(1000)], type=pa.int32()),
+            "city": ["Leeds", "Manchester", "London", "Bristol"] * 250,
+        }
+    )
+    sink = BytesIO()
+    pq.write_table(table, sink, row_group_size=300, compression="zstd")
+    return {"table": table, "bytes": sink.getvalue()}
+
+
+class TestParquetPassthrough:
+    def test_thrift_footer_round_trip(self, make_wide_parquet):
+        parquet_bytes = make_wide_parquet["bytes"]
+        footer_length = int.from_bytes(parquet_bytes[-8:-4], "little")
+        footer_bytes = parquet_bytes[-8 - footer_length : -8]
+        encoded = bytearray()
+        _write_thrift_struct(encoded, read_parquet_footer(BytesIO(parquet_bytes)))
+        assert bytes(encoded) == footer_bytes
+
+    def test_obfuscates_only_pii_columns(self, make_wide_parquet):
+        output = BytesIO()
+        row_count = rewrite_parquet_passthrough(
+            BytesIO(make_wide_parquet["bytes"]), ["name", "age"], output
+        )
+        result = pq.read_table(BytesIO(output.getvalue()))
+        table = make_wide_parquet["table"]
+        assert row_count == 1000
+        assert result.schema == table.schema
+        assert result.column("name").to_pylist() == ["***"] * 1000
+        assert result.column("age").null_count == 1000
+        assert result.column("id").equals(table.column("id"))
+        assert result.column("city").equals(table.column("city"))
+
+    def test_preserves_layout_and_copies_other_chunks(self, make_wide_parquet):
+        output = BytesIO()
+        rewrite_parquet_passthrough(BytesIO(make_wide_parquet["bytes"]), ["name"], output)
+        original = pq.ParquetFile(BytesIO(make_wide_parquet["bytes"])).metadata
+        result = pq.ParquetFile(BytesIO(output.getvalue())).metadata
+        assert result.num_row_groups == original.num_row_groups == 4
+        for row_group_index in range(original.num_row_groups):
+            for column_index in (0, 2, 3):
+                original_chunk = original.row_group(row_group_index).column(column_index)
+                result_chunk = result.row_group(row_group_index).column(column_index)
+                original_start = original_chunk.dictionary_page_offset or (
+                    original_chunk.data_page_offset
+                )
+                result_start = result_chunk.dictionary_page_offset or (
+                    result_chunk.data_page_offset
+                )
+                size = original_chunk.total_compressed_size
+                assert result_chunk.compression == "ZSTD"
+                assert (
+                    output.getvalue()[result_start : result_start + size]
+                    == make_wide_parquet["bytes"][original_start : original_start + size]
+                )
+
+    def test_statistics_do_not_leak_pii(self, make_wide_parquet):
+        output = BytesIO()
+        rewrite_parquet_passthrough(BytesIO(make_wide_parquet["bytes"]), ["name"], output)
+        result = pq.ParquetFile(BytesIO(output.getvalue())).metadata
+        for row_group_index in range(result.num_row_groups):
+            assert not result.row_group(row_group_index).column(1).is_stats_set
+        assert b"customer" not in output.getvalue()
+
+    @staticmethod
+    def column_metadatas(footer):
+        for row_group_index, row_group in enumerate(
+            _thrift_field(footer, PARQUET_FILE_ROW_GROUPS)
+        ):
+            for column_chunk in _thrift_field(row_group, PARQUET_ROW_GROUP_COLUMNS):
+                metadata = _thrift_field(column_chunk, PARQUET_CHUNK_METADATA)
+                yield row_group_index, _parquet_column_name(metadata), metadata
+
+    def test_other_columns_keep_statistics_and_bloom_filters(self, make_wide_parquet):
+        parquet_bytes = make_wide_parquet["bytes"]
+        footer_length = int.from_bytes(parquet_bytes[-8:-4], "little")
+        with_filters = bytearray(parquet_bytes[: -8 - footer_length])
+        footer = read_parquet_footer(BytesIO(parquet_bytes))
+        filters = {}
+        for row_group_index, name, metadata in self.column_metadatas(footer):
+            bloom_filter = f"bloom {name} {row_group_index}".encode()
+            metadata[PARQUET_COLUMN_BLOOM_FILTER_OFFSET] = (
+                THRIFT_I64,
+                len(with_filters),
+            )
+            metadata[PARQUET_COLUMN_BLOOM_FILTER_LENGTH] = (
+                THRIFT_I32,
+                len(bloom_filter),
+            )
+            filters[(row_group_index, name)] = bloom_filter
+            with_filters += bloom_filter
+        encoded = bytearray()
+        _write_thrift_struct(encoded, footer)
+        with_filters += encoded + len(encoded).to_bytes(4, "little") + PARQUET_MAGIC
+        output = BytesIO()
+        rewrite_parquet_passthrough(BytesIO(with_filters), ["name"], output)
+        original = pq.ParquetFile(BytesIO(parquet_bytes)).metadata
+        result = pq.ParquetFile(BytesIO(output.getvalue())).metadata
+        for row_group_index in range(result.num_row_groups):
+            for column_index in (0, 2, 3):
+                original_chunk = original.row_group(row_group_index).column(column_index)
+                result_chunk = result.row_group(row_group_index).column(column_index)
+                assert result_chunk.is_stats_set
+                assert result_chunk.statistics == original_chunk.statistics
+        result_footer = read_parquet_footer(BytesIO(output.getvalue()))
+        for row_group_index, name, metadata in self.column_metadatas(result_footer):
+            if name == "name":
+                assert PARQUET_COLUMN_BLOOM_FILTER_OFFSET not in metadata
+                assert PARQUET_COLUMN_STATISTICS not in metadata
+                continue
+            start = _thrift_field(metadata, PARQUET_COLUMN_BLOOM_FILTER_OFFSET)
+            length = _thrift_field(metadata, PARQUET_COLUMN_BLOOM_FILTER_LENGTH)
+            bloom_filter = output.getvalue()[start : start + length]
+            assert bloom_filter == filters[(row_group_index, name)]
+
+    def test_required_non_string_field_raises_error(self):
+        schema = pa.schema([pa.field("age", pa.int32(), nullable=False)])
+        sink = BytesIO()
+        pq.write_table(pa.table({"age": [1, 2]}, schema=schema), sink)
+        with pytest.raises(TypeError):
+            rewrite_parquet_passthrough(BytesIO(sink.getvalue()), ["age"], BytesIO())
+
+    def test_missing_field_raises_error(self, make_wide_parquet):
+        with pytest.raises(TypeError):
+            rewrite_parquet_passthrough(
+                BytesIO(make_wide_parquet["bytes"]), ["email"], BytesIO()
+            )
+
+    def test_int96_column_keeps_physical_type(self):
+        table = pa.table(
+            {
+                "id": [1, 2],
+                "born": pa.array([0, 1], pa.timestamp("ns")),
+            }
+        )
+        sink = BytesIO()
+        pq.write_table(table, sink, use_deprecated_int96_timestamps=True)
+        output = BytesIO()
+        rewrite_parquet_passthrough(BytesIO(sink.getvalue()), ["born"], output)
+        result = pq.ParquetFile(BytesIO(output.getvalue()))
+        assert result.metadata.row_group(0).column(1).physical_type == "INT96"
+        assert result.schema.column(1).physical_type == "INT96"
+        assert result.read().column("born").null_count == 2
+        assert result.read().column("id").equals(table.column("id"))
+
+    def test_physical_type_that_cannot_be_written_back_raises_error(self):
+        table = pa.table({"price": pa.array([1, 2], pa.decimal128(5, 2))})
+        sink = BytesIO()
+        pq.write_table(table, sink, store_decimal_as_integer=True)
+        with pytest.raises(TypeError, match="use the arrow engine"):
+            rewrite_parquet_passthrough(BytesIO(sink.getvalue()), ["price"], BytesIO())
+
+
+class TestStreamObfuscateParquet:
+    def test_stream_keeps_row_groups(self, make_wide_parquet):
+        output = BytesIO()
+        row_count = stream_obfuscate_parquet(
+            BytesIO(make_wide_parquet["bytes"]), ["name"], output
+        )
+        result_file = pq.ParquetFile(BytesIO(output.getvalue()))
+        result = result_file.read()
+        assert row_count == 1000
+        assert result_file.metadata.num_row_groups == 4
+        assert result_file.metadata.row_group(0).column(0).compression == "ZSTD"
+        assert result.column("name").to_pylist() == ["***"] * 1000
+        assert result.column("age").equals(make_wide_parquet["table"].column("age"))
+
+    def test_stream_reads_one_row_group_at_a_time(self):
+        table = pa.table(
+            {
+                "id": pa.array(range(200_000), type=pa.int64()),
+                "name": [f"customer {i}" for i in range(200_000)],
+            }
+        )
+        sink = BytesIO()
+        pq.write_table(table, sink, row_group_size=50_000, compression="none")
+        parquet_bytes = sink.getvalue()
+        source = BytesIO(parquet_bytes)
+        largest_read = 0
+        original_read = source.read
+
+        def tracked_read(size=-1):
+            nonlocal largest_read
+            data = original_read(size)
+            largest_read = max(largest_read, len(data))
+            return data
+
+        source.read = tracked_read
+        stream_obfuscate_parquet(source, ["name"], BytesIO())
+        assert largest_read < len(parquet_bytes) / 2
+
+
+class TestS3RangedFile:
+    def test_reads_ranges(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="test-ranged-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        test_body = bytes(range(256)) * 10
+        mock_s3_client.put_object(Bucket="test-ranged-bucket", Key="k", Body=test_body)
+        ranged_file = S3RangedFile(mock_s3_client, "test-ranged-bucket", "k")
+        assert ranged_file.size == len(test_body)
+        assert ranged_file.read(10) == test_body[:10]
+        ranged_file.seek(-5, io.SEEK_END)
+        assert ranged_file.read() == test_body[-5:]
+        assert ranged_file.read(1) == b""
+        ranged_file.seek(100)
+        ranged_file.seek(20, io.SEEK_CUR)
+        assert ranged_file.tell() == 120
+        assert ranged_file.read(30) == test_body[120:150]
+
+
+@pytest.fixture
+def upload_bucket(mock_s3_client):
+    mock_s3_client.create_bucket(
+        Bucket="test-upload-bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+    )
+    with patch("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 256):
+        with patch("src.GDPRObfuscator_handler.S3_MIN_PART_SIZE", 256):
+            yield "test-upload-bucket"
+
+
+class TestS3MultipartWriter:
+    def test_part_size_under_s3_minimum_raises_error(self, mock_s3_client):
+        with pytest.raises(ValueError):
+            S3MultipartWriter(mock_s3_client, "bucket", "key", part_size=1024 * 1024)
+        writer = S3MultipartWriter(
+            mock_s3_client, "bucket", "key", part_size=S3_MIN_PART_SIZE
+        )
+        assert writer.upload_id is None
+
+    def test_small_output_is_put_in_one_request(self, mock_s3_client, upload_bucket):
+        with S3MultipartWriter(mock_s3_client, upload_bucket, "small") as writer:
+            writer.write(b"name\n***\n")
+        response = mock_s3_client.get_object(Bucket=upload_bucket, Key="small")
+        assert response["Body"].read() == b"name\n***\n"
+        assert writer.etag == response["ETag"]
+        assert writer.size == 9
+
+    def test_large_output_is_uploaded_in_parts(self, mock_s3_client, upload_bucket):
+        test_body = bytes(range(256)) * 40
+        with S3MultipartWriter(
+            mock_s3_client, upload_bucket, "large", part_size=1000, max_concurrency=3
+        ) as writer:
+            for start in range(0, len(test_body), 777):
+                writer.write(test_body[start : start + 777])
+        response = mock_s3_client.get_object(Bucket=upload_bucket, Key="large")
+        assert response["Body"].read() == test_body
+        assert writer.etag == response["ETag"]
+        assert writer.etag.strip('"').endswith("-11")
+
+    def test_failure_aborts_upload(self, mock_s3_client, upload_bucket):
+        with pytest.raises(RuntimeError):
+            with S3MultipartWriter(
+                mock_s3_client, upload_bucket, "failed", part_size=1000
+            ) as writer:
+                writer.write(b"x" * 5000)
+                raise RuntimeError("transform failed")
+        uploads = mock_s3_client.list_multipart_uploads(Bucket=upload_bucket)
+        assert "Uploads" not in uploads
+        assert "Contents" not in mock_s3_client.list_objects_v2(Bucket=upload_bucket)
+
+    def test_output_within_inline_limit_is_not_uploaded(
+        self, mock_s3_client, upload_bucket
+    ):
+        with S3MultipartWriter(
+            mock_s3_client, upload_bucket, "inline", part_size=1000, inline_limit=3000
+        ) as writer:
+            writer.write(b"x" * 2500)
+        assert writer.inline_body == b"x" * 2500
+        assert "Contents" not in mock_s3_client.list_objects_v2(Bucket=upload_bucket)
+
+    def test_output_over_inline_limit_is_uploaded(self, mock_s3_client, upload_bucket):
+        with S3MultipartWriter(
+            mock_s3_client, upload_bucket, "spilled", part_size=1000, inline_limit=3000
+        ) as writer:
+            writer.write(b"x" * 2500)
+            writer.write(b"y" * 2500)
+        assert writer.inline_body is None
+        response = mock_s3_client.get_object(Bucket=upload_bucket, Key="spilled")
+        assert response["Body"].read() == b"x" * 2500 + b"y" * 2500
+
+
+class TestStageRecorder:
+    def test_records_each_stage(self):
+        recorder = StageRecorder()
+        with recorder.stage("parse") as stage:
+            stage.record(bytes_in=100)
+        with recorder.stage("serialise") as stage:
+            stage.record(bytes_out=50)
+        assert [stage["stage"] for stage in recorder.stages] == ["parse", "serialise"]
+        assert recorder.stages[0]["bytes_in"] == 100
+        assert recorder.stages[1]["bytes_out"] == 50
+        assert recorder.stages[0]["wall_ms"] >= 0
+        assert recorder.stages[0]["cpu_ms"] >= 0
+        assert recorder.stages[0]["max_rss_mb"] > 0
+
+    def test_records_failed_stages(self):
+        recorder = StageRecorder()
+        with pytest.raises(TypeError):
+            with recorder.stage("parse"):
+                raise TypeError("bad file")
+        assert recorder.stages[0]["error"] == "TypeError"
+
+    def test_disabled_recorder_records_nothing(self):
+        recorder = StageRecorder(enabled=False)
+        with recorder.stage("parse") as stage:
+            stage.record(bytes_in=100)
+        assert recorder.stages == []
+
+    def test_trace_memory_records_peak_allocations(self):
+        recorder = StageRecorder(trace_memory=True)
+        with recorder.stage("allocate"):
+            block = bytearray(5 * 2**20)
+        del block
+        recorder.finish()
+        assert recorder.stages[0]["traced_peak_mb"] >= 5
+
+    def test_finish_prints_embedded_metric_format_lines(self, capsys):
+        recorder = StageRecorder()
+        with recorder.stage("download") as stage:
+            stage.record(bytes_in=10)
+        recorder.finish()
+        document = json.loads(capsys.readouterr().out.strip())
+        metrics = document["_aws"]["CloudWatchMetrics"][0]
+        assert metrics["Namespace"] == "GDPRObfuscator"
+        assert metrics["Dimensions"] == [["Stage"]]
+        names = [metric["Name"] for metric in metrics["Metrics"]]
+        assert "bytes_out" not in names
+        assert document["Stage"] == "download"
+        assert document["bytes_in"] == 10
+        for name in names:
+            assert name in document
+
+
+class TestRunWithBoundedConcurrency:
+    def test_returns_every_result(self):
+        results = run_with_bounded_concurrency(lambda x: x * 2, range(100), 4)
+        assert sorted(results) == [x * 2 for x in range(100)]
+
+    def test_consumes_items_as_results_complete(self):
+        taken = []
+
+        def items():
+            for x in range(100):
+                taken.append(x)
+                yield x
+
+        results = run_with_bounded_concurrency(lambda x: x, items(), 2)
+        next(results)
+        assert len(taken) <= 5
+        assert len(list(results)) == 99
+
+
+class TestObfuscateBatch:
+    def test_failed_items_are_reported(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="batch-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        mock_s3_client.put_object(
+            Bucket="batch-bucket", Key="good.csv", Body=b"name,age\nbob,3\n"
+        )
+        result = obfuscate_batch(
+            {
+                "obfuscate_fields": ["name"],
+                "items": [
+                    {
+                        "s3_path": "s3://batch-bucket/good.csv",
+                        "output_s3_path": "s3://batch-bucket/out/good.csv",
+                    },
+                    {
+                        "s3_path": "s3://batch-bucket/missing.csv",
+                        "output_s3_path": "s3://batch-bucket/out/missing.csv",
+                    },
+                    {"s3_path": "s3://batch-bucket/good.csv"},
+                ],
+            }
+        )
+        assert result["succeeded"] == 1
+        assert result["failed"] == 2
+        good, missing, no_output = result["items"]
+        assert good["status"] == "succeeded"
+        assert good["row_count"] == 1
+        assert missing["status"] == "failed"
+        assert missing["error_type"] == "NoSuchKey"
+        assert no_output["error_type"] == "ValueError"
+        body = mock_s3_client.get_object(Bucket="batch-bucket", Key="out/good.csv")
+        assert body["Body"].read() == b"name,age\n***,3\n"
+
+
+class TestListS3Objects:
+    def test_lists_every_page(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="list-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        for i in range(7):
+            mock_s3_client.put_object(Bucket="list-bucket", Key=f"in/{i}", Body=b"x")
+        mock_s3_client.put_object(Bucket="list-bucket", Key="other", Body=b"x")
+        listed = list_s3_objects(mock_s3_client, "list-bucket", "in/", page_size=2)
+        assert [listed_object["Key"] for listed_object in listed] == [
+            f"in/{i}" for i in range(7)
+        ]
+
+    def test_pages_are_requested_as_consumed(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="list-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        for i in range(6):
+            mock_s3_client.put_object(Bucket="list-bucket", Key=f"in/{i}", Body=b"x")
+        requests = []
+        mock_s3_client.meta.events.register(
+            "before-call.s3.ListObjectsV2", lambda **kwargs: requests.append(1)
+        )
+        listed = list_s3_objects(mock_s3_client, "list-bucket", "in/", page_size=2)
+        next(listed)
+        assert len(requests) == 1
+        assert len(list(listed)) == 5
+        assert len(requests) == 3
+
+
+def make_multiline_csv(rows):
+    lines = [b"id,name,notes\r\n"]
+    starts = []
+    position = len(lines[0])
+    for i in range(rows):
+        if i % 3 == 0:
+            notes = f'"line one\nline ""two"", {i}\nend"'
+        elif i % 3 == 1:
+            notes = '""'
+        else:
+            notes = f"plain {i}"
+        line = f"{i},name {i},{notes}\r\n".encode()
+        starts.append(position)
+        position += len(line)
+        lines.append(line)
+    return {"bytes": b"".join(lines), "starts": starts}
+
+
+class TestRecordBoundaries:
+    def test_scan_skips_newlines_in_quotes(self):
+        assert _scan_record_boundary(b'a,"x\ny"\nb', False) == (8, False)
+        assert _scan_record_boundary(b'x\ny",z\nb', True) == (7, False)
+        assert _scan_record_boundary(b'a,"x\n""y', False) == (None, True)
+        assert _scan_record_boundary(b"a,b", False) == (None, False)
+
+    @pytest.mark.parametrize("window_size", [40, 4096])
+    def test_find_record_boundary(self, mock_s3_client, upload_bucket, window_size):
+        test_csv = make_multiline_csv(60)
+        mock_s3_client.put_object(
+            Bucket=upload_bucket, Key="multiline.csv", Body=test_csv["bytes"]
+        )
+        header_end = test_csv["starts"][0]
+        for offset in range(header_end, len(test_csv["bytes"]), 37):
+            expected = next(
+                (start for start in test_csv["starts"] if start >= offset),
+                len(test_csv["bytes"]),
+            )
+            assert (
+                find_record_boundary(
+                    mock_s3_client,
+                    upload_bucket,
+                    "multiline.csv",
+                    offset,
+                    field_count=3,
+                    previous_boundary=header_end,
+                    window_size=window_size,
+                )
+                == expected
+            )
+
+    def test_read_csv_header(self, mock_s3_client, upload_bucket):
+        mock_s3_client.put_object(
+            Bucket=upload_bucket, Key="quoted-header.csv", Body=b'"a\nb",c\n1,2\n'
+        )
+        header = read_csv_header(
+            mock_s3_client, upload_bucket, "quoted-header.csv", window_size=3
+        )
+        assert header == b'"a\nb",c\n'
+
+
+class TestParallelObfuscateCsv:
+    def test_record_boundaries_skip_quoted_newlines(self):
+        test_csv = make_multiline_csv(50)
+        boundaries = csv_record_boundaries(test_csv["bytes"])
+        assert boundaries.tolist() == test_csv["starts"] + [len(test_csv["bytes"])]
+        assert csv_record_boundaries(b'a,b\n"x\n""y""\n",1\n2,3').tolist() == [4, 17]
+
+    @pytest.mark.parametrize("max_workers", [2, 3, 8])
+    def test_output_matches_single_threaded(self, monkeypatch, max_workers):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.PARALLEL_MIN_BYTES", 0)
+        test_csv = make_multiline_csv(2000)["bytes"]
+        expected = BytesIO()
+        expected_rows = stream_obfuscate_csv(BytesIO(test_csv), ["name"], expected)
+        output = BytesIO()
+        row_count = parallel_obfuscate_csv(
+            bytearray(test_csv), ["name"], output, max_workers=max_workers
+        )
+        assert output.getvalue() == expected.getvalue()
+        assert row_count == expected_rows == 2000
+
+    def test_missing_field_raises_error(self, monkeypatch):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.PARALLEL_MIN_BYTES", 0)
+        with pytest.raises(TypeError):
+            parallel_obfuscate_csv(
+                make_multiline_csv(100)["bytes"], ["email"], BytesIO(), max_workers=2
+            )
+
+
+class TestExactObfuscateCsv:
+    test_csv = (
+        b'id,name,"no\nte",x\r\n'
+        b'1,"bob ""b""",3.50,\r\n'
+        b"\r\n"
+        b'2,,007,"a,b"\r\n'
+        b'3,"multi\nline",1e3,z'
+    )
+
+    @pytest.mark.parametrize("block_size", [1, 7, 4096])
+    def test_only_pii_fields_change(self, block_size):
+        output = BytesIO()
+        row_count = exact_obfuscate_csv(
+            self.test_csv, ["name", "x"], output, block_size=block_size
+        )
+        assert output.getvalue() == (
+            b'id,name,"no\nte",x\r\n'
+            b"1,***,3.50,***\r\n"
+            b"\r\n"
+            b"2,***,007,***\r\n"
+            b"3,***,1e3,***"
+        )
+        assert row_count == 3
+
+    @pytest.mark.parametrize("block_size", [5, 4096])
+    def test_reads_file_like_sources(self, block_size):
+        output = BytesIO()
+        exact_obfuscate_csv(
+            BytesIO(self.test_csv), ["name"], output, block_size=block_size
+        )
+        assert output.getvalue() == (
+            b'id,name,"no\nte",x\r\n'
+            b"1,***,3.50,\r\n"
+            b"\r\n"
+            b'2,***,007,"a,b"\r\n'
+            b"3,***,1e3,z"
+        )
+
+    def test_matches_pandas_values(self):
+        test_csv = make_multiline_csv(500)["bytes"]
+        output = BytesIO()
+        exact_obfuscate_csv(test_csv, ["notes"], output, block_size=1000)
+        expected = pd.read_csv(BytesIO(test_csv), dtype=str, keep_default_na=False)
+        expected["notes"] = "***"
+        result = pd.read_csv(
+            BytesIO(output.getvalue()), dtype=str, keep_default_na=False
+        )
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_missing_field_raises_error(self):
+        with pytest.raises(TypeError):
+            exact_obfuscate_csv(self.test_csv, ["email"], BytesIO())
+
+
+class TestStreamObfuscateJson:
+    @pytest.mark.parametrize("read_size", [1, 7, 65536])
+    def test_records_keep_shape_and_key_order(self, read_size):
+        test_json = (
+            '[{"zeta": 1, "name": "Émile", "amount": 12345.678},\n'
+            ' {"name": null, "zeta": 2, "nested": {"a": [1, 2]}},'
+            ' {"zeta": 3}]'
+        ).encode("utf-8")
+        output = BytesIO()
+        row_count = stream_obfuscate_json(
+            test_json, ["name"], output, read_size=read_size
+        )
+        assert output.getvalue().decode("utf-8") == (
+            '[{"zeta": 1, "name": "***", "amount": 12345.678}, '
+            '{"name": "***", "zeta": 2, "nested": {"a": [1, 2]}}, '
+            '{"zeta": 3}]'
+        )
+        assert row_count == 3
+
+    @pytest.mark.parametrize("read_size", [3, 65536])
+    def test_columns_keep_shape(self, read_size):
+        test_json = (
+            b'{"id": [1,  2, 3], "name": ["a", "b", "c"],'
+            b' "city": {"0": "x", "1": "y"}}'
+        )
+        output = BytesIO()
+        row_count = stream_obfuscate_json(
+            BytesIO(test_json), ["name", "city"], output, read_size=read_size
+        )
+        assert json.loads(output.getvalue()) == {
+            "id": [1, 2, 3],
+            "name": ["***", "***", "***"],
+            "city": {"0": "***", "1": "***"},
+        }
+        assert b'"id": [1,  2, 3]' in output.getvalue()
+        assert row_count == 3
+
+    def test_large_columns_are_read_in_linear_time(self, monkeypatch):
+        rows = 400_000
+        test_json = json.dumps(
+            {"name": [f"customer {i}" for i in range(rows)], "id": list(range(rows))}
+        ).encode("utf-8")
+        start = time.perf_counter()
+        json.loads(test_json)
+        loads_seconds = time.perf_counter() - start
+        scanned = 0
+        raw_decode = json.JSONDecoder.raw_decode
+
+        def counting_raw_decode(decoder, text, index=0):
+            nonlocal scanned
+            scanned += len(text) - index
+            return raw_decode(decoder, text, index)
+
+        monkeypatch.setattr(json.JSONDecoder, "raw_decode", counting_raw_decode)
+        output = BytesIO()
+        start = time.perf_counter()
+        row_count = stream_obfuscate_json(test_json, ["name"], output)
+        stream_seconds = time.perf_counter() - start
+        assert row_count == rows
+        assert scanned < 4 * len(test_json)
+        assert stream_seconds < 10 * loads_seconds + 0.5
+
+    def test_empty_list_has_no_fields_to_obfuscate(self):
+        output = BytesIO()
+        with pytest.raises(TypeError):
+            stream_obfuscate_json(b" [ ] ", ["name"], output)
+
+    @pytest.mark.parametrize(
+        "test_json",
+        [b'[{"id": 1}]', b'[{"name": 1}', b'[{"name": 1}] [', b"[1, 2]", b'"name"'],
+    )
+    def test_invalid_json_raises_error(self, test_json):
+        with pytest.raises(TypeError):
+            stream_obfuscate_json(test_json, ["name"], BytesIO())
+
+
+class TestStreamObfuscateNdjson:
+    test_ndjson = (
+        b'{"id": 1, "name": "bob", "city": "x"}\r\n'
+        b"\n"
+        b'{"id":2,"city":"y"}\n'
+        b"not json, but no sensitive key either\n"
+        b'{"n\\u0061me": "al", "id": 3}\n'
+        b'{"id": 4, "name": null}'
+    )
+    expected = (
+        b'{"id": 1, "name": "***", "city": "x"}\r\n'
+        b"\n"
+        b'{"id":2,"city":"y"}\n'
+        b"not json, but no sensitive key either\n"
+        b'{"name": "***", "id": 3}\n'
+        b'{"id": 4, "name": "***"}'
+    )
+
+    @pytest.mark.parametrize("block_size", [1, 7, 4096])
+    def test_only_lines_with_pii_keys_change(self, block_size):
+        output = BytesIO()
+        row_count = stream_obfuscate_ndjson(
+            BytesIO(self.test_ndjson), ["name"], output, block_size=block_size
+        )
+        assert output.getvalue() == self.expected
+        assert row_count == 5
+
+    def test_missing_field_raises_error(self):
+        with pytest.raises(TypeError):
+            stream_obfuscate_ndjson(self.test_ndjson, ["email"], BytesIO())
+
+    def test_line_that_is_not_an_object_raises_error(self):
+        with pytest.raises(TypeError):
+            stream_obfuscate_ndjson(b'["name"]\n', ["name"], BytesIO())
+
+    @pytest.mark.parametrize("max_workers", [2, 3])
+    def test_parallel_output_matches_streaming(self, monkeypatch, max_workers):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.PARALLEL_MIN_BYTES", 0)
+        test_ndjson = b"\n".join([self.test_ndjson] * 200)
+        expected = BytesIO()
+        expected_rows = stream_obfuscate_ndjson(test_ndjson, ["name"], expected)
+        output = BytesIO()
+        row_count = parallel_obfuscate_ndjson(
+            bytearray(test_ndjson), ["name"], output, max_workers=max_workers
+        )
+        assert output.getvalue() == expected.getvalue()
+        assert row_count == expected_rows == 1000
+
+    @pytest.mark.parametrize("engine", ["pandas", "arrow"])
+    def test_dataframe_and_table_round_trip(self, engine):
+        test_ndjson = b'{"id": 1, "name": "bob"}\n{"id": 2, "name": "al"}\n'
+        if engine == "arrow":
+            table = convert_bytestream_to_table(test_ndjson, ["name"], "ndjson")
+            output = convert_table_to_formatted_bytestream(table["table"], "ndjson")
+        else:
+            df = convert_bytestream_to_df(test_ndjson, ["name"])
+            assert df["format"] == "ndjson"
+            output = convert_df_to_formatted_bytestream(df["df"], "ndjson")
+        records = [json.loads(line) for line in output.splitlines()]
+        assert records == [{"id": 1, "name": "bob"}, {"id": 2, "name": "al"}]
+
+
+def make_nested_table():
+    return pa.table(
+        {
+            "id": [1, 2, 3],
+            "customer": [
+                {"contact": {"email": "a@b.com", "phone": "123"}},
+                None,
+                {"contact": None},
+            ],
+            "orders": [[{"shipping": {"address": "1 road", "cost": 3}}], [], None],
+        }
+    )
+
+
+class TestFieldPaths:
+    def test_compiled_paths_are_cached(self):
+        compile_field_path.cache_clear()
+        first = compile_field_path("customer.contact.email")
+        assert compile_field_path("customer.contact.email") is first
+        assert compile_field_path.cache_info().hits == 1
+
+    def test_json_path_masks_in_place(self):
+        orders = [
+            {"paid": True, "card": {"number": "1"}, "items": [1, 2]},
+            {"paid": False, "card": {"number": "2"}, "items": [3]},
+        ]
+        document = {"customer": {"contact": {"email": "a"}}, "orders": orders}
+        assert obfuscate_json_path(document, "customer.contact.email") == 1
+        assert obfuscate_json_path(document, "orders[?paid].card.number") == 1
+        assert obfuscate_json_path(document, "orders[1:].items[0]") == 1
+        assert obfuscate_json_path(document, "orders[*].missing") == 0
+        assert document["orders"] is orders
+        assert document == {
+            "customer": {"contact": {"email": "***"}},
+            "orders": [
+                {"paid": True, "card": {"number": "***"}, "items": [1, 2]},
+                {"paid": False, "card": {"number": "2"}, "items": ["***"]},
+            ],
+        }
+
+    def test_expression_that_cant_be_masked_raises_error(self):
+        with pytest.raises(ValueError):
+            obfuscate_json_path({"a": 1, "b": 2}, "a || b")
+
+    def test_stream_json_masks_paths_in_records_and_columns(self):
+        output = BytesIO()
+        stream_obfuscate_json(
+            b'[{"id": 1, "customer": {"contact": {"email": "a", "phone": "1"}}}]',
+            ["customer.contact.email"],
+            output,
+        )
+        assert json.loads(output.getvalue()) == [
+            {"id": 1, "customer": {"contact": {"email": "***", "phone": "1"}}}
+        ]
+        output = BytesIO()
+        stream_obfuscate_json(
+            b'{"id": [1, 2], "customer": [{"email": "a"}, {"email": "b"}]}',
+            ["customer[*].email"],
+            output,
+        )
+        assert json.loads(output.getvalue()) == {
+            "id": [1, 2],
+            "customer": [{"email": "***"}, {"email": "***"}],
+        }
+
+    def test_stream_ndjson_masks_paths(self):
+        test_ndjson = (
+            b'{"id": 1, "orders": [{"shipping": {"address": "x"}}]}\n'
+            b'{"id": 2}\n'
+        )
+        output = BytesIO()
+        stream_obfuscate_ndjson(test_ndjson, ["orders[*].shipping.address"], output)
+        assert output.getvalue() == (
+            b'{"id": 1, "orders": [{"shipping": {"address": "***"}}]}\n'
+            b'{"id": 2}\n'
+        )
+
+    def test_arrow_paths_rebuild_only_nested_columns(self):
+        table = make_nested_table()
+        new_table = produce_obfuscated_table(
+            table, ["customer.contact.email", "orders[*].shipping.address"]
+        )
+        assert new_table.column("id").chunk(0).buffers()[1].address == (
+            table.column("id").chunk(0).buffers()[1].address
+        )
+        assert new_table.to_pydict() == {
+            "id": [1, 2, 3],
+            "customer": [
+                {"contact": {"email": "***", "phone": "123"}},
+                None,
+                {"contact": None},
+            ],
+            "orders": [[{"shipping": {"address": "***", "cost": 3}}], [], None],
+        }
+
+    def test_arrow_path_not_in_schema_raises_error(self):
+        with pytest.raises(TypeError):
+            produce_obfuscated_table(make_nested_table(), ["customer.contact.fax"])
+
+    def test_parquet_paths_with_pandas_and_streaming(self):
+        sink = BytesIO()
+        pq.write_table(make_nested_table(), sink)
+        parquet_bytes = sink.getvalue()
+        fields = ["customer.contact.email"]
+        df = convert_bytestream_to_df(parquet_bytes, fields)["df"]
+        pandas_output = convert_df_to_formatted_bytestream(
+            produce_obfuscated_data(df, fields), "parquet"
+        )
+        streamed_output = BytesIO()
+        stream_obfuscate_parquet(BytesIO(parquet_bytes), fields, streamed_output)
+        for output in (pandas_output, streamed_output.getvalue()):
+            customers = pq.read_table(BytesIO(output)).column("customer").to_pylist()
+            assert customers[0] == {"contact": {"email": "***", "phone": "123"}}
+            assert customers[1] is None
+
+
+COMPRESSION_MODULES = {"gzip": gzip, "bz2": bz2, "xz": lzma}
+
+
+class TestCompression:
+    test_csv = b"".join(b"%d,name %d,x\n" % (i, i) for i in range(20000))
+
+    def test_detects_compression_from_magic_bytes_or_encoding(self):
+        assert detect_compression(gzip.compress(b"a")) == "gzip"
+        assert detect_compression(bz2.compress(b"a")) == "bz2"
+        assert detect_compression(lzma.compress(b"a")) == "xz"
+        assert detect_compression(b"BZh,name\n") is None
+        assert detect_compression(b"id,name\n") is None
+        assert detect_compression(b"id,name\n", content_encoding="x-gzip") == "gzip"
+        assert strip_compression_extension("data/file.csv.gz") == "data/file.csv"
+
+    @pytest.mark.parametrize("compression", COMPRESSIONS)
+    def test_reader_decompresses_concatenated_streams(self, compression):
+        module = COMPRESSION_MODULES[compression]
+        compressed = module.compress(self.test_csv[:999]) + module.compress(
+            self.test_csv[999:]
+        )
+        reader = io.BufferedReader(
+            DecompressingReader(BytesIO(compressed), compression, chunk_size=4096)
+        )
+        chunks = iter(lambda: reader.read(10000), b"")
+        assert b"".join(chunks) == self.test_csv
+        assert decompress_bytes(compressed, compression) == self.test_csv
+
+    @pytest.mark.parametrize("compression", COMPRESSIONS)
+    def test_truncated_input_raises_error(self, compression):
+        compressed = COMPRESSION_MODULES[compression].compress(self.test_csv)
+        with pytest.raises(TypeError):
+            decompress_bytes(compressed[:-10], compression)
+
+    @pytest.mark.parametrize("compression", COMPRESSIONS)
+    def test_writer_compresses_output(self, compression):
+        output = BytesIO()
+        with CompressingWriter(output, compression, level=1, chunk_size=5000) as writer:
+            for start in range(0, len(self.test_csv), 777):
+                writer.write(self.test_csv[start : start + 777])
+        assert writer.size == len(self.test_csv)
+        decompressed = COMPRESSION_MODULES[compression].decompress(output.getvalue())
+        assert decompressed == self.test_csv
+
+    def test_output_compression_options(self):
+        assert resolve_output_compression("same", "gzip") == "gzip"
+        assert resolve_output_compression("none", "gzip") is None
+        assert resolve_output_compression("xz", None) == "xz"
+        with pytest.raises(ValueError):
+            resolve_output_compression("zip", None)
+
+
+class TestPseudonymisation:
+    test_csv = b'id,name,email\n1,"Smith, J",a@b.com\n2,,c@d.com\n3,Bob,a@b.com\n'
+
+    @pytest.fixture
+    def pseudonymiser(self):
+        return Pseudonymiser("secret")
+
+    def test_tokens_are_truncated_hmacs(self, pseudonymiser):
+        token = pseudonymiser.pseudonymise_value("a@b.com")
+        assert len(token) == PSEUDONYM_LENGTH
+        assert token == Pseudonymiser(b"secret").pseudonymise_value("a@b.com")
+        assert token != Pseudonymiser("other").pseudonymise_value("a@b.com")
+        assert pseudonymiser.tokens([None, "", float("nan")])[:2] == [None, ""]
+        assert Pseudonymiser("secret", length=8).pseudonymise_value("a@b.com") == (
+            token[:8]
+        )
+
+    def test_columns_are_factorised_before_hashing(self, pseudonymiser):
+        series = pd.Series(["a", "b", "a", None, "a"], index=[5, 6, 7, 8, 9])
+        with patch.object(
+            pseudonymiser, "token", wraps=pseudonymiser.token
+        ) as mocked_token:
+            tokens = pseudonymiser.pseudonymise_series(series)
+        assert mocked_token.call_count == 2
+        assert list(tokens.index) == [5, 6, 7, 8, 9]
+        assert tokens[5] == tokens[7] == tokens[9] != tokens[6]
+        assert tokens[8] is None
+
+    def test_arrow_keeps_indices_and_nulls(self, pseudonymiser):
+        array = pa.chunked_array([["a", "b"], ["a", None]])
+        tokens = pseudonymiser.pseudonymise_arrow(array)
+        assert pa.types.is_dictionary(tokens.type)
+        assert tokens.to_pylist() == pseudonymiser.tokens(["a", "b", "a", None])
+
+    def test_tokens_are_memoised_across_calls(self):
+        pseudonymiser = get_pseudonymiser("memo key")
+        pseudonymiser.pseudonymise_value("a")
+        pseudonymiser.pseudonymise_value("a")
+        assert get_pseudonymiser(b"memo key") is pseudonymiser
+        assert pseudonymiser.token.cache_info().hits >= 1
+        assert pickle.loads(pickle.dumps(pseudonymiser)) is pseudonymiser
+
+    def test_csv_engines_write_the_same_tokens(self, pseudonymiser):
+        outputs = []
+        for obfuscate in (stream_obfuscate_csv, exact_obfuscate_csv):
+            output = BytesIO()
+            obfuscate(
+                BytesIO(self.test_csv),
+                ["name", "email"],
+                output,
+                pseudonymiser=pseudonymiser,
+            )
+            outputs.append(output.getvalue())
+        assert outputs[0] == outputs[1]
+        df = pd.read_csv(BytesIO(outputs[0]), dtype=str, keep_default_na=False)
+        assert list(df["name"]) == pseudonymiser.tokens(["Smith, J", "", "Bob"])
+        assert df["email"][0] == df["email"][2] != df["email"][1]
+
+    def test_json_and_arrow_match_csv_tokens(self, pseudonymiser):
+        records = [{"name": "Bob", "contact": {"email": "a@b.com"}}]
+        output = BytesIO()
+        stream_obfuscate_json(
+            json.dumps(records).encode(),
+            ["name", "contact.email"],
+            output,
+            pseudonymiser=pseudonymiser,
+        )
+        expected = pseudonymiser.tokens(["Bob", "a@b.com"])
+        obfuscated = json.loads(output.getvalue())[0]
+        assert [obfuscated["name"], obfuscated["contact"]["email"]] == expected
+        table = produce_obfuscated_table(
+            pa.Table.from_pylist(records), ["name", "contact.email"], pseudonymiser
+        )
+        assert table.to_pylist() == [obfuscated]
+
+    def test_mode_options(self, monkeypatch):
+        monkeypatch.delenv(PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE, raising=False)
+        assert pseudonymiser_from_options({}) is None
+        with pytest.raises(ValueError):
+            pseudonymiser_from_options({"mode": "pseudonymise"})
+        with pytest.raises(ValueError):
+            pseudonymiser_from_options({"mode": "hash"})
+        monkeypatch.setenv(PSEUDONYMISATION_KEY_ENVIRONMENT_VARIABLE, "secret")
+        pseudonymiser = pseudonymiser_from_options(
+            {"mode": "pseudonymise", "token_length": 10}
+        )
+        assert pseudonymiser.length == 10
+
+
+class TestLazyImports:
+    def test_heavy_modules_load_only_when_needed(self):
+        code = (
+            "import sys\n"
+            "from io import BytesIO\n"
+            "import src.GDPRObfuscator_handler as handler\n"
+            "names = ('numpy', 'pandas', 'pyarrow')\n"
+            "heavy = lambda: [name for name in names if name in sys.modules]\n"
+            "print(heavy())\n"
+            "handler.stream_obfuscate_ndjson(b'{\"a\": 1}\\n', ['a'], BytesIO())\n"
+            "print(heavy())\n"
+            "handler.exact_obfuscate_csv(b'a,b\\n1,2\\n', ['a'], BytesIO())\n"
+            "print(heavy())\n"
+        )
+        completed = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        assert completed.stdout.split("\n")[:3] == ["[]", "[]", "['numpy']"]
+
+
+class TestPriming:
+    @pytest.fixture(autouse=True)
+    def clean_registry(self, monkeypatch):
+        monkeypatch.setattr("src.GDPRObfuscator_handler._primed_credentials", None)
+        reset_s3_clients()
+        yield
+        reset_s3_clients()
+
+    def test_enabled_by_initialization_type_or_setting(self, monkeypatch):
+        monkeypatch.delenv(PRIME_ENVIRONMENT_VARIABLE, raising=False)
+        monkeypatch.setenv("AWS_LAMBDA_INITIALIZATION_TYPE", "on-demand")
+        assert not priming_enabled_by_environment()
+        monkeypatch.setenv("AWS_LAMBDA_INITIALIZATION_TYPE", "snap-start")
+        assert priming_enabled_by_environment()
+        monkeypatch.setenv(PRIME_ENVIRONMENT_VARIABLE, "false")
+        assert not priming_enabled_by_environment()
+
+    def test_prime_builds_clients_and_runs_engines(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="prime-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        result = prime(buckets=["prime-bucket", "missing-prime-bucket"])
+        steps = {"s3_client", "bucket prime-bucket", "engines"}
+        assert steps.issubset(result["timings_ms"])
+        assert list(result["errors"]) == ["bucket missing-prime-bucket"]
+        assert get_s3_client(region_name="eu-west-2") is get_s3_client_for_bucket(
+            "prime-bucket"
+        )
+
+    def test_new_credentials_refresh_clients(self, mock_s3_client, monkeypatch):
+        prime()
+        s3_client = get_s3_client()
+        check_restored()
+        assert get_s3_client() is s3_client
+        monkeypatch.setenv("AWS_SESSION_TOKEN", "restored")
+        check_restored()
+        assert get_s3_client() is not s3_client
+
+    def test_refresh_closes_real_clients(self, mock_s3_client):
+        mock_s3_client.create_bucket(
+            Bucket="restore-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3_client = get_s3_client_for_bucket("restore-bucket")
+        assert isinstance(s3_client, botocore.client.BaseClient)
+        close = patch.object(s3_client, "close", wraps=s3_client.close)
+        get_region = patch(
+            "src.GDPRObfuscator_handler.get_bucket_region", wraps=get_bucket_region
+        )
+        with close as closed, get_region as region_lookup:
+            refresh_after_restore()
+            closed.assert_called_once_with()
+            restored_client = get_s3_client_for_bucket("restore-bucket")
+            region_lookup.assert_called_once()
+        assert restored_client is not s3_client
+        listed = restored_client.list_objects_v2(Bucket="restore-bucket")
+        assert listed["KeyCount"] == 0
+
+
+class TestTypedMasks:
+    @pytest.fixture
+    def typed_df(self):
+        return pd.DataFrame(
+            {
+                "id": [1, 2, 3],
+                "score": [0.5, 1.5, 2.5],
+                "joined": pd.to_datetime(["2020-01-01", "2021-01-01", "2022-01-01"]),
+                "active": [True, False, True],
+                "visits": pd.array([1, None, 3], dtype="Int32"),
+                "name": ["a", "b", "c"],
+            }
+        )
+
+    def test_masks_are_single_category_views(self, typed_df):
+        fields = ["score", "name"]
+        result = produce_obfuscated_data(typed_df, fields)
+        assert (result[fields] == "***").all().all()
+        for field in fields:
+            assert isinstance(result[field].dtype, pd.CategoricalDtype)
+            assert result[field].array.codes.strides == (0,)
+        assert np.shares_memory(result["id"].values, typed_df["id"].values)
+        assert typed_df["name"].tolist() == ["a", "b", "c"]
+
+    @pytest.mark.parametrize("typed_mask", TYPED_MASKS)
+    def test_typed_masks_keep_column_types(self, typed_df, typed_mask):
+        fields = ["score", "joined", "active", "visits", "name"]
+        result = produce_obfuscated_data(typed_df, fields, typed_mask=typed_mask)
+        table = produce_obfuscated_table(
+            pa.Table.from_pandas(typed_df, preserve_index=False),
+            fields,
+            typed_mask=typed_mask,
+        )
+        assert (result["name"] == "***").all()
+        assert table.column("name").to_pylist() == ["***"] * 3
+        for field in ["score", "joined", "visits"]:
+            assert result[field].dtype == typed_df[field].dtype
+            assert table.schema.field(field).type == pa.Schema.from_pandas(
+                typed_df, preserve_index=False
+            ).field(field).type
+        if typed_mask == "null":
+            assert result[fields[:-1]].isna().all().all()
+            assert table.column("active").null_count == 3
+        else:
+            assert result["score"].tolist() == [0.0] * 3
+            assert result["joined"][0] == pd.Timestamp(0)
+            assert table.column("visits").to_pylist() == [0] * 3
+
+    def test_masked_parquet_columns_are_strings_with_every_engine(self, typed_df):
+        fields = ["score", "joined", "visits", "name"]
+        schemas = []
+        for engine in ("pandas", "arrow"):
+            output = BytesIO()
+            obfuscate_file_bytes(
+                typed_df.to_parquet(), None, None, fields, output, {"engine": engine}
+            )
+            result = pd.read_parquet(BytesIO(output.getvalue()))
+            for field in fields:
+                assert result[field].dtype == object
+                assert result[field].tolist() == ["***"] * 3
+            assert result["id"].dtype == typed_df["id"].dtype
+            schemas.append(pq.read_schema(BytesIO(output.getvalue())))
+        assert schemas[0].field("name").type == pa.string()
+        assert schemas[0].types == schemas[1].types
+
+    def test_unknown_typed_mask_raises_error(self, typed_df):
+        with pytest.raises(ValueError):
+            produce_obfuscated_data(typed_df, ["name"], typed_mask="zero")
+
+
+class TestBufferPipeline:
+    @pytest.fixture
+    def test_df(self):
+        return pd.DataFrame(
+            {
+                "id": range(7),
+                "name": [f"customer {i}" for i in range(7)],
+                "score": [i * 0.5 for i in range(7)],
+            }
+        )
+
+    def test_memoryview_reader_reads_without_copying(self):
+        data = bytearray(b"id,name\n1,a\n2,b\n")
+        with MemoryviewReader(data) as reader:
+            assert reader.read(3) == b"id,"
+            reader.seek(-4, io.SEEK_END)
+            assert reader.read() == b"2,b\n"
+            with pytest.raises(BufferError):
+                del data[:]
+        del data[:]
+        assert data == bytearray()
+
+    @pytest.mark.parametrize("file_format", ["csv", "json", "ndjson", "parquet"])
+    def test_writers_append_whole_files_in_chunks(
+        self, test_df, file_format, monkeypatch
+    ):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.WRITE_CHUNK_ROWS", 3)
+        table = pa.Table.from_pandas(test_df, preserve_index=False)
+        df_output = BytesIO()
+        df_output.write(b"head")
+        write_df_to_formatted_output(test_df, file_format, df_output)
+        table_output = BytesIO()
+        table_output.write(b"head")
+        write_table_to_formatted_output(table, file_format, table_output)
+        assert df_output.getvalue()[:4] == table_output.getvalue()[:4] == b"head"
+        df_bytes = df_output.getvalue()[4:]
+        table_bytes = table_output.getvalue()[4:]
+        if file_format == "csv":
+            assert df_bytes == test_df.to_csv(index=False).encode("utf-8")
+        elif file_format == "json":
+            assert df_bytes == json.dumps(test_df.to_dict()).encode("utf-8")
+            assert table_bytes == json.dumps(table.to_pylist()).encode("utf-8")
+        elif file_format == "ndjson":
+            expected = test_df.to_json(orient="records", lines=True).encode("utf-8")
+            assert df_bytes == expected
+            assert table_bytes.splitlines() == [
+                json.dumps(record).encode("utf-8") for record in table.to_pylist()
+            ]
+        else:
+            pd.testing.assert_frame_equal(pd.read_parquet(BytesIO(df_bytes)), test_df)
+            assert pq.read_table(BytesIO(table_bytes)).equals(table)
+
+    @pytest.mark.parametrize("engine", ["pandas", "arrow"])
+    @pytest.mark.parametrize("file_format", ["csv", "parquet"])
+    def test_release_input_empties_the_bytearray(self, test_df, engine, file_format):
+        if file_format == "csv":
+            file = bytearray(test_df.to_csv(index=False).encode("utf-8"))
+        else:
+            file = bytearray(test_df.to_parquet())
+        expected = BytesIO()
+        obfuscate_file_bytes(
+            bytes(file), None, None, ["name"], expected, {"engine": engine}
+        )
+        output = BytesIO()
+        result = obfuscate_file_bytes(
+            file, None, None, ["name"], output, {"engine": engine}, release_input=True
+        )
+        assert file == bytearray()
+        assert result["row_count"] == 7
+        assert output.getvalue() == expected.getvalue()
@@ -1,12 +1,15 @@
 import botocore.session
+import gzip
 from src.GDPRObfuscator_handler import *
 import pandas as pd
 import pyarrow
+import pyarrow.parquet
 from io import StringIO, BytesIO
 import pytest
 import os
 from moto import mock_aws
 import boto3
+from unittest.mock import patch
 
 
 @pytest.fixture
@@ -24,6 +27,13 @@ def mock_s3_client(aws_creds):
         yield boto3.client("s3")
 
 
+@pytest.fixture(autouse=True)
+def clean_s3_client_registry():
+    reset_s3_clients()
+    yield
+    reset_s3_clients()
+
+
 @pytest.fixture
 def clean_test_bucket(mock_s3_client):
     s3_client = mock_s3_client
@@ -101,3 +111,610 @@ class TestHandlerIntegration:
         response = lambda_handler(test_event, test_context)
         df = pd.read_parquet(BytesIO(response))
         assert df["variety"][0] == "***"
+
+    def test_handler_integration_csv_streaming(self, clean_test_bucket, mock_s3_client):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        test_key_name = "test_data_csv"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            response = s3_client.put_object(
+                Bucket=test_bucket_name, Key=test_key_name, Body=f
+            )
+        test_object = f"s3://{test_bucket_name}/{test_key_name}"
+        test_event = {
+            "s3_path": test_object,
+            "obfuscate_fields": ["First Name"],
+            "streaming": True,
+            "chunk_rows": 10,
+        }
+        test_context = None
+        response = lambda_handler(test_event, test_context)
+        df = pd.read_csv(StringIO(response.decode("utf-8")), sep=",", header=0)
+        assert len(df) == 100
+        assert (df["First Name"] == "***").all()
+
+    def test_handler_integration_arrow_engine(self, clean_test_bucket, mock_s3_client):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        test_files = {
+            "test_data_csv": ("test/test_data/customers-100.csv", "First Name"),
+            "test_data_json": ("test/test_data/json_test_data.json", "first_name"),
+            "test_data_parquet": ("test/test_data/parquet_test_data.parquet", "variety"),
+        }
+        responses = {}
+        for test_key_name, (file_path, field) in test_files.items():
+            with open(file_path, "rb") as f:
+                s3_client.put_object(Bucket=test_bucket_name, Key=test_key_name, Body=f)
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/{test_key_name}",
+                "obfuscate_fields": [field],
+                "engine": "arrow",
+            }
+            responses[test_key_name] = lambda_handler(test_event, None)
+        df = pd.read_csv(BytesIO(responses["test_data_csv"]))
+        assert (df["First Name"] == "***").all()
+        records = json.loads(responses["test_data_json"])
+        assert all(record["first_name"] == "***" for record in records)
+        df = pd.read_parquet(BytesIO(responses["test_data_parquet"]))
+        assert (df["variety"] == "***").all()
+
+    def test_handler_unknown_engine_raises_error(self, clean_test_bucket, mock_s3_client):
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        mock_s3_client.put_object(
+            Bucket=test_bucket_name, Key="test_data_csv", Body=b"name\nbob\n"
+        )
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+            "obfuscate_fields": ["name"],
+            "engine": "polars",
+        }
+        with pytest.raises(ValueError):
+            lambda_handler(test_event, None)
+
+    def test_handler_integration_parquet_passthrough(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        test_key_name = "test_data_parquet"
+        with open("test/test_data/parquet_test_data.parquet", "rb") as f:
+            response = s3_client.put_object(
+                Bucket=test_bucket_name, Key=test_key_name, Body=f
+            )
+        test_object = f"s3://{test_bucket_name}/{test_key_name}"
+        test_event = {
+            "s3_path": test_object,
+            "obfuscate_fields": ["variety"],
+            "parquet_passthrough": True,
+        }
+        test_context = None
+        response = lambda_handler(test_event, test_context)
+        df = pd.read_parquet(BytesIO(response))
+        expected = pd.read_parquet("test/test_data/parquet_test_data.parquet")
+        expected["variety"] = "***"
+        pd.testing.assert_frame_equal(df, expected)
+
+    def test_handler_integration_parquet_streaming(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        test_key_name = "test_data_parquet"
+        with open("test/test_data/parquet_test_data.parquet", "rb") as f:
+            response = s3_client.put_object(
+                Bucket=test_bucket_name, Key=test_key_name, Body=f
+            )
+        test_object = f"s3://{test_bucket_name}/{test_key_name}"
+        for passthrough in (False, True):
+            test_event = {
+                "s3_path": test_object,
+                "obfuscate_fields": ["variety"],
+                "streaming": True,
+                "parquet_passthrough": passthrough,
+            }
+            response = lambda_handler(test_event, None)
+            df = pd.read_parquet(BytesIO(response))
+            expected = pd.read_parquet("test/test_data/parquet_test_data.parquet")
+            expected["variety"] = "***"
+            pd.testing.assert_frame_equal(df, expected)
+
+    def test_handler_integration_parquet_streaming_uses_ranged_requests(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/parquet_test_data.parquet", "rb") as f:
+            mock_s3_client.put_object(
+                Bucket=test_bucket_name, Key="test_data_parquet", Body=f
+            )
+        s3_client = get_s3_client_for_bucket(test_bucket_name)
+        with patch.object(
+            s3_client, "get_object", wraps=s3_client.get_object
+        ) as mocked_get_object:
+            lambda_handler(
+                {
+                    "s3_path": f"s3://{test_bucket_name}/test_data_parquet",
+                    "obfuscate_fields": ["variety"],
+                    "streaming": True,
+                },
+                None,
+            )
+        assert mocked_get_object.call_count > 0
+        for call in mocked_get_object.call_args_list:
+            assert call.kwargs["Range"].startswith("bytes=")
+
+    def test_handler_integration_output_to_s3(self, clean_test_bucket, mock_s3_client):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        test_key_name = "test_data_csv"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=test_bucket_name, Key=test_key_name, Body=f)
+        for streaming in (False, True):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/{test_key_name}",
+                "obfuscate_fields": ["First Name"],
+                "streaming": streaming,
+                "output_s3_path": f"s3://{test_bucket_name}/obfuscated/test_data_csv",
+            }
+            response = lambda_handler(test_event, None)
+            uploaded = s3_client.get_object(
+                Bucket=test_bucket_name, Key="obfuscated/test_data_csv"
+            )
+            df = pd.read_csv(uploaded["Body"])
+            assert (df["First Name"] == "***").all()
+            assert response["key_name"] == "obfuscated/test_data_csv"
+            assert response["row_count"] == 100
+            assert response["format"] == "csv"
+            assert response["etag"] == uploaded["ETag"]
+            assert response["size"] == uploaded["ContentLength"]
+            assert response["timings"]["total_seconds"] >= 0
+
+    def test_handler_integration_output_auto_mode_returns_small_outputs(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=test_bucket_name, Key="test_data_csv", Body=f)
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+            "obfuscate_fields": ["First Name"],
+            "output_s3_path": f"s3://{test_bucket_name}/obfuscated/auto_csv",
+            "output_mode": "auto",
+        }
+        response = lambda_handler(test_event, None)
+        df = pd.read_csv(BytesIO(response))
+        assert (df["First Name"] == "***").all()
+        listed = s3_client.list_objects_v2(
+            Bucket=test_bucket_name, Prefix="obfuscated/auto_csv"
+        )
+        assert "Contents" not in listed
+
+    def test_handler_integration_metrics(
+        self, clean_test_bucket, mock_s3_client, capsys
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=test_bucket_name, Key="test_data_csv", Body=f)
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+            "obfuscate_fields": ["First Name"],
+            "metrics": True,
+        }
+        response = lambda_handler(test_event, None)
+        df = pd.read_csv(BytesIO(response["body"]))
+        assert (df["First Name"] == "***").all()
+        stages = [stage["stage"] for stage in response["metrics"]]
+        assert stages == [
+            "client",
+            "download",
+            "detect_format",
+            "convert_bytestream_to_df",
+            "produce_obfuscated_data",
+            "write_df_to_formatted_output",
+        ]
+        emitted = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [document["Stage"] for document in emitted] == stages
+
+        test_event["output_s3_path"] = f"s3://{test_bucket_name}/obfuscated/metrics"
+        response = lambda_handler(test_event, None)
+        upload = response["metrics"][-1]
+        assert upload["stage"] == "upload"
+        assert upload["bytes_out"] == response["size"]
+
+    def test_handler_integration_metrics_from_environment(
+        self, clean_test_bucket, mock_s3_client, capsys, monkeypatch
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=test_bucket_name, Key="test_data_csv", Body=f)
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+            "obfuscate_fields": ["First Name"],
+        }
+        assert lambda_handler(test_event, None)[:10] == b"Index,Cust"
+        assert capsys.readouterr().out == ""
+        monkeypatch.setenv("OBFUSCATOR_METRICS", "true")
+        response = lambda_handler(test_event, None)
+        assert isinstance(response, bytes)
+        assert "CloudWatchMetrics" in capsys.readouterr().out
+
+    def test_handler_integration_batch(self, clean_test_bucket, mock_s3_client):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            customers = f.read()
+        items = []
+        for i in range(20):
+            s3_client.put_object(
+                Bucket=test_bucket_name, Key=f"batch/{i}.csv", Body=customers
+            )
+            items.append(
+                {
+                    "s3_path": f"s3://{test_bucket_name}/batch/{i}.csv",
+                    "output_s3_path": f"s3://{test_bucket_name}/batch_out/{i}.csv",
+                }
+            )
+        items.append(
+            {
+                "s3_path": f"s3://{test_bucket_name}/batch/0.csv",
+                "output_s3_path": f"s3://{test_bucket_name}/batch_out/bad.csv",
+                "obfuscate_fields": ["Not A Field"],
+            }
+        )
+        test_event = {
+            "items": items,
+            "obfuscate_fields": ["First Name"],
+            "batch_concurrency": 4,
+        }
+        response = lambda_handler(test_event, None)
+        assert response["succeeded"] == 20
+        assert response["failed"] == 1
+        assert response["items"][-1]["error_type"] == "TypeError"
+        for i, report in enumerate(response["items"][:-1]):
+            assert report["s3_path"] == items[i]["s3_path"]
+            uploaded = s3_client.get_object(
+                Bucket=test_bucket_name, Key=f"batch_out/{i}.csv"
+            )
+            df = pd.read_csv(uploaded["Body"])
+            assert (df["First Name"] == "***").all()
+            assert report["etag"] == uploaded["ETag"]
+
+    def test_handler_integration_prefix(self, clean_test_bucket, mock_s3_client):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            customers = f.read()
+        for i in range(5):
+            s3_client.put_object(
+                Bucket=test_bucket_name, Key=f"prefix/in/{i}.csv", Body=customers
+            )
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="prefix/in/nested/5.csv", Body=customers
+        )
+        s3_client.put_object(Bucket=test_bucket_name, Key="prefix/in/folder/", Body=b"")
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="prefix/in/image.png", Body=b"\x89PNG\xff\xfe"
+        )
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="prefix/in/other.csv", Body=b"a,b\n1,2\n"
+        )
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/prefix/in/",
+            "output_s3_path": f"s3://{test_bucket_name}/prefix/out/",
+            "obfuscate_fields": ["First Name"],
+            "batch_concurrency": 2,
+        }
+        response = lambda_handler(test_event, None)
+        assert response["succeeded"] == 6
+        assert response["skipped"] == 2
+        assert response["failed"] == 1
+        assert response["failures"][0]["s3_path"].endswith("prefix/in/other.csv")
+        listed = s3_client.list_objects_v2(
+            Bucket=test_bucket_name, Prefix="prefix/out/"
+        )
+        assert sorted(item["Key"] for item in listed["Contents"]) == sorted(
+            [f"prefix/out/{i}.csv" for i in range(5)] + ["prefix/out/nested/5.csv"]
+        )
+        uploaded = s3_client.get_object(
+            Bucket=test_bucket_name, Key="prefix/out/nested/5.csv"
+        )
+        assert (pd.read_csv(uploaded["Body"])["First Name"] == "***").all()
+
+    def test_handler_integration_prefix_needs_output_prefix(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        test_event = {
+            "s3_path": "s3://test-data-for-obfuscation-bucket/prefix/in/",
+            "output_s3_path": "s3://test-data-for-obfuscation-bucket/out.csv",
+            "obfuscate_fields": ["First Name"],
+        }
+        with pytest.raises(ValueError):
+            lambda_handler(test_event, None)
+
+    def test_handler_integration_fan_out(
+        self, clean_test_bucket, mock_s3_client, monkeypatch
+    ):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.S3_MIN_PART_SIZE", 256)
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        rows = [b"id,name,notes\n"]
+        for i in range(3000):
+            notes = f'"multi\nline ""{i}"""' if i % 4 == 0 else f"note {i}"
+            rows.append(f"{i},customer {i},{notes}\n".encode())
+        test_body = b"".join(rows)
+        s3_client.put_object(Bucket=test_bucket_name, Key="large.csv", Body=test_body)
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/large.csv",
+            "output_s3_path": f"s3://{test_bucket_name}/obfuscated/large.csv",
+            "obfuscate_fields": ["name"],
+            "fan_out": True,
+            "fan_out_range_size": 8192,
+            "fan_out_executor": "local",
+            "fan_out_concurrency": 4,
+        }
+        with patch("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 256):
+            response = lambda_handler(test_event, None)
+        expected = BytesIO()
+        stream_obfuscate_csv(BytesIO(test_body), ["name"], expected)
+        uploaded = s3_client.get_object(
+            Bucket=test_bucket_name, Key="obfuscated/large.csv"
+        )
+        assert uploaded["Body"].read() == expected.getvalue()
+        assert response["workers"] > 5
+        assert response["row_count"] == 3000
+        assert response["etag"] == uploaded["ETag"]
+        assert response["size"] == len(expected.getvalue())
+
+    def test_handler_integration_fan_out_failure_aborts_upload(
+        self, clean_test_bucket, mock_s3_client, monkeypatch
+    ):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.S3_MIN_PART_SIZE", 256)
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=test_bucket_name, Key="test_data_csv", Body=f)
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+            "output_s3_path": f"s3://{test_bucket_name}/obfuscated/failed.csv",
+            "obfuscate_fields": ["Not A Field"],
+            "fan_out": True,
+            "fan_out_range_size": 2048,
+            "fan_out_executor": "local",
+        }
+        with pytest.raises(TypeError):
+            lambda_handler(test_event, None)
+        uploads = s3_client.list_multipart_uploads(Bucket=test_bucket_name)
+        assert "Uploads" not in uploads
+
+    def test_handler_integration_fan_out_checks_part_sizes(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        rows = [b"id,name\n"]
+        rows.extend(f"{i},{'x' * 200}\n".encode() for i in range(55000))
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="wide.csv", Body=b"".join(rows)
+        )
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/wide.csv",
+            "output_s3_path": f"s3://{test_bucket_name}/obfuscated/wide.csv",
+            "obfuscate_fields": ["name"],
+            "fan_out": True,
+            "fan_out_range_size": 1024 * 1024,
+            "fan_out_executor": "local",
+        }
+        with pytest.raises(ValueError, match="fan_out_range_size must be at least"):
+            lambda_handler(test_event, None)
+        test_event["fan_out_range_size"] = 5 * 1024 * 1024
+        with pytest.raises(ValueError, match="after obfuscation"):
+            lambda_handler(test_event, None)
+        uploads = s3_client.list_multipart_uploads(Bucket=test_bucket_name)
+        assert "Uploads" not in uploads
+        listed = s3_client.list_objects_v2(
+            Bucket=test_bucket_name, Prefix="obfuscated/"
+        )
+        assert "Contents" not in listed
+
+    def test_handler_integration_workers(
+        self, clean_test_bucket, mock_s3_client, monkeypatch
+    ):
+        monkeypatch.setattr("src.GDPRObfuscator_handler.PARALLEL_MIN_BYTES", 0)
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            s3_client.put_object(Bucket=test_bucket_name, Key="test_data_csv", Body=f)
+        test_event = {
+            "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+            "obfuscate_fields": ["First Name"],
+            "streaming": True,
+        }
+        streamed = lambda_handler(test_event, None)
+        test_event["streaming"] = False
+        test_event["workers"] = 3
+        assert lambda_handler(test_event, None) == streamed
+
+    def test_handler_integration_exact_engine(self, clean_test_bucket, mock_s3_client):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            test_body = f.read()
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="test_data_csv", Body=test_body
+        )
+        original = pd.read_csv(BytesIO(test_body), dtype=str, keep_default_na=False)
+        for streaming in (False, True):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/test_data_csv",
+                "obfuscate_fields": ["First Name", "Email"],
+                "engine": "exact",
+                "streaming": streaming,
+            }
+            response = lambda_handler(test_event, None)
+            result = pd.read_csv(BytesIO(response), dtype=str, keep_default_na=False)
+            assert (result[["First Name", "Email"]] == "***").all().all()
+            untouched = original.drop(columns=["First Name", "Email"])
+            pd.testing.assert_frame_equal(
+                result.drop(columns=["First Name", "Email"]), untouched
+            )
+            assert response.splitlines()[0] == test_body.splitlines()[0]
+
+    def test_handler_integration_json_keeps_records(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/json_test_data.json", "rb") as f:
+            test_body = f.read()
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="test_data_json", Body=test_body
+        )
+        original = json.loads(test_body)
+        for streaming in (False, True):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/test_data_json",
+                "obfuscate_fields": ["first_name", "email"],
+                "streaming": streaming,
+            }
+            records = json.loads(lambda_handler(test_event, None))
+            assert len(records) == len(original)
+            for record, original_record in zip(records, original):
+                assert list(record) == list(original_record)
+                assert record["first_name"] == record["email"] == "***"
+                assert record["id"] == original_record["id"]
+
+    def test_handler_integration_ndjson_line_for_line(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/json_test_data.json", "rb") as f:
+            original = json.loads(f.read())
+        test_body = "".join(json.dumps(record) + "\n" for record in original)
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="test_data.jsonl", Body=test_body
+        )
+        for options in ({}, {"streaming": True}, {"workers": 2}):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/test_data.jsonl",
+                "obfuscate_fields": ["first_name", "email"],
+                **options,
+            }
+            lines = lambda_handler(test_event, None).decode("utf-8").splitlines()
+            assert len(lines) == len(original)
+            for line, original_record in zip(lines, original):
+                record = json.loads(line)
+                assert list(record) == list(original_record)
+                assert record["first_name"] == record["email"] == "***"
+                assert record["id"] == original_record["id"]
+
+    def test_handler_integration_nested_field_paths(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        records = [
+            {"id": 1, "customer": {"contact": {"email": "a@b.com", "phone": "1"}}},
+            {"id": 2, "customer": {"contact": {"email": "c@d.com", "phone": "2"}}},
+        ]
+        sink = BytesIO()
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records), sink)
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="nested.parquet", Body=sink.getvalue()
+        )
+        s3_client.put_object(
+            Bucket=test_bucket_name, Key="nested.json", Body=json.dumps(records)
+        )
+        expected = [
+            {"id": 1, "customer": {"contact": {"email": "***", "phone": "1"}}},
+            {"id": 2, "customer": {"contact": {"email": "***", "phone": "2"}}},
+        ]
+        for options in ({}, {"engine": "arrow"}, {"streaming": True}):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/nested.parquet",
+                "obfuscate_fields": ["customer.contact.email"],
+                **options,
+            }
+            response = lambda_handler(test_event, None)
+            table = pyarrow.parquet.read_table(BytesIO(response))
+            assert table.to_pylist() == expected
+            test_event["s3_path"] = f"s3://{test_bucket_name}/nested.json"
+            assert json.loads(lambda_handler(test_event, None)) == expected
+
+    def test_handler_integration_gzip_round_trip(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        s3_client = mock_s3_client
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        with open("test/test_data/customers-100.csv", "rb") as f:
+            test_body = f.read()
+        s3_client.put_object(
+            Bucket=test_bucket_name,
+            Key="customers.csv.gz",
+            Body=gzip.compress(test_body),
+        )
+        for options in ({}, {"streaming": True}, {"engine": "exact"}):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/customers.csv.gz",
+                "obfuscate_fields": ["First Name"],
+                **options,
+            }
+            response = lambda_handler(test_event, None)
+            df = pd.read_csv(BytesIO(gzip.decompress(response)))
+            assert (df["First Name"] == "***").all()
+            assert len(df) == 100
+            test_event["output_compression"] = "none"
+            uncompressed = lambda_handler(test_event, None)
+            assert uncompressed == gzip.decompress(response)
+
+    def test_handler_integration_pseudonymise(
+        self, clean_test_bucket, mock_s3_client, monkeypatch
+    ):
+        monkeypatch.setenv("OBFUSCATOR_PSEUDONYMISATION_KEY", "integration secret")
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        mock_s3_client.upload_file(
+            "test/test_data/customers-100.csv", test_bucket_name, "customers-100.csv"
+        )
+        tokens = {}
+        for options in ({}, {"streaming": True}, {"engine": "exact"}):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/customers-100.csv",
+                "obfuscate_fields": ["First Name"],
+                "mode": "pseudonymise",
+                **options,
+            }
+            response = lambda_handler(test_event, None)
+            df = pd.read_csv(BytesIO(response))
+            tokens[json.dumps(options)] = list(df["First Name"])
+        assert len({json.dumps(value) for value in tokens.values()}) == 1
+        first_names = pd.read_csv("test/test_data/customers-100.csv")["First Name"]
+        assert first_names.nunique() == len(set(tokens["{}"]))
+        monkeypatch.delenv("OBFUSCATOR_PSEUDONYMISATION_KEY")
+        with pytest.raises(ValueError):
+            lambda_handler(test_event, None)
+
+    def test_handler_integration_parquet_typed_mask(
+        self, clean_test_bucket, mock_s3_client
+    ):
+        test_bucket_name = "test-data-for-obfuscation-bucket"
+        sink = BytesIO()
+        pyarrow.parquet.write_table(
+            pyarrow.table({"id": [1, 2], "age": [30, 40], "name": ["a", "b"]}), sink
+        )
+        mock_s3_client.put_object(
+            Bucket=test_bucket_name, Key="typed.parquet", Body=sink.getvalue()
+        )
+        for options in ({}, {"engine": "arrow"}, {"streaming": True}):
+            test_event = {
+                "s3_path": f"s3://{test_bucket_name}/typed.parquet",
+                "obfuscate_fields": ["age", "name"],
+                "typed_mask": "null",
+                **options,
+            }
+            response = lambda_handler(test_event, None)
+            table = pyarrow.parquet.read_table(BytesIO(response))
+            assert table.schema.field("age").type == pyarrow.int64()
+            assert table.column("age").null_count == 2
+            assert table.column("name").to_pylist() == ["***", "***"]